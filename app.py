@@ -1,20 +1,29 @@
 import os
 import json
-import cv2
-import numpy as np
-from flask import Flask, request, jsonify, send_file
-from flask_cors import CORS, cross_origin
-from PIL import Image
-import pdf2image
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import uuid
+from flask import Flask, Request, Response, request, jsonify, send_file, g
+from flask_cors import CORS
 from datetime import datetime
 import io
-import base64
+import time
 from werkzeug.utils import secure_filename
 import tempfile
 import logging
+import threading
 from dotenv import load_dotenv
+from omr_pool import SheetPool
+from omr_jobs import JobQueue
+from db_pool import DatabasePool, db_config
+import omr_store
+import omr_export
+import omr_stats
+from result_cache import ResultCache
+from omr_templates import TemplateCache
+import omr_metrics
+from sheet_cache import SheetCache, hash_stream
+from omr_admission import AdmissionControl
+from omr_uploads import UploadSessions, UploadError
+from omr_archive import CropArchive, without_crops
 
 # Load environment variables
 load_dotenv()
@@ -36,6 +45,8 @@ CORS(app, resources={
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'pdf'}
 MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
+UPLOAD_SPOOL_THRESHOLD = int(os.getenv('UPLOAD_SPOOL_THRESHOLD', str(8 * 1024 * 1024)))  # Spool larger uploads to disk
+PRELOAD_IMAGING = os.getenv('OMR_PRELOAD_IMAGING', 'true').lower() == 'true'  # Import OpenCV in the background after startup
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
@@ -43,178 +54,160 @@ app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
 # Create uploads directory if it doesn't exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-# Database connection
-def get_db_connection():
-    try:
-        # Get database config from environment variables
-        db_config = {
-            'host': os.getenv('PGHOST', 'localhost'),
-            'database': os.getenv('PGDATABASE', 'omrscan'),
-            'user': os.getenv('PGUSER', 'postgres'),
-            'password': os.getenv('PGPASSWORD', 'root'),
-            'port': os.getenv('PGPORT', '5432')
-        }
-        
-        # Log connection attempt (without password)
-        log_config = db_config.copy()
-        log_config.pop('password')
-        logger.info(f"Attempting database connection with config: {log_config}")
-        
-        conn = psycopg2.connect(**db_config)
-        logger.info("Database connection successful")
-        return conn
-        
-    except psycopg2.Error as e:
-        logger.error(f"PostgreSQL Error: {e.diag.message_primary if hasattr(e, 'diag') else str(e)}")
-        return None
-    except Exception as e:
-        logger.error(f"Unexpected error in database connection: {str(e)}")
+# Sheet processing pool (OMR_POOL_WORKERS=0 keeps processing in the request thread)
+sheet_pool = SheetPool()
+
+# Results of previously processed uploads, keyed by content hash
+sheet_cache = SheetCache()
+
+def store_sheet_result(batch_code, position, filename, results):
+    """Store a background-processed file's sheets under its batch subject
+
+    Raises when they cannot be stored, so the job queue keeps the sheet for a retry.
+    """
+    with db_pool.connection() as conn:
+        if not conn:
+            raise RuntimeError('Database connection failed')
+        batch_id = omr_store.batch_id_for(conn, batch_code)
+        if batch_id is None:
+            raise ValueError(f"Batch {batch_code} not found for {filename}")
+        try:
+            omr_store.clear_sheets(conn, batch_id, position)
+            omr_store.insert_sheets(conn, batch_id, position, filename, results)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        result_cache.invalidate(batch_code)
+
+# Durable background queue for /api/upload/<batch_code>
+job_queue = JobQueue(sheet_pool, on_sheet_done=store_sheet_result, sheet_cache=sheet_cache)
+
+# Database connection pool, shared by all routes
+db_pool = DatabasePool(db_config('omrscan'))
+
+# Cache of /api/results payloads, invalidated whenever a batch is written
+result_cache = ResultCache()
+
+# Compiled bubble layouts keyed by template id and version
+template_cache = TemplateCache()
+
+# Resumable chunked uploads, each file queued on the job queue as soon as it is complete
+upload_sessions = UploadSessions(job_queue, sheet_cache=sheet_cache)
+
+# Per-process limits on concurrent uploads and reads; uploads are refused while the job queue is backed up
+admission = AdmissionControl(backlog=job_queue.backlog)
+
+# Routes limited as uploads; health and metrics are never limited so probes keep working
+UPLOAD_ENDPOINTS = {'upload_omr', 'upload_files', 'create_upload_session'}
+# Chunks of an admitted upload session take upload slots but skip the backlog check
+UPLOAD_CHUNK_ENDPOINTS = {'put_upload_chunk'}
+UNLIMITED_ENDPOINTS = {'health_check', 'metrics', 'static'}
+
+# Pool and cache state sampled when /api/metrics is scraped; the queue is shared, the rest per process
+omr_metrics.registry.gauge('omr_db_pool_in_use', 'Database connections checked out', lambda: db_pool.in_use)
+omr_metrics.registry.gauge('omr_result_cache_entries', 'Batches held in the results cache',
+                           lambda: result_cache.stats()['size'])
+omr_metrics.registry.gauge('omr_job_queue_depth', 'Sheets pending or processing in the job queue', job_queue.backlog,
+                           per_process=False)
+omr_metrics.registry.gauge('omr_uploads_in_flight', 'Upload requests being handled',
+                           lambda: admission.limiters['upload'].in_flight)
+omr_metrics.registry.gauge('omr_reads_in_flight', 'Read requests being handled',
+                           lambda: admission.limiters['read'].in_flight)
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.before_request
+def admit_request():
+    if request.endpoint is None or request.endpoint in UNLIMITED_ENDPOINTS:
         return None
+    chunk = request.endpoint in UPLOAD_CHUNK_ENDPOINTS
+    kind = 'upload' if chunk or request.endpoint in UPLOAD_ENDPOINTS else 'read'
+    
+    # Refused before the request body is read, so rejected uploads cost no memory
+    refused = admission.admit(kind, check_backlog=not chunk)
+    if refused:
+        status, message = refused
+        response = jsonify({'error': message, 'retryAfter': admission.retry_after})
+        response.status_code = status
+        response.headers['Retry-After'] = str(admission.retry_after)
+        return response
+    g.admission = kind
+
+@app.teardown_request
+def release_admission(exc=None):
+    kind = g.pop('admission', None)
+    if kind is not None:
+        admission.release(kind)
+
+@app.after_request
+def record_request_time(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        omr_metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, method=request.method,
+                                            endpoint=endpoint, status=response.status_code)
+    return response
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-class OMRProcessor:
-    def __init__(self):
-        self.question_regions = [
-            # Define regions for 5 questions with 5 rating options each
-            # Format: (x, y, width, height) for each option
-            # Question 1: Course Content Quality
-            [(100, 150, 25, 25), (140, 150, 25, 25), (180, 150, 25, 25), (220, 150, 25, 25), (260, 150, 25, 25)],
-            # Question 2: Teaching Effectiveness  
-            [(100, 200, 25, 25), (140, 200, 25, 25), (180, 200, 25, 25), (220, 200, 25, 25), (260, 200, 25, 25)],
-            # Question 3: Learning Materials
-            [(100, 250, 25, 25), (140, 250, 25, 25), (180, 250, 25, 25), (220, 250, 25, 25), (260, 250, 25, 25)],
-            # Question 4: Assessment Methods
-            [(100, 300, 25, 25), (140, 300, 25, 25), (180, 300, 25, 25), (220, 300, 25, 25), (260, 300, 25, 25)],
-            # Question 5: Overall Satisfaction
-            [(100, 350, 25, 25), (140, 350, 25, 25), (180, 350, 25, 25), (220, 350, 25, 25), (260, 350, 25, 25)]
-        ]
-        
-        self.questions = [
-            "Course Content Quality",
-            "Teaching Effectiveness", 
-            "Learning Materials",
-            "Assessment Methods",
-            "Overall Satisfaction"
-        ]
-
-    def preprocess_image(self, image):
-        """Preprocess image for better OMR detection"""
-        # Convert to grayscale
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        
-        # Apply Gaussian blur to reduce noise
-        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-        
-        # Apply adaptive threshold for better contrast
-        thresh = cv2.adaptiveThreshold(blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
-                                     cv2.THRESH_BINARY_INV, 11, 2)
-        
-        return thresh
+def is_pdf(filename):
+    return filename.lower().endswith('.pdf')
 
-    def detect_filled_circles(self, image, regions):
-        """Detect filled circles/marks in specified regions"""
-        processed_image = self.preprocess_image(image)
-        results = []
-        
-        for i, question_regions in enumerate(regions):
-            question_results = []
-            
-            for j, (x, y, w, h) in enumerate(question_regions):
-                # Extract region of interest
-                roi = processed_image[y:y+h, x:x+w]
-                
-                if roi.size == 0:
-                    question_results.append(0)
-                    continue
-                
-                # Calculate the percentage of filled pixels
-                total_pixels = roi.size
-                filled_pixels = cv2.countNonZero(roi)
-                fill_percentage = filled_pixels / total_pixels
-                
-                # Consider it marked if more than 30% is filled
-                is_marked = fill_percentage > 0.3
-                confidence = min(fill_percentage * 2, 1.0)  # Convert to confidence score
-                
-                question_results.append({
-                    'option': j + 1,
-                    'is_marked': is_marked,
-                    'confidence': confidence,
-                    'fill_percentage': fill_percentage
-                })
-            
-            results.append(question_results)
-        
-        return results
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        """Keep small uploads in memory and spool large ones to a named file in UPLOAD_FOLDER"""
+        if total_content_length is not None and total_content_length <= UPLOAD_SPOOL_THRESHOLD:
+            return io.BytesIO()
+        suffix = os.path.splitext(secure_filename(filename or ''))[1]
+        return tempfile.NamedTemporaryFile('wb+', dir=app.config['UPLOAD_FOLDER'], suffix=suffix)
 
-    def calculate_ratings(self, detection_results):
-        """Calculate ratings based on detection results"""
-        ratings = []
-        
-        for i, question_results in enumerate(detection_results):
-            # Find the highest confidence marked option
-            marked_options = [r for r in question_results if r['is_marked']]
-            
-            if marked_options:
-                # Select the option with highest confidence
-                best_option = max(marked_options, key=lambda x: x['confidence'])
-                rating = best_option['option']
-                confidence = best_option['confidence']
-            else:
-                # No clear marking detected, assign neutral rating
-                rating = 3
-                confidence = 0.1
-            
-            ratings.append({
-                'question': self.questions[i],
-                'rating': rating,
-                'confidence': confidence,
-                'percentage': (rating / 5) * 100
-            })
-        
-        return ratings
+app.request_class = UploadRequest
 
-    def process_image_file(self, image_path):
-        """Process an image file and extract OMR data"""
-        try:
-            # Load image
-            image = cv2.imread(image_path)
-            if image is None:
-                raise ValueError("Could not load image")
-            
-            # Detect filled circles
-            detection_results = self.detect_filled_circles(image, self.question_regions)
-            
-            # Calculate ratings
-            ratings = self.calculate_ratings(detection_results)
-            
-            return {
-                'success': True,
-                'ratings': ratings,
-                'overall_score': sum(r['rating'] for r in ratings) / len(ratings),
-                'confidence': sum(r['confidence'] for r in ratings) / len(ratings)
-            }
-            
-        except Exception as e:
-            logger.error(f"Error processing image: {e}")
-            return {
-                'success': False,
-                'error': str(e),
-                'ratings': [],
-                'overall_score': 0,
-                'confidence': 0
-            }
+def spool_upload(file):
+    """Write an in-memory upload to a uniquely named file in UPLOAD_FOLDER and return its path"""
+    suffix = os.path.splitext(secure_filename(file.filename))[1]
+    with tempfile.NamedTemporaryFile(dir=app.config['UPLOAD_FOLDER'], suffix=suffix, delete=False) as spool:
+        spool.write(file.stream.getbuffer())
+    return spool.name
 
-    def convert_pdf_to_images(self, pdf_path):
-        """Convert PDF to images for processing"""
-        try:
-            images = pdf2image.convert_from_path(pdf_path)
-            return [np.array(img) for img in images]
-        except Exception as e:
-            logger.error(f"Error converting PDF: {e}")
-            return []
+def upload_source(file):
+    """Return (source, spool_path) for an upload; source is a file path or in-memory buffer"""
+    stream = file.stream
+    
+    # Large uploads were already spooled to a named file by UploadRequest
+    if not hasattr(stream, 'getbuffer'):
+        stream.flush()
+        return stream.name, None
+    
+    # pdf2image always shells out to poppler with a file path, so PDFs are written once
+    if is_pdf(file.filename):
+        spool_path = spool_upload(file)
+        return spool_path, spool_path
+    
+    # Decode in place from the request buffer
+    return stream.getbuffer(), None
+
+def submit_upload(file, template=None, profile=None):
+    """Queue an upload on the sheet pool, returning (pending, spool_path)"""
+    source, spool_path = upload_source(file)
+    try:
+        return sheet_pool.submit(source, is_pdf(file.filename), template, profile), spool_path
+    except Exception:
+        if spool_path:
+            os.remove(spool_path)
+        raise
+
+def collect_upload(pending, spool_path):
+    """Wait for a queued upload and clean up its spool file"""
+    try:
+        return pending.result()
+    finally:
+        if spool_path:
+            os.remove(spool_path)
 
 @app.route('/api/upload-omr', methods=['POST'])
 def upload_omr():
@@ -230,15 +223,51 @@ def upload_omr():
         
         subjects = json.loads(subjects_json)
         
+        # Optional bubble layout; the built-in feedback form is used without one
+        template = None
+        template_id = request.form.get('templateId')
+        if template_id:
+            with db_pool.connection() as conn:
+                if not conn:
+                    return jsonify({'error': 'Database connection failed'}), 500
+                template = template_cache.from_db(conn, template_id)
+            if template is None:
+                return jsonify({'error': f'Template {template_id} not found'}), 404
+        
+        # Scanner or feeder the sheets came from, so alignment can reuse its transform
+        scanner_profile = request.form.get('scannerProfile')
+        
         # Get uploaded files
         files = request.files.getlist('omrSheets')
         if not files:
             return jsonify({'error': 'No files uploaded'}), 400
         
-        processor = OMRProcessor()
+        # Raw processor results per subject, stored as sheet rows below
+        subject_results = {}
+        
+        # Fan every subject's OMR sheet out to the sheet pool first, unless
+        # identical bytes were already processed with this template
+        pending = {}
+        cached = {}
+        content_keys = {}
+        duplicates = {}
+        for i, subject in enumerate(subjects):
+            if i < len(files) and files[i].filename and allowed_file(files[i].filename):
+                try:
+                    digest = hash_stream(files[i].stream)
+                    duplicates[i] = sheet_cache.register(batch_code, digest, secure_filename(files[i].filename))
+                    content_keys[i] = sheet_cache.key(digest, template)
+                    cached[i] = sheet_cache.get(content_keys[i])
+                    if cached[i] is None:
+                        pending[i] = submit_upload(files[i], template, scanner_profile)
+                    else:
+                        pending[i] = None
+                except Exception as e:
+                    pending[i] = e
+        
         processed_subjects = []
         
-        # Process each subject's OMR sheet
+        # Collect results back in subject order
         for i, subject in enumerate(subjects):
             subject_result = {
                 'subject': subject['subjectName'],
@@ -248,94 +277,75 @@ def upload_omr():
             }
             
             # Check if there's a corresponding file for this subject
-            if i < len(files) and files[i].filename:
-                file = files[i]
+            if i in pending:
+                filename = secure_filename(files[i].filename)
                 
-                if file and allowed_file(file.filename):
-                    # Save uploaded file
-                    filename = secure_filename(file.filename)
-                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    file.save(filepath)
+                try:
+                    if duplicates.get(i):
+                        subject_result['duplicate'] = True
+                        subject_result['duplicateOf'] = duplicates[i]
+                    if isinstance(pending[i], Exception):
+                        raise pending[i]
+                    if cached.get(i) is not None:
+                        result = cached[i]
+                    else:
+                        result = collect_upload(*pending[i])
+                        sheet_cache.put(content_keys[i], result)
+                    subject_results[i] = (filename, result)
                     
-                    try:
-                        # Process the OMR sheet
-                        if filename.lower().endswith('.pdf'):
-                            # Convert PDF to images and process first page
-                            images = processor.convert_pdf_to_images(filepath)
-                            if images:
-                                # Save first page as temporary image
-                                temp_img_path = filepath.replace('.pdf', '_page1.jpg')
-                                cv2.imwrite(temp_img_path, cv2.cvtColor(images[0], cv2.COLOR_RGB2BGR))
-                                result = processor.process_image_file(temp_img_path)
-                                os.remove(temp_img_path)  # Clean up temp file
-                            else:
-                                result = {'success': False, 'error': 'Could not process PDF'}
-                        else:
-                            # Process image directly
-                            result = processor.process_image_file(filepath)
-                        
-                        if result['success']:
-                            # Calculate overall percentage from ratings
-                            avg_rating = result['overall_score']
-                            percentage = (avg_rating / 5) * 100
-                            
-                            subject_result.update({
-                                'percentage': round(percentage, 1),
-                                'isUploaded': True,
-                                'ratings': result['ratings'],
-                                'confidence': result['confidence']
-                            })
-                        else:
-                            logger.error(f"Processing failed for {filename}: {result.get('error', 'Unknown error')}")
-                            # Set default values for failed processing
-                            subject_result.update({
-                                'percentage': 75.0,  # Default percentage
-                                'isUploaded': True,
-                                'error': result.get('error', 'Processing failed')
-                            })
-                        
-                        # Clean up uploaded file
-                        os.remove(filepath)
+                    if result['success']:
+                        # Overall percentage from the ratings, each out of its question's options
+                        percentage = omr_store.result_percentage(result)
                         
-                    except Exception as e:
-                        logger.error(f"Error processing file {filename}: {e}")
                         subject_result.update({
-                            'percentage': 75.0,  # Default percentage  
+                            'percentage': round(percentage, 1),
                             'isUploaded': True,
-                            'error': str(e)
+                            'ratings': result['ratings'],
+                            'confidence': result['confidence']
                         })
-                        
-                        # Clean up file if it exists
-                        if os.path.exists(filepath):
-                            os.remove(filepath)
+                        if 'sheets' in result:
+                            subject_result['sheets'] = without_crops(result)['sheets']
+                    else:
+                        logger.error(f"Processing failed for {filename}: {result.get('error', 'Unknown error')}")
+                        # Set default values for failed processing
+                        subject_result.update({
+                            'percentage': 75.0,  # Default percentage
+                            'isUploaded': True,
+                            'error': result.get('error', 'Processing failed')
+                        })
+                    
+                except Exception as e:
+                    logger.error(f"Error processing file {filename}: {e}")
+                    subject_result.update({
+                        'percentage': 75.0,  # Default percentage  
+                        'isUploaded': True,
+                        'error': str(e)
+                    })
             
             processed_subjects.append(subject_result)
         
-        # Save to database
-        conn = get_db_connection()
-        if conn:
-            try:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    INSERT INTO result (batch_code, phase, total_students, subjects,percentage,remarks)
-                    VALUES (%s, %s, %s, %s)
-                    ON CONFLICT (batch_code) DO UPDATE SET
-                    phase = EXCLUDED.phase,
-                    total_students = EXCLUDED.total_students,
-                    subjects = EXCLUDED.subjects,
-                    updated_at = CURRENT_TIMESTAMP
-                """, (batch_code, phase, int(total_students), json.dumps(processed_subjects)))
-                
-                conn.commit()
-                cursor.close()
-                conn.close()
-                
-                logger.info(f"Successfully saved batch {batch_code} to database")
-                
-            except Exception as e:
-                logger.error(f"Database error: {e}")
-                conn.rollback()
-                conn.close()
+        # Save to database, one row per sheet and per question response
+        with db_pool.connection() as conn:
+            if conn:
+                try:
+                    batch = omr_store.upsert_batch(
+                        conn, batch_code, phase, int(total_students),
+                        [(s['subjectName'], s['teacherName']) for s in subjects])
+                    for i in subject_results:
+                        omr_store.clear_sheets(conn, batch['id'], i)
+                    
+                    # Bulk-write every sheet; the writer commits once per flush
+                    with omr_store.SheetWriter(conn) as writer:
+                        for i, (filename, result) in subject_results.items():
+                            writer.add(batch['id'], i, filename, result)
+                    conn.commit()
+                    result_cache.invalidate(batch_code)
+                    
+                    logger.info(f"Successfully saved batch {batch_code} to database")
+                    
+                except Exception as e:
+                    logger.error(f"Database error: {e}")
+                    conn.rollback()
         
         return jsonify({
             'message': 'OMR sheets processed successfully',
@@ -350,97 +360,156 @@ def upload_omr():
 @app.route('/api/results/<batch_code>', methods=['GET'])
 def get_results(batch_code):
     try:
-        logger.info(f"Fetching results for batch code: {batch_code}")
-        conn = get_db_connection()
-        if not conn:
-            logger.error("Database connection failed")
-            return jsonify({'error': 'Database connection failed', 'details': 'Could not establish database connection'}), 500
-        
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute("""
-            SELECT batch_code, phase, total_students, subjects, created_at
-            FROM result 
-            WHERE batch_code = %s
-        """, (batch_code,))
+        # Serve from cache (or answer a revalidation with 304) without touching the database
+        entry = result_cache.get(batch_code)
+        if entry is not None:
+            return cached_response(entry)
         
-        result = cursor.fetchone()
-        cursor.close()
+        logger.info(f"Fetching results for batch code: {batch_code}")
+        version = result_cache.version(batch_code)
+        with db_pool.connection() as conn:
+            if not conn:
+                logger.error("Database connection failed")
+                return jsonify({'error': 'Database connection failed', 'details': 'Could not establish database connection'}), 500
+            
+            batch = omr_store.fetch_batch(conn, batch_code)
+            if batch:
+                subjects = omr_store.fetch_subject_results(conn, batch['id'])
         
-        if not result:
+        if not batch:
             logger.info(f"No results found for batch code: {batch_code}")
             return jsonify({'error': 'Batch not found', 'message': f'No results found for batch code {batch_code}'}), 404
         
         # Convert the results to JSON-safe format
         response_data = {
-            'batchCode': result['batch_code'],
-            'phase': result['phase'],
-            'totalStudents': result['total_students'],
-            'subjects': result['subjects'],
-            'createdAt': result['created_at'].isoformat(),
+            'batchCode': batch['batch_code'],
+            'phase': batch['phase'],
+            'totalStudents': batch['total_students'],
+            'subjects': subjects,
+            'createdAt': batch['created_at'].isoformat(),
             'dataSource': 'database'
         }
-        return jsonify(response_data)
+        return cached_response(result_cache.put(batch_code, response_data, version, batch['last_modified']))
         
     except Exception as e:
         logger.error(f"Error fetching results: {e}")
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/export/excel/<batch_code>', methods=['GET'])
-def export_excel(batch_code):
+def cached_response(entry):
+    """JSON response with validators so browsers can revalidate with If-None-Match"""
+    response = jsonify(entry.data)
+    response.set_etag(entry.etag)
+    response.last_modified = entry.last_modified
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+def export_response(batch_codes, download_name, multi_batch=False):
+    """Stream a CSV (or constant-memory XLSX) export of one or more batches"""
+    export_format = request.args.get('format', 'csv')
+    detail = request.args.get('detail', 'summary')
+    if export_format not in ('csv', 'xlsx') or detail not in ('summary', 'sheets'):
+        return jsonify({'error': 'Unsupported export format'}), 400
+    
+    conn = db_pool.getconn()
+    if not conn:
+        return jsonify({'error': 'Database connection failed'}), 500
+    
+    released = []
+    def release():
+        if not released:
+            released.append(True)
+            db_pool.putconn(conn)
+    
     try:
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({'error': 'Database connection failed'}), 500
-        
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute("""
-            SELECT batch_code, phase, total_students, subjects
-            FROM result 
-            WHERE batch_code = %s
-        """, (batch_code,))
-        
-        result = cursor.fetchone()
-        cursor.close()
-        conn.close()
-        
-        if not result:
+        if not multi_batch and not omr_store.fetch_batch(conn, batch_codes[0]):
+            release()
             return jsonify({'error': 'Batch not found'}), 404
         
-        # Create CSV content
-        csv_content = "Subject,Teacher Name,Percentage,Status\n"
-        for subject in result['subjects']:
-            status = "Uploaded" if subject.get('isUploaded', False) else "Not Uploaded"
-            csv_content += f"{subject['subject']},{subject['teacherName']},{subject['percentage']},{status}\n"
-        
-        # Create a temporary file for download
-        temp_file = io.BytesIO()
-        temp_file.write(csv_content.encode('utf-8'))
-        temp_file.seek(0)
-        
-        return send_file(
-            temp_file,
-            as_attachment=True,
-            download_name=f"{batch_code}_results.csv",
-            mimetype='text/csv'
-        )
-        
+        if detail == 'sheets':
+            header, rows = omr_export.sheet_rows(conn, batch_codes)
+            download_name = download_name.replace('_results', '_sheets')
+        else:
+            header, rows = omr_export.summary_rows(conn, batch_codes, with_batch_code=multi_batch)
+        
+        if export_format == 'xlsx':
+            path = omr_export.write_xlsx(header, rows)
+            release()
+            response = send_file(
+                path,
+                as_attachment=True,
+                download_name=f"{download_name}.xlsx",
+                mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+            )
+            response.call_on_close(lambda: os.remove(path))
+            return response
+    except Exception:
+        release()
+        raise
+    
+    # Rows are fetched from a server-side cursor while the response streams
+    response = Response(omr_export.iter_csv(header, rows), mimetype='text/csv', headers={
+        'Content-Disposition': f'attachment; filename="{download_name}.csv"'
+    })
+    response.call_on_close(release)
+    return response
+
+@app.route('/api/export/excel/<batch_code>', methods=['GET'])
+def export_excel(batch_code):
+    try:
+        return export_response([batch_code], f"{batch_code}_results")
+    except ImportError:
+        return jsonify({'error': 'XLSX export requires the xlsxwriter package'}), 501
+    except Exception as e:
+        logger.error(f"Export error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/export/batches', methods=['GET'])
+def export_batches():
+    try:
+        batch_codes = [code for code in request.args.get('batchCodes', '').split(',') if code]
+        if not batch_codes:
+            return jsonify({'error': 'No batch codes given'}), 400
+        return export_response(batch_codes, 'batches_results', multi_batch=True)
+    except ImportError:
+        return jsonify({'error': 'XLSX export requires the xlsxwriter package'}), 501
     except Exception as e:
         logger.error(f"Export error: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """Prometheus scrape endpoint"""
+    return Response(omr_metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/dashboard/stats', methods=['GET'])
+def dashboard_stats():
+    """Counters maintained by the omr_stats triggers, read without scanning sheets"""
+    try:
+        with db_pool.connection() as conn:
+            if not conn:
+                return jsonify({'error': 'Database connection failed'}), 500
+            stats = omr_stats.fetch_stats(conn, request.args.get('hours', omr_stats.STATS_HOURS, type=int))
+        
+        if stats is None:
+            return jsonify({'error': 'Statistics are not installed', 'message': 'Run python omr_stats.py install'}), 503
+        return jsonify(stats)
+    except Exception as e:
+        logger.error(f"Error fetching dashboard stats: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     try:
-        conn = get_db_connection()
-        if conn:
-            conn.close()
-            db_status = "connected"
-        else:
-            db_status = "disconnected"
+        with db_pool.connection() as conn:
+            db_status = "connected" if conn else "disconnected"
         
         return jsonify({
             'status': 'healthy',
             'database': db_status,
+            'databasePool': db_pool.stats(),
+            'resultCache': result_cache.stats(),
+            'sheetCache': sheet_cache.stats(),
+            'admission': admission.stats(),
             'timestamp': datetime.now().isoformat()
         })
     except Exception as e:
@@ -454,21 +523,15 @@ def health_check():
 def create_batch():
     try:
         data = request.get_json()
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({'error': 'Database connection failed'}), 500
-
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute("""
-            INSERT INTO result (batch_code, phase, total_students, subjects)
-            VALUES (%s, %s, %s, %s)
-            RETURNING *
-        """, (data['batchCode'], data['description'], data['totalStudents'], json.dumps(data['subjects'])))
-        
-        result = cursor.fetchone()
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with db_pool.connection() as conn:
+            if not conn:
+                return jsonify({'error': 'Database connection failed'}), 500
+
+            result = omr_store.upsert_batch(
+                conn, data['batchCode'], data['description'], data['totalStudents'],
+                [(s['subject'], s['teacherName']) for s in data['subjects']])
+            conn.commit()
+            result_cache.invalidate(data['batchCode'])
 
         return jsonify(result), 201
     except Exception as e:
@@ -486,38 +549,27 @@ def upload_files(batch_code):
             return jsonify({'error': 'No files selected'}), 400
 
         uploaded_files = []
+        uploads = []
         for file in files:
             if file and allowed_file(file.filename):
                 filename = secure_filename(file.filename)
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(filepath)
-                
-                uploaded_files.append({
-                    'filename': filename,
-                    'filepath': filepath
-                })
-
-                # Process OMR in background
-                processor = OMRProcessor()
-                results = processor.process_image(filepath)  # You'll need to implement this method
                 
-                # Store results in database
-                conn = get_db_connection()
-                if conn:
-                    cursor = conn.cursor()
-                    cursor.execute("""
-                        UPDATE result 
-                        SET subjects = subjects || jsonb_build_object('results', %s::jsonb) 
-                        WHERE batch_code = %s
-                    """, (json.dumps([{'filename': filename, 'results': results}]), batch_code))
-                    conn.commit()
-                    cursor.close()
-                    conn.close()
+                uploaded_file = {'filename': filename}
+                duplicate_of = sheet_cache.register(batch_code, hash_stream(file.stream), filename)
+                if duplicate_of:
+                    uploaded_file.update({'duplicate': True, 'duplicateOf': duplicate_of})
+                uploaded_files.append(uploaded_file)
+                uploads.append((filename, is_pdf(filename), file.save))
+
+        # Queue the sheets; they are processed in the background by the job queue
+        job_id = job_queue.enqueue(batch_code, uploads)
 
         return jsonify({
             'message': f'Successfully uploaded {len(uploaded_files)} files',
-            'files': uploaded_files
-        }), 201
+            'files': uploaded_files,
+            'jobId': job_id,
+            'statusUrl': f'/api/jobs/{job_id}'
+        }), 202
 
     except Exception as e:
         logger.error(f"Upload error: {e}")
@@ -525,5 +577,215 @@ def upload_files(batch_code):
 
 
 
+@app.route('/api/uploads', methods=['POST'])
+def create_upload_session():
+    """Start a chunked upload: {batchCode, files: [{name, size, sha256?}, ...]} in subject order"""
+    try:
+        data = request.get_json()
+        if not data or not data.get('batchCode') or not data.get('files'):
+            return jsonify({'error': 'Missing required fields'}), 400
+        
+        files = []
+        for file in data['files']:
+            filename = secure_filename(file.get('name', ''))
+            if not allowed_file(filename):
+                return jsonify({'error': f"File type not allowed: {file.get('name')}"}), 400
+            files.append((filename, int(file.get('size', 0)), file.get('sha256')))
+        
+        session = upload_sessions.create(data['batchCode'], files)
+        return jsonify(session), 201
+    except UploadError as e:
+        return jsonify({'error': str(e), **e.details}), e.status
+    except Exception as e:
+        logger.error(f"Upload session error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def get_upload_session(upload_id):
+    """Offsets to resume each file from"""
+    status = upload_sessions.status(upload_id)
+    if status is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify(status)
+
+@app.route('/api/uploads/<upload_id>/files/<int:position>', methods=['PUT'])
+def put_upload_chunk(upload_id, position):
+    """Write the request body at ?offset=N; X-Chunk-Checksum carries its SHA-256"""
+    try:
+        offset = request.args.get('offset', type=int)
+        if offset is None or request.content_length is None:
+            return jsonify({'error': 'offset and Content-Length are required'}), 400
+        
+        # Streamed straight into the spool file, never buffered whole
+        state = upload_sessions.write_chunk(upload_id, position, offset, request.stream,
+                                            request.content_length, request.headers.get('X-Chunk-Checksum'))
+        return jsonify(state)
+    except UploadError as e:
+        return jsonify({'error': str(e), **e.details}), e.status
+    except Exception as e:
+        logger.error(f"Upload chunk error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_upload_session(upload_id):
+    try:
+        session = upload_sessions.finalize(upload_id)
+        return jsonify({**session, 'statusUrl': f"/api/jobs/{session['jobId']}"}), 202
+    except UploadError as e:
+        return jsonify({'error': str(e), **e.details}), e.status
+    except Exception as e:
+        logger.error(f"Upload finalize error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    try:
+        status = job_queue.job_status(job_id, uploading=upload_sessions.awaiting(job_id=job_id))
+        if status is None:
+            return jsonify({'error': 'Job not found'}), 404
+        return jsonify(status)
+    except Exception as e:
+        logger.error(f"Error fetching job {job_id}: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/processing-status/<batch_code>', methods=['GET'])
+def get_processing_status(batch_code):
+    try:
+        status = job_queue.batch_status(batch_code, uploading=upload_sessions.awaiting(batch_code=batch_code))
+        if status is None:
+            return jsonify({'error': 'Batch not found'}), 404
+        return jsonify(status)
+    except Exception as e:
+        logger.error(f"Error fetching processing status: {e}")
+        return jsonify({'error': str(e)}), 500
+
+def archived_sheet(sheet_id):
+    """(sheet row, SheetCrops) of a stored sheet, or (None, error response)"""
+    try:
+        uuid.UUID(sheet_id)
+    except ValueError:
+        return None, (jsonify({'error': 'Sheet not found'}), 404)
+    
+    with db_pool.connection() as conn:
+        if not conn:
+            return None, (jsonify({'error': 'Database connection failed'}), 500)
+        sheet = omr_store.fetch_sheet(conn, sheet_id)
+    if sheet is None:
+        return None, (jsonify({'error': 'Sheet not found'}), 404)
+    
+    # Sliced straight out of the batch's mapped archive; no scan is decoded
+    crops = CropArchive(sheet['batch_id']).get(sheet['sheet_key'])
+    if crops is None:
+        return None, (jsonify({'error': 'No bubble crops archived for this sheet'}), 404)
+    return sheet, crops
+
+@app.route('/api/review/sheets/<sheet_id>', methods=['GET'])
+def review_sheet(sheet_id):
+    """Re-score a sheet from its archived bubble crops, optionally at another fill threshold"""
+    try:
+        sheet, crops = archived_sheet(sheet_id)
+        if sheet is None:
+            return crops
+        
+        threshold = request.args.get('threshold', type=float)
+        ratings, confidences, fallback = crops.ratings(threshold)
+        fills = crops.fill_ratios()
+        stored = sheet['responses'] or []
+        
+        questions = []
+        for i, (rating, confidence) in enumerate(zip(ratings.tolist(), confidences.tolist())):
+            count = int(crops.options_per_question[i])
+            questions.append({
+                'question': stored[i]['question'] if i < len(stored) else f'Question {i + 1}',
+                'rating': rating,
+                'confidence': confidence,
+                'percentage': (rating / count) * 100,
+                'storedRating': stored[i]['rating'] if i < len(stored) else None,
+                'fills': [round(f, 4) for f in fills[crops.question_idx == i].tolist()]
+            })
+        
+        return jsonify({
+            'sheetId': str(sheet['id']),
+            'batchCode': sheet['batch_code'],
+            'studentId': sheet['student_id'],
+            'page': sheet['page'],
+            'threshold': threshold,
+            'ratings': questions,
+            'overallScore': sum(q['rating'] for q in questions) / len(questions) if questions else None,
+            'fallbackRatings': int(fallback.sum()),
+            'changed': sum(1 for q in questions if q['storedRating'] is not None and q['storedRating'] != q['rating'])
+        })
+    except Exception as e:
+        logger.error(f"Error re-scoring sheet {sheet_id}: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/review/sheets/<sheet_id>/crops', methods=['GET'])
+def review_crops(sheet_id):
+    """PNG of a sheet's archived bubble crops, one row per question or ?question=<index> only"""
+    try:
+        sheet, crops = archived_sheet(sheet_id)
+        if sheet is None:
+            return crops
+        
+        question = request.args.get('question', type=int)
+        if question is not None and not 0 <= question < len(crops.options_per_question):
+            return jsonify({'error': 'Question out of range'}), 400
+        
+        import cv2
+        ok, png = cv2.imencode('.png', crops.mosaic(question))
+        if not ok:
+            return jsonify({'error': 'Could not encode crops'}), 500
+        return Response(png.tobytes(), mimetype='image/png')
+    except Exception as e:
+        logger.error(f"Error serving crops of sheet {sheet_id}: {e}")
+        return jsonify({'error': str(e)}), 500
+
+def preload_imaging():
+    """Import the imaging stack before the first upload needs it
+
+    The app starts without OpenCV, numpy or pdf2image so read-only processes never
+    load them; serving processes warm up here instead of on the first upload.
+    """
+    start = time.perf_counter()
+    sheet_pool.processor.warm_up()
+    logger.info(f"Imaging stack loaded in {time.perf_counter() - start:.2f}s")
+
+def preload_templates():
+    """Compile the active templates before forking, so every worker shares them
+
+    Uses its own connection rather than db_pool, whose connections must not cross a fork.
+    """
+    import psycopg2
+    try:
+        conn = psycopg2.connect(**db_config('omrscan'))
+    except Exception as e:
+        logger.warning(f"Templates not preloaded: {e}")
+        return
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM omr_templates WHERE is_active ORDER BY created_at DESC LIMIT %s",
+                       (template_cache.maxsize,))
+        template_ids = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+        for template_id in template_ids:
+            # The bubble grid is compiled on first use, so build it here
+            sheet_pool.processor_for(template_cache.from_db(conn, template_id)).template.grid
+        logger.info(f"Preloaded {len(template_ids)} templates")
+    except Exception as e:
+        logger.warning(f"Templates not preloaded: {e}")
+    finally:
+        conn.close()
+
+def start_background():
+    """Start this process's sheet pool and job queue threads (called after fork in production)"""
+    sheet_pool.start()
+    job_queue.start(requeue=False)
+
 if __name__ == '__main__':
+    # Only the serving process starts workers, not the debug reloader's parent
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        sheet_pool.start()
+        job_queue.start()
+        if PRELOAD_IMAGING:
+            threading.Thread(target=preload_imaging, name='omr-preload', daemon=True).start()
     app.run(host='0.0.0.0', port=5001, debug=True)
\ No newline at end of file
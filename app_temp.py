@@ -6,6 +6,7 @@ from flask_cors import CORS
 from psycopg2.extras import RealDictCursor
 from datetime import datetime
 from dotenv import load_dotenv
+from db_pool import DatabasePool, db_config
 
 # Load environment variables
 load_dotenv()
@@ -17,41 +18,27 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 CORS(app)
 
-# Database connection
-def get_db_connection():
-    try:
-        import psycopg2
-        conn = psycopg2.connect(
-            host=os.getenv('PGHOST'),
-            database=os.getenv('PGDATABASE'),
-            user=os.getenv('PGUSER'),
-            password=os.getenv('PGPASSWORD'),
-            port=os.getenv('PGPORT')
-        )
-        return conn
-    except Exception as e:
-        logger.error(f"Database connection error: {e}")
-        return None
+# Database connection pool, shared by all routes
+db_pool = DatabasePool(db_config('omrscan'))
 
 @app.route('/api/results/<batch_code>', methods=['GET'])
 def get_results(batch_code):
     try:
         logger.info(f"Fetching results for batch code: {batch_code}")
-        conn = get_db_connection()
-        if not conn:
-            logger.error("Database connection failed")
-            return jsonify({'error': 'Database connection failed'}), 500
+        with db_pool.connection() as conn:
+            if not conn:
+                logger.error("Database connection failed")
+                return jsonify({'error': 'Database connection failed'}), 500
 
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute("""
-            SELECT batch_code, phase, total_students, subjects, created_at
-            FROM omr_results 
-            WHERE batch_code = %s
-        """, (batch_code,))
-        
-        result = cursor.fetchone()
-        cursor.close()
-        conn.close()
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            cursor.execute("""
+                SELECT batch_code, phase, total_students, subjects, created_at
+                FROM omr_results 
+                WHERE batch_code = %s
+            """, (batch_code,))
+            
+            result = cursor.fetchone()
+            cursor.close()
         
         if not result:
             return jsonify({'error': 'Batch not found'}), 404
@@ -70,9 +57,9 @@ def get_results(batch_code):
 @app.route('/api/health', methods=['GET'])
 def health_check():
     try:
-        conn = get_db_connection()
-        if conn:
-            conn.close()
+        with db_pool.connection() as conn:
+            connected = conn is not None
+        if connected:
             return jsonify({
                 'status': 'healthy',
                 'database': 'connected',
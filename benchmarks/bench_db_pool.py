@@ -0,0 +1,75 @@
+"""Compare request latency with a fresh connection per request against the pool.
+
+Needs a reachable PostgreSQL configured through the PG* environment variables.
+Run from the repository root:
+    python -m benchmarks.bench_db_pool --requests 500 --threads 8
+"""
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from db_pool import DatabasePool, db_config
+
+
+def unpooled_request(config):
+    conn = psycopg2.connect(**config)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+    finally:
+        conn.close()
+
+
+def pooled_request(pool):
+    with pool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+
+
+def measure(fn, requests, threads):
+    def timed(_):
+        start = time.perf_counter()
+        fn()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        latencies = sorted(executor.map(timed, range(requests)))
+    elapsed = time.perf_counter() - start
+    return {
+        'p50_ms': statistics.median(latencies) * 1e3,
+        'p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1e3,
+        'requests_per_s': requests / elapsed
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--database', default='omrscan')
+    args = parser.parse_args()
+
+    config = db_config(args.database)
+    pool = DatabasePool(config, maxconn=args.threads)
+    pooled_request(pool)  # Open the pool before timing
+
+    for name, fn in (('connect per request', lambda: unpooled_request(config)),
+                     ('pooled', lambda: pooled_request(pool))):
+        stats = measure(fn, args.requests, args.threads)
+        print(f"{name:20s} p50 {stats['p50_ms']:7.2f} ms  p99 {stats['p99_ms']:7.2f} ms  "
+              f"{stats['requests_per_s']:8.1f} req/s")
+
+    print(f"pool stats: {pool.stats()}")
+    pool.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""Compare the compiled bubble grid against the original per-ROI loop.
+
+Run from the repository root:
+    python -m benchmarks.bench_detect --questions 100 --options 5
+    python -m benchmarks.bench_detect --batch 32
+"""
+import argparse
+import time
+import cv2
+import numpy as np
+
+from omr_engine import compile_bubble_grid
+from omr_processor import OMRProcessor
+from omr_templates import OMRTemplate
+
+
+def legacy_detect(processed_image, regions):
+    """Original per-ROI countNonZero loop from OMRProcessor.detect_filled_circles"""
+    results = []
+    for i, question_regions in enumerate(regions):
+        question_results = []
+        for j, (x, y, w, h) in enumerate(question_regions):
+            roi = processed_image[y:y+h, x:x+w]
+            if roi.size == 0:
+                question_results.append(0)
+                continue
+            fill_percentage = cv2.countNonZero(roi) / roi.size
+            question_results.append({
+                'option': j + 1,
+                'is_marked': fill_percentage > 0.3,
+                'confidence': min(fill_percentage * 2, 1.0),
+                'fill_percentage': fill_percentage
+            })
+        results.append(question_results)
+    return results
+
+
+def make_layout(questions, options, size=25, pitch=40):
+    """Dense grid of bubbles laid out in rows like the default template"""
+    return [[(100 + j * pitch, 150 + i * (size + 10), size, size) for j in range(options)]
+            for i in range(questions)]
+
+
+def make_sheet(regions, seed=0):
+    """Random thresholded sheet with one marked bubble per question"""
+    rng = np.random.default_rng(seed)
+    height = max(y + h for q in regions for (_, y, _, h) in q) + 100
+    width = max(x + w for q in regions for (x, _, w, _) in q) + 100
+    sheet = np.where(rng.random((height, width)) < 0.05, 255, 0).astype(np.uint8)
+    for question in regions:
+        x, y, w, h = question[rng.integers(len(question))]
+        sheet[y:y+h, x:x+w] = np.where(rng.random((h, w)) < 0.8, 255, 0)
+    return sheet
+
+
+def time_it(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--questions', type=int, default=100)
+    parser.add_argument('--options', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--batch', type=int, default=16, help='sheets stacked for the batched reduction')
+    args = parser.parse_args()
+
+    regions = make_layout(args.questions, args.options)
+    sheet = make_sheet(regions)
+    grid = compile_bubble_grid(regions)
+    bubbles = len(grid)
+
+    assert grid.score(sheet) == legacy_detect(sheet, regions), "results differ from legacy loop"
+
+    legacy = time_it(lambda: legacy_detect(sheet, regions), args.repeat)
+    compiled = time_it(lambda: grid.score(sheet), args.repeat)
+    ratios_only = time_it(lambda: grid.fill_ratios(sheet), args.repeat)
+
+    print(f"bubbles per sheet: {bubbles}")
+    print(f"legacy loop:       {legacy * 1e6 / bubbles:8.3f} us/bubble  {legacy * 1e3:8.3f} ms/sheet")
+    print(f"compiled grid:     {compiled * 1e6 / bubbles:8.3f} us/bubble  {compiled * 1e3:8.3f} ms/sheet")
+    print(f"fill ratios only:  {ratios_only * 1e6 / bubbles:8.3f} us/bubble  {ratios_only * 1e3:8.3f} ms/sheet")
+    print(f"speedup:           {legacy / compiled:8.2f}x (scoring), {legacy / ratios_only:.2f}x (ratios)")
+
+    # Stacked strips of several sheets scored and rated together, as OMRProcessor.process_batch does
+    sheets = [make_sheet(regions, seed) for seed in range(args.batch)]
+    y0, y1, x0, x1 = grid.strip(sheet.shape)
+    stack = np.stack([s[y0:y1, x0:x1] for s in sheets])
+    expected = np.stack([grid.fill_ratios(s)[0] for s in sheets])
+    assert np.allclose(grid.fill_ratios_batch(stack, sheet.shape), expected), "batched ratios differ"
+
+    configuration = {'questions': [{'text': f'Q{i + 1}', 'options': [list(box) for box in question]}
+                                   for i, question in enumerate(regions)]}
+    processor = OMRProcessor(OMRTemplate(configuration, 'bench'))
+    grid = processor.template.grid
+    expected = [processor.calculate_ratings(grid.score(s)) for s in sheets]
+    assert processor.calculate_ratings_batch(*grid.score_batch(stack, sheet.shape))[0] == expected, \
+        "batched ratings differ"
+
+    repeat = max(1, args.repeat // args.batch)
+    per_sheet = time_it(lambda: [processor.calculate_ratings(grid.score(s)) for s in sheets], repeat)
+    batched = time_it(lambda: processor.calculate_ratings_batch(*grid.score_batch(stack, sheet.shape)), repeat)
+    pixels = time_it(lambda: grid.fill_ratios_batch(stack, sheet.shape), repeat)
+    print(f"per-sheet rating:  {per_sheet * 1e3 / args.batch:8.3f} ms/sheet  (score + calculate_ratings)")
+    print(f"batched rating:    {batched * 1e3 / args.batch:8.3f} ms/sheet  ({per_sheet / batched:.2f}x over "
+          f"{args.batch} sheets, {pixels * 1e3 / args.batch:.3f} ms/sheet of it in the pixel reduction)")
+
+if __name__ == '__main__':
+    main()
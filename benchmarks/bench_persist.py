@@ -0,0 +1,96 @@
+"""Compare per-row INSERTs against the bulk SheetWriter for a large batch.
+
+Needs a reachable PostgreSQL set up with setup_db.py (PG* environment variables).
+Run from the repository root:
+    python -m benchmarks.bench_persist --sheets 2000 --flush-size 500
+"""
+import argparse
+import json
+import time
+import uuid
+import psycopg2
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import omr_store
+from db_pool import db_config
+
+QUESTIONS = ["Course Content Quality", "Teaching Effectiveness", "Learning Materials",
+             "Assessment Methods", "Overall Satisfaction"]
+
+
+def make_results(sheets):
+    """One processor result per sheet, shaped like OMRProcessor.process_image_array output"""
+    results = []
+    for n in range(sheets):
+        ratings = [{'question': q, 'rating': 1 + (n + i) % 5, 'confidence': 0.9,
+                    'percentage': (1 + (n + i) % 5) * 20} for i, q in enumerate(QUESTIONS)]
+        results.append({'success': True, 'ratings': ratings, 'confidence': 0.9,
+                        'overall_score': sum(r['rating'] for r in ratings) / len(ratings)})
+    return results
+
+
+def per_row(conn, batch_id, results):
+    """The single-row cursor.execute pattern the routes used before the bulk writer"""
+    cursor = conn.cursor()
+    for n, result in enumerate(results):
+        key = f'0:sheet-{n}'
+        cursor.execute("""
+            INSERT INTO omr_sheets (batch_id, sheet_key, subject_position, student_id, file_name, file_path,
+                                    status, overall_score, confidence, responses, metadata, processed_at)
+            VALUES (%s, %s, 0, %s, %s, %s, 'processed', %s, %s, %s, '{}', CURRENT_TIMESTAMP)
+            RETURNING id
+        """, (batch_id, key, key, key, key, result['overall_score'], result['confidence'],
+              json.dumps(result['ratings'])))
+        sheet_id = cursor.fetchone()[0]
+        for question, rating in enumerate(result['ratings']):
+            cursor.execute("""
+                INSERT INTO sheet_responses (sheet_id, batch_id, subject_position, question,
+                                             question_text, rating, confidence)
+                VALUES (%s, %s, 0, %s, %s, %s, %s)
+            """, (sheet_id, batch_id, question, rating['question'], rating['rating'], rating['confidence']))
+    conn.commit()
+    cursor.close()
+
+
+def bulk(conn, batch_id, results, flush_size):
+    with omr_store.SheetWriter(conn, flush_size) as writer:
+        for n, result in enumerate(results):
+            writer.add(batch_id, 0, f'sheet-{n}', result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sheets', type=int, default=2000)
+    parser.add_argument('--flush-size', type=int, default=500)
+    parser.add_argument('--database', default='omrscan')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**db_config(args.database))
+    results = make_results(args.sheets)
+    rows = args.sheets * (1 + len(QUESTIONS))
+
+    for name, write in (('per-row execute', lambda b: per_row(conn, b, results)),
+                        ('bulk execute_values', lambda b: bulk(conn, b, results, args.flush_size))):
+        batch = omr_store.upsert_batch(conn, f'bench-{uuid.uuid4().hex[:8]}', 'bench', args.sheets, [('Bench', 'Bench')])
+        conn.commit()
+        start = time.perf_counter()
+        write(batch['id'])
+        elapsed = time.perf_counter() - start
+        print(f"{name:22s} {elapsed:7.3f} s  {rows / elapsed:10.0f} rows/s")
+
+        # Remove the scratch batch
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM sheet_responses WHERE batch_id = %s", (batch['id'],))
+        cursor.execute("DELETE FROM omr_sheets WHERE batch_id = %s", (batch['id'],))
+        cursor.execute("DELETE FROM batch_subjects WHERE batch_id = %s", (batch['id'],))
+        cursor.execute("DELETE FROM batches WHERE id = %s", (batch['id'],))
+        conn.commit()
+        cursor.close()
+
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+"""Measure every stage of sheet processing on synthetic sheets and write the results as JSON.
+
+Stages: decode, rasterize (PDF, needs poppler), align, preprocess, detect, rate and
+persist (needs PostgreSQL, skipped otherwise). Each stage reports sheets per second,
+p50/p99 latency and its peak allocation; accuracy is checked against the marks
+drawn on each sheet.
+
+Run from the repository root:
+    python -m benchmarks.bench_pipeline --sheets 100 --questions 50 --output after.json
+    python -m benchmarks.bench_pipeline --sheets 100 --questions 50 --baseline before.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timezone
+import cv2
+import numpy as np
+
+from benchmarks import synthetic
+from omr_processor import OMRProcessor
+
+STAGES = ('decode', 'rasterize', 'align', 'preprocess', 'detect', 'rate', 'persist')
+
+
+def summarize(samples, sheets=None):
+    """Throughput and latency percentiles for a list of per-call seconds"""
+    if not samples:
+        return None
+    samples = np.asarray(samples)
+    total = float(samples.sum())
+    return {
+        'samples': len(samples),
+        'sheets_per_second': (sheets or len(samples)) / total if total else None,
+        'mean_ms': float(samples.mean() * 1e3),
+        'p50_ms': float(np.percentile(samples, 50) * 1e3),
+        'p99_ms': float(np.percentile(samples, 99) * 1e3)
+    }
+
+
+def peak_allocation(fn):
+    """Peak bytes allocated while fn runs, numpy and OpenCV buffers included"""
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def peak_rss():
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class Timer:
+    def __init__(self):
+        self.samples = {stage: [] for stage in STAGES}
+
+    def run(self, stage, fn, *args):
+        start = time.perf_counter()
+        value = fn(*args)
+        self.samples[stage].append(time.perf_counter() - start)
+        return value
+
+
+def process_sheets(processor, encoded, marks, timer):
+    """Run the image stages one by one, returning (results, correct answers, fallback ratings)"""
+    results, correct, fallbacks = [], 0, 0
+    for data, truth in zip(encoded, marks):
+        image = timer.run('decode', cv2.imdecode, np.frombuffer(data, dtype=np.uint8), processor.decode_flags)
+        grid, _ = timer.run('align', processor.grid_for, image, 'bench', processor.reduction)
+        binary = timer.run('preprocess', processor.preprocess_image, image, grid)
+        detection = timer.run('detect', grid.score, binary)
+        ratings = timer.run('rate', processor.calculate_ratings, detection)
+
+        correct += sum(r['rating'] == mark for r, mark in zip(ratings, truth))
+        fallbacks += sum(not any(d and d['is_marked'] for d in question) for question in detection)
+        results.append(processor._sheet_result(detection))
+    return results, correct, fallbacks
+
+
+def rasterize(processor, images, dpi, timer):
+    """Time rasterizing a multi-page PDF of the sheets, page by page"""
+    handle, path = tempfile.mkstemp(suffix='.pdf')
+    os.close(handle)
+    try:
+        synthetic.write_pdf(images, path, dpi)
+        pages = processor.iter_pdf_pages(path)
+        while True:
+            start = time.perf_counter()
+            page = next(pages, None)
+            if page is None:
+                break
+            timer.samples['rasterize'].append(time.perf_counter() - start)
+    finally:
+        os.remove(path)
+
+
+def persist(results, database, flush_size, timer):
+    """Time bulk-writing the results into a scratch batch, one sample per flush"""
+    import psycopg2
+    import omr_store
+    from db_pool import db_config
+
+    conn = psycopg2.connect(**db_config(database))
+    batch = omr_store.upsert_batch(conn, f'bench-{uuid.uuid4().hex[:8]}', 'bench', len(results), [('Bench', 'Bench')])
+    conn.commit()
+    try:
+        # Flushed here rather than by the writer so every flush is timed
+        writer = omr_store.SheetWriter(conn, len(results) + 1)
+        for n, result in enumerate(results, start=1):
+            writer.add(batch['id'], 0, f'sheet-{n}', result)
+            if n % flush_size == 0 or n == len(results):
+                timer.run('persist', writer.flush)
+    finally:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM sheet_responses WHERE batch_id = %s", (batch['id'],))
+        cursor.execute("DELETE FROM omr_sheets WHERE batch_id = %s", (batch['id'],))
+        cursor.execute("DELETE FROM batch_subjects WHERE batch_id = %s", (batch['id'],))
+        cursor.execute("DELETE FROM batches WHERE id = %s", (batch['id'],))
+        conn.commit()
+        cursor.close()
+        conn.close()
+
+
+def memory_pass(processor, data):
+    """Peak allocation of each image stage on one sheet"""
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), processor.decode_flags)
+    grid, _ = processor.grid_for(image, 'bench-memory', processor.reduction)
+    binary = processor.preprocess_image(image, grid)
+    detection = grid.score(binary)
+    return {
+        'decode': peak_allocation(lambda: cv2.imdecode(np.frombuffer(data, dtype=np.uint8), processor.decode_flags)),
+        'align': peak_allocation(lambda: processor.grid_for(image, 'bench-memory', processor.reduction)),
+        'preprocess': peak_allocation(lambda: processor.preprocess_image(image, grid)),
+        'detect': peak_allocation(lambda: grid.score(binary)),
+        'rate': peak_allocation(lambda: processor.calculate_ratings(detection))
+    }
+
+
+def compare(report, baseline):
+    """Print throughput of this run relative to a baseline report"""
+    print(f"\nagainst {baseline['created_at']}:")
+    for stage in STAGES:
+        new, old = report['stages'].get(stage), baseline['stages'].get(stage)
+        if new and old and new['sheets_per_second'] and old['sheets_per_second']:
+            ratio = new['sheets_per_second'] / old['sheets_per_second']
+            print(f"  {stage:10s} {ratio:6.2f}x throughput, p99 {old['p99_ms']:8.2f} -> {new['p99_ms']:8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sheets', type=int, default=50)
+    parser.add_argument('--questions', type=int, default=0, help='0 uses the built-in 5-question template')
+    parser.add_argument('--options', type=int, default=5)
+    parser.add_argument('--dpi', type=int, default=synthetic.PDF_DPI)
+    parser.add_argument('--skew', type=float, default=0.0, help='maximum rotation in degrees')
+    parser.add_argument('--noise', type=float, default=8.0, help='pixel noise standard deviation')
+    parser.add_argument('--format', choices=('png', 'jpeg'), default='png')
+    parser.add_argument('--fiducials', action='store_true', help='add registration marks and align sheets')
+    parser.add_argument('--decode-mode', default='color')
+    parser.add_argument('--pdf-pages', type=int, default=10, help='pages rasterized; 0 skips the PDF stage')
+    parser.add_argument('--database', help='PostgreSQL database for the persist stage')
+    parser.add_argument('--flush-size', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--baseline', help='earlier JSON report to compare against')
+    args = parser.parse_args()
+
+    template = synthetic.make_template(args.questions, args.options, args.fiducials)
+    processor = OMRProcessor(template, decode_mode=args.decode_mode)
+    rng = np.random.default_rng(args.seed)
+
+    marks, images, encoded = [], [], []
+    for n in range(args.sheets):
+        truth = synthetic.random_marks(template, rng)
+        skew = float(rng.uniform(-args.skew, args.skew)) if args.skew else 0.0
+        image = synthetic.make_sheet(template, truth, args.dpi, skew, args.noise, seed=args.seed + n)
+        marks.append(truth)
+        encoded.append(synthetic.encode(image, args.format))
+        if n < args.pdf_pages:
+            images.append(image)
+
+    timer = Timer()
+    skipped = {}
+    start = time.perf_counter()
+    results, correct, fallbacks = process_sheets(processor, encoded, marks, timer)
+    elapsed = time.perf_counter() - start
+
+    if images:
+        try:
+            rasterize(processor, images, args.dpi, timer)
+        except Exception as e:
+            skipped['rasterize'] = str(e)
+    else:
+        skipped['rasterize'] = 'disabled with --pdf-pages 0'
+
+    if args.database:
+        try:
+            persist(results, args.database, args.flush_size, timer)
+        except Exception as e:
+            skipped['persist'] = str(e)
+    else:
+        skipped['persist'] = 'no --database given'
+
+    memory = memory_pass(processor, encoded[0])
+    stages = {}
+    for stage in STAGES:
+        sheets = len(results) if stage == 'persist' else None
+        summary = summarize(timer.samples[stage], sheets)
+        if summary is None:
+            continue
+        summary['peak_alloc_bytes'] = memory.get(stage)
+        stages[stage] = summary
+
+    questions = len(results) * len(template.question_regions)
+    report = {
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'config': vars(args),
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count()
+        },
+        'sheet_bytes': int(np.mean([len(data) for data in encoded])),
+        'bubbles_per_sheet': len(template.grid),
+        'pipeline': {'sheets': len(results), 'seconds': elapsed, 'sheets_per_second': len(results) / elapsed},
+        'stages': stages,
+        'skipped': skipped,
+        'accuracy': {
+            'questions': questions,
+            'correct': correct,
+            'rate': correct / questions if questions else None,
+            'fallback_ratings': fallbacks
+        },
+        'peak_rss_bytes': peak_rss()
+    }
+
+    for stage, summary in stages.items():
+        print(f"{stage:10s} {summary['sheets_per_second']:10.1f} sheets/s  p50 {summary['p50_ms']:8.2f} ms  "
+              f"p99 {summary['p99_ms']:8.2f} ms", file=sys.stderr)
+    for stage, reason in skipped.items():
+        print(f"{stage:10s} skipped: {reason}", file=sys.stderr)
+    print(f"accuracy   {report['accuracy']['rate']:.4f} ({fallbacks} fallback ratings), "
+          f"pipeline {report['pipeline']['sheets_per_second']:.1f} sheets/s", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
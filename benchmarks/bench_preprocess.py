@@ -0,0 +1,86 @@
+"""Compare full-page preprocessing against thresholding only the bubble rows.
+
+Run from the repository root:
+    python -m benchmarks.bench_preprocess --questions 50 --options 5
+"""
+import argparse
+import time
+import cv2
+import numpy as np
+
+from omr_processor import OMRProcessor
+from omr_templates import OMRTemplate
+
+# A4 at 300 DPI
+PAGE_WIDTH, PAGE_HEIGHT = 2480, 3508
+
+
+def make_template(questions, options):
+    """Rows of bubbles spread down an A4 page at scan resolution"""
+    pitch = min(60, (PAGE_HEIGHT - 600) // max(1, questions))
+    return OMRTemplate({
+        'questions': [f'Question {i + 1}' for i in range(questions)],
+        'layout': {'origin': [900, 400], 'bubble': [40, 40], 'optionPitch': 80,
+                   'questionPitch': pitch, 'options': options}
+    }, 'bench', '1')
+
+
+def make_page(template, seed=0):
+    """Noisy scanned page with one filled bubble per question"""
+    rng = np.random.default_rng(seed)
+    page = rng.integers(215, 255, (PAGE_HEIGHT, PAGE_WIDTH, 3), dtype=np.uint8)
+    for question in template.question_regions:
+        for x, y, w, h in question:
+            cv2.rectangle(page, (x, y), (x + w, y + h), (60, 60, 60), 2)
+        x, y, w, h = question[rng.integers(len(question))]
+        cv2.rectangle(page, (x + 6, y + 6), (x + w - 6, y + h - 6), (30, 30, 30), -1)
+    return page
+
+
+def time_it(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--questions', type=int, default=50)
+    parser.add_argument('--options', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    template = make_template(args.questions, args.options)
+    page = make_page(template)
+    ok, encoded = cv2.imencode('.jpg', page, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    encoded = encoded.tobytes()
+
+    full = OMRProcessor(template, roi=False)
+    roi = OMRProcessor(template, roi=True)
+    regions = template.question_regions
+
+    assert roi.detect_filled_circles(page, regions) == full.detect_filled_circles(page, regions), \
+        "ROI results differ from the full page"
+
+    full_time = time_it(lambda: full.detect_filled_circles(page, regions), args.repeat)
+    roi_time = time_it(lambda: roi.detect_filled_circles(page, regions), args.repeat)
+
+    print(f"page: {PAGE_WIDTH}x{PAGE_HEIGHT}, bubbles per sheet: {len(template.grid)}")
+    print(f"full page preprocess + score:  {full_time * 1e3:8.2f} ms/sheet")
+    print(f"bubble rows preprocess + score:{roi_time * 1e3:8.2f} ms/sheet")
+    print(f"speedup:                       {full_time / roi_time:8.2f}x")
+
+    # Decoding from the encoded upload, end to end
+    for mode in ('color', 'gray', 'reduced2'):
+        processor = OMRProcessor(template, decode_mode=mode)
+        elapsed = time_it(lambda: processor.process_image_buffer(encoded), args.repeat)
+        ratings = [r['rating'] for r in processor.process_image_buffer(encoded)['ratings']]
+        baseline = [r['rating'] for r in full.process_image_buffer(encoded)['ratings']]
+        matches = sum(a == b for a, b in zip(ratings, baseline))
+        print(f"decode {mode:8s} + process:     {elapsed * 1e3:8.2f} ms/sheet  "
+              f"({matches}/{len(baseline)} ratings match full page)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Measure how long importing the Flask app takes, and check that it stays free of the imaging stack.
+
+Runs `python -X importtime -c "import app"` in a fresh interpreter and reports the
+total import time and the slowest modules. Exits non-zero if a heavy module
+(OpenCV, numpy, Pillow, pdf2image) is loaded at startup or the budget is exceeded.
+
+Run from the repository root:
+    python -m benchmarks.bench_startup
+    python -m benchmarks.bench_startup --module omr_watch --budget-ms 400 --runs 5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Loaded on first upload or by preload_imaging, never by `import app`
+HEAVY_MODULES = ('cv2', 'numpy', 'PIL', 'pdf2image')
+
+
+def import_times(module):
+    """{module: (self us, cumulative us)} from one -X importtime run"""
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                               capture_output=True, text=True, env=env, check=True)
+    times = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--module', default='app')
+    parser.add_argument('--runs', type=int, default=3, help='the median run is reported')
+    parser.add_argument('--budget-ms', type=float, default=0, help='fail above this total; 0 disables')
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--output', help='write the JSON report here')
+    args = parser.parse_args()
+
+    runs = sorted((import_times(args.module) for _ in range(max(1, args.runs))),
+                  key=lambda run: run[args.module][1])
+    totals = [run[args.module][1] / 1e3 for run in runs]
+    times = runs[len(runs) // 2]
+    median = totals[len(runs) // 2]
+
+    heavy = sorted(name for name in times if name in HEAVY_MODULES)
+    slowest = sorted(times.items(), key=lambda item: item[1][0], reverse=True)[:args.top]
+
+    print(f"import {args.module}: median {median:.1f} ms over {len(totals)} runs "
+          f"(min {min(totals):.1f}, max {max(totals):.1f})")
+    for name, (self_us, cumulative_us) in slowest:
+        print(f"  {self_us / 1e3:8.2f} ms self {cumulative_us / 1e3:9.2f} ms total  {name}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'module': args.module, 'runs_ms': totals, 'median_ms': median, 'heavy_modules': heavy,
+                       'modules': {name: {'self_us': s, 'cumulative_us': c} for name, (s, c) in times.items()}},
+                      f, indent=2)
+
+    failed = False
+    if heavy:
+        print(f"FAIL: import {args.module} loads {', '.join(heavy)}", file=sys.stderr)
+        failed = True
+    if args.budget_ms and median > args.budget_ms:
+        print(f"FAIL: {median:.1f} ms is over the {args.budget_ms:.0f} ms budget", file=sys.stderr)
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Synthetic filled OMR sheets rendered from an OMRProcessor template.
+
+Template coordinates are pixels at PDF_DPI; sheets can be rendered at any DPI,
+with skew and scanner noise, and written as PNG/JPEG or a multi-page PDF.
+"""
+import cv2
+import numpy as np
+from PIL import Image
+
+from omr_processor import PDF_DPI
+from omr_templates import OMRTemplate, DEFAULT_CONFIGURATION
+
+# A4 at PDF_DPI
+PAGE_WIDTH, PAGE_HEIGHT = round(8.27 * PDF_DPI), round(11.69 * PDF_DPI)
+FIDUCIAL_SIZE = 30
+FIDUCIAL_MARGIN = 60
+
+
+def calibration_points():
+    """Registration marks near the page corners, as template calibrationPoints"""
+    left, top = FIDUCIAL_MARGIN, FIDUCIAL_MARGIN
+    right, bottom = PAGE_WIDTH - FIDUCIAL_MARGIN, PAGE_HEIGHT - FIDUCIAL_MARGIN
+    return {
+        'topLeft': {'x': left, 'y': top},
+        'topRight': {'x': right, 'y': top},
+        'bottomLeft': {'x': left, 'y': bottom},
+        'bottomRight': {'x': right, 'y': bottom}
+    }
+
+
+def make_template(questions=0, options=5, fiducials=False):
+    """The built-in template, or a generated layout of the given size
+
+    With fiducials the template gets calibration points so sheets are aligned.
+    """
+    if questions:
+        pitch = min(50, (PAGE_HEIGHT - 300) // questions)
+        configuration = {
+            'questions': [f'Question {i + 1}' for i in range(questions)],
+            'layout': {'origin': [300, 150], 'bubble': [min(25, pitch - 4)] * 2, 'optionPitch': 40,
+                       'questionPitch': pitch, 'options': options}
+        }
+    else:
+        configuration = dict(DEFAULT_CONFIGURATION)
+
+    if fiducials:
+        configuration['calibrationPoints'] = calibration_points()
+        configuration['fiducialSize'] = FIDUCIAL_SIZE
+    return OMRTemplate(configuration, f'synthetic-{questions}x{options}', '1')
+
+
+def random_marks(template, rng):
+    """One 1-based option per question"""
+    return [int(rng.integers(len(question))) + 1 for question in template.question_regions]
+
+
+def make_sheet(template, marks, dpi=PDF_DPI, skew=0.0, noise=0.0, seed=0):
+    """Render a filled sheet as a BGR image
+
+    skew rotates the page by that many degrees about its centre, noise is the
+    standard deviation of Gaussian pixel noise and dpi rescales the page.
+    """
+    rng = np.random.default_rng(seed)
+    page = np.full((PAGE_HEIGHT, PAGE_WIDTH), 255, dtype=np.uint8)
+
+    if template.calibration_points:
+        half = FIDUCIAL_SIZE // 2
+        for x, y in template.calibration_points:
+            cv2.rectangle(page, (int(x) - half, int(y) - half), (int(x) + half, int(y) + half), 0, -1)
+
+    for question, mark in zip(template.question_regions, marks):
+        for x, y, w, h in question:
+            cv2.ellipse(page, (x + w // 2, y + h // 2), (w // 2, h // 2), 0, 0, 360, 90, 1)
+        x, y, w, h = question[mark - 1]
+        cv2.ellipse(page, (x + w // 2, y + h // 2), (w // 2 - 2, h // 2 - 2), 0, 0, 360, 20, -1)
+
+    scale = dpi / PDF_DPI
+    if skew or scale != 1:
+        matrix = cv2.getRotationMatrix2D((PAGE_WIDTH / 2, PAGE_HEIGHT / 2), skew, scale)
+        matrix[:, 2] += ((scale - 1) * PAGE_WIDTH / 2, (scale - 1) * PAGE_HEIGHT / 2)
+        size = (round(PAGE_WIDTH * scale), round(PAGE_HEIGHT * scale))
+        page = cv2.warpAffine(page, matrix, size, flags=cv2.INTER_AREA, borderValue=255)
+
+    if noise:
+        page = np.clip(page + rng.normal(0, noise, page.shape), 0, 255).astype(np.uint8)
+
+    return cv2.cvtColor(page, cv2.COLOR_GRAY2BGR)
+
+
+def encode(image, fmt='png', quality=90):
+    """Encode a sheet the way a scanner upload would arrive"""
+    if fmt in ('jpg', 'jpeg'):
+        ok, data = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    else:
+        ok, data = cv2.imencode('.png', image)
+    if not ok:
+        raise ValueError(f'Could not encode sheet as {fmt}')
+    return data.tobytes()
+
+
+def write_pdf(images, path, dpi=PDF_DPI):
+    """Write sheets as one page each of a PDF"""
+    pages = [Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB)) for image in images]
+    pages[0].save(path, save_all=True, append_images=pages[1:], resolution=dpi)
@@ -0,0 +1,166 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+import psycopg2
+from psycopg2 import pool as pg_pool
+from omr_metrics import DB_CONNECT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))  # Seconds to wait for a free connection
+DB_POOL_IDLE_CHECK = float(os.getenv('DB_POOL_IDLE_CHECK', '30'))  # Ping connections idle longer than this
+
+
+def db_config(default_database):
+    """Connection settings from the PG* environment variables"""
+    return {
+        'host': os.getenv('PGHOST', 'localhost'),
+        'database': os.getenv('PGDATABASE', default_database),
+        'user': os.getenv('PGUSER', 'postgres'),
+        'password': os.getenv('PGPASSWORD', 'root'),
+        'port': os.getenv('PGPORT', '5432')
+    }
+
+
+class DatabasePool:
+    """Lazily created ThreadedConnectionPool that blocks instead of failing when saturated"""
+
+    def __init__(self, config, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX,
+                 timeout=DB_POOL_TIMEOUT, idle_check=DB_POOL_IDLE_CHECK):
+        self.config = config
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.idle_check = idle_check
+        self._pool = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._returned_at = {}
+
+        # Saturation metrics
+        self.in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.timeouts = 0
+        self.health_check_failures = 0
+        self.connect_errors = 0
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                log_config = self.config.copy()
+                log_config.pop('password')
+                logger.info(f"Creating database pool ({self.minconn}-{self.maxconn}) with config: {log_config}")
+                self._pool = pg_pool.ThreadedConnectionPool(self.minconn, self.maxconn, **self.config)
+            return self._pool
+
+    def _healthy(self, conn):
+        """Ping a connection that has been idle long enough to have gone stale"""
+        if conn.closed:
+            return False
+        idle = time.monotonic() - self._returned_at.get(id(conn), time.monotonic())
+        if idle < self.idle_check:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        """Check out a healthy connection, or return None if the database is unreachable"""
+        start = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            self.waits += 1
+            if not self._slots.acquire(timeout=self.timeout):
+                self.timeouts += 1
+                logger.error(f"Timed out waiting {self.timeout}s for a database connection")
+                return None
+            self.wait_seconds += time.monotonic() - start
+
+        try:
+            pool = self._get_pool()
+            conn = pool.getconn()
+            while not self._healthy(conn):
+                self.health_check_failures += 1
+                pool.putconn(conn, close=True)
+                conn = pool.getconn()
+        except psycopg2.Error as e:
+            self.connect_errors += 1
+            self._slots.release()
+            logger.error(f"PostgreSQL Error: {e.diag.message_primary if hasattr(e, 'diag') else str(e)}")
+            return None
+        except Exception as e:
+            self.connect_errors += 1
+            self._slots.release()
+            logger.error(f"Unexpected error in database connection: {str(e)}")
+            return None
+
+        with self._lock:
+            self.in_use += 1
+            self.checkouts += 1
+        DB_CONNECT_SECONDS.observe(time.monotonic() - start)
+        return conn
+
+    def putconn(self, conn, failed=False):
+        """Return a connection, rolling back anything uncommitted"""
+        close = failed or conn.closed
+        if not close:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                close = True
+
+        self._returned_at[id(conn)] = time.monotonic()
+        self._pool.putconn(conn, close=close)
+        if close:
+            self._returned_at.pop(id(conn), None)
+
+        with self._lock:
+            self.in_use -= 1
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Yield a pooled connection (or None if the database is down) and always return it"""
+        conn = self.getconn()
+        if conn is None:
+            yield None
+            return
+
+        failed = False
+        try:
+            yield conn
+        except psycopg2.InterfaceError:
+            failed = True
+            raise
+        finally:
+            self.putconn(conn, failed)
+
+    def stats(self):
+        return {
+            'min': self.minconn,
+            'max': self.maxconn,
+            'inUse': self.in_use,
+            'saturation': self.in_use / self.maxconn if self.maxconn else 0,
+            'checkouts': self.checkouts,
+            'waits': self.waits,
+            'waitSeconds': round(self.wait_seconds, 6),
+            'timeouts': self.timeouts,
+            'healthCheckFailures': self.health_check_failures,
+            'connectErrors': self.connect_errors
+        }
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
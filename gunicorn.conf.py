@@ -0,0 +1,46 @@
+import os
+import multiprocessing
+
+# Configuration
+bind = os.getenv('BIND', '0.0.0.0:5001')
+workers = int(os.getenv('WEB_CONCURRENCY', str(min(4, multiprocessing.cpu_count()))))  # Pre-forked worker processes
+worker_class = 'gthread'
+threads = int(os.getenv('WEB_THREADS', '8'))  # Request threads per worker; see ADMISSION_* for per-route limits
+timeout = int(os.getenv('WEB_TIMEOUT', '180'))  # Seconds before a stuck worker is restarted
+graceful_timeout = 30
+max_requests = int(os.getenv('WEB_MAX_REQUESTS', '2000'))  # Recycle workers to bound memory growth
+max_requests_jitter = max_requests // 10
+
+# Workers share metrics through snapshot files, so /api/metrics covers all of them
+os.environ.setdefault('OMR_METRICS_DIR', os.path.join('uploads', 'metrics'))
+
+# Load app, OpenCV and templates once in the master; see wsgi.py
+preload_app = True
+accesslog = '-'
+
+
+def on_starting(server):
+    # Counts from an earlier run would otherwise be added to this one's
+    from omr_metrics import registry
+    registry.clear()
+
+
+def post_fork(server, worker):
+    # Process pools and threads do not survive fork, so each worker starts its own
+    from app import start_background
+    start_background()
+
+
+def worker_exit(server, worker):
+    from app import job_queue, sheet_pool
+    job_queue.stop()
+    sheet_pool.shutdown()
+
+
+def child_exit(server, worker):
+    # Runs in the master; requeues sheets a killed worker left mid-processing and keeps
+    # its metric counts without keeping its file
+    from app import job_queue
+    from omr_metrics import registry
+    job_queue.requeue_interrupted(worker.pid)
+    registry.mark_process_dead(worker.pid)
@@ -0,0 +1,88 @@
+import os
+import threading
+from omr_metrics import registry
+
+# Configuration
+UPLOAD_CONCURRENCY = int(os.getenv('ADMISSION_UPLOAD_CONCURRENCY', '2'))  # Upload requests handled at once per process
+READ_CONCURRENCY = int(os.getenv('ADMISSION_READ_CONCURRENCY', '16'))  # Read requests handled at once per process
+UPLOAD_WAIT = float(os.getenv('ADMISSION_UPLOAD_WAIT', '2'))  # Seconds an upload waits for a slot before 429
+READ_WAIT = float(os.getenv('ADMISSION_READ_WAIT', '10'))  # Seconds a read waits for a slot before 503
+MAX_BACKLOG = int(os.getenv('ADMISSION_MAX_BACKLOG', '500'))  # Queued sheets above which uploads are refused
+RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER', '30'))  # Seconds suggested to refused clients
+
+REJECTED = registry.counter('omr_admission_rejected_total', 'Requests refused by admission control', ('kind', 'reason'))
+
+
+class Limiter:
+    """Counting semaphore that reports how many requests hold or wait for a slot"""
+
+    def __init__(self, limit, wait):
+        self.limit = max(1, limit)
+        self.wait = wait
+        self._slots = threading.BoundedSemaphore(self.limit)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.waiting = 0
+
+    def acquire(self):
+        acquired = False
+        with self._lock:
+            self.waiting += 1
+        try:
+            acquired = self._slots.acquire(timeout=self.wait) if self.wait > 0 else self._slots.acquire(blocking=False)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+                if acquired:
+                    self.in_flight += 1
+        return acquired
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+
+class AdmissionControl:
+    """Separate concurrency limits for uploads and reads, and a backlog cap on uploads
+
+    backlog is a callable returning the number of sheets queued for processing; uploads
+    are refused with 429 while it is at or above max_backlog instead of queuing more.
+    Reads that cannot get a slot within their wait get 503, so a burst of slow uploads
+    never starves result and export requests.
+    """
+
+    def __init__(self, backlog=None, upload_concurrency=UPLOAD_CONCURRENCY, read_concurrency=READ_CONCURRENCY,
+                 upload_wait=UPLOAD_WAIT, read_wait=READ_WAIT, max_backlog=MAX_BACKLOG, retry_after=RETRY_AFTER):
+        self.backlog = backlog or (lambda: 0)
+        self.max_backlog = max_backlog
+        self.retry_after = retry_after
+        self.limiters = {
+            'upload': Limiter(upload_concurrency, upload_wait),
+            'read': Limiter(read_concurrency, read_wait)
+        }
+
+    def admit(self, kind, check_backlog=True):
+        """None if the request may proceed (call release(kind) afterwards), else (status, reason)
+
+        Pass check_backlog=False for requests that continue an upload already admitted,
+        such as the chunks of an upload session, so a backlog never strands it half sent.
+        """
+        if kind == 'upload' and check_backlog and self.max_backlog and self.backlog() >= self.max_backlog:
+            REJECTED.inc(kind=kind, reason='backlog')
+            return 429, 'Processing backlog is full'
+        if not self.limiters[kind].acquire():
+            REJECTED.inc(kind=kind, reason='concurrency')
+            return (429, 'Too many uploads in progress') if kind == 'upload' else (503, 'Server busy')
+        return None
+
+    def release(self, kind):
+        self.limiters[kind].release()
+
+    def stats(self):
+        return {
+            'backlog': self.backlog(),
+            'maxBacklog': self.max_backlog,
+            **{kind: {'limit': limiter.limit, 'inFlight': limiter.in_flight, 'waiting': limiter.waiting}
+               for kind, limiter in self.limiters.items()}
+        }
@@ -0,0 +1,208 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+import cv2
+import numpy as np
+from omr_engine import BubbleGrid
+from omr_templates import CORNERS
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+ALIGN_SEARCH_FRACTION = float(os.getenv('ALIGN_SEARCH_FRACTION', '0.25'))  # Corner window of a full search, as a fraction of the page
+ALIGN_REFINE_RADIUS = float(os.getenv('ALIGN_REFINE_RADIUS', '3'))  # Refinement window radius, in fiducial sizes
+ALIGN_PROFILE_CACHE_SIZE = int(os.getenv('ALIGN_PROFILE_CACHE_SIZE', '64'))  # Scanner profiles remembered per template
+
+
+def _gray(image):
+    if image.ndim == 2:
+        return image
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+
+def find_fiducial(image, window, target, min_size, max_size):
+    """Centroid of the solid dark blob in a window nearest to target, or None
+
+    window is (x0, y0, x1, y1) in image coordinates; only that crop is converted
+    and thresholded.
+    """
+    height, width = image.shape[:2]
+    x0, y0, x1, y1 = (int(round(v)) for v in window)
+    x0, x1 = max(0, x0), min(width, x1)
+    y0, y1 = max(0, y0), min(height, y1)
+    if x1 - x0 < 2 or y1 - y0 < 2:
+        return None
+
+    crop = _gray(image[y0:y1, x0:x1])
+    _, binary = cv2.threshold(crop, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    count, _, stats, centroids = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    if count < 2:
+        return None
+
+    # Keep solid, roughly square blobs of a plausible size
+    w = stats[1:, cv2.CC_STAT_WIDTH].astype(np.float64)
+    h = stats[1:, cv2.CC_STAT_HEIGHT].astype(np.float64)
+    area = stats[1:, cv2.CC_STAT_AREA]
+    size = np.sqrt(w * h)
+    keep = ((size >= min_size) & (size <= max_size)
+            & (area >= 0.6 * w * h) & (w <= 2 * h) & (h <= 2 * w))
+    if not keep.any():
+        return None
+
+    points = centroids[1:][keep] + (x0, y0)
+    distance = np.hypot(points[:, 0] - target[0], points[:, 1] - target[1])
+    return points[np.argmin(distance)]
+
+
+class SheetAligner:
+    """Maps a template's bubble boxes onto scanned sheets through its four fiducials
+
+    The homography found for a scanner profile is cached, so the next sheet from the
+    same feeder only searches small windows around the previous fiducial positions.
+    A full corner search runs for new profiles and whenever refinement fails.
+    """
+
+    def __init__(self, template, cache_size=ALIGN_PROFILE_CACHE_SIZE):
+        self.template = template
+        self.reference = np.asarray(template.calibration_points, dtype=np.float32)
+        self.fiducial_size = float(template.fiducial_size)
+        self.cache_size = cache_size
+        self._profiles = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Bubble centres and edge midpoints in template coordinates, warped together
+        boxes = np.asarray([box for question in template.question_regions for box in question],
+                           dtype=np.float64).reshape(-1, 4)
+        x, y, w, h = boxes.T
+        cx, cy = x + w / 2, y + h / 2
+        self._points = np.concatenate([
+            np.stack([cx, cy], axis=1),
+            np.stack([x, cy], axis=1), np.stack([x + w, cy], axis=1),
+            np.stack([cx, y], axis=1), np.stack([cx, y + h], axis=1)
+        ]).reshape(-1, 1, 2)
+        self._counts = [len(question) for question in template.question_regions]
+
+        self.full_searches = 0
+        self.refinements = 0
+        self.failures = 0
+
+    def _get(self, profile):
+        with self._lock:
+            state = self._profiles.get(profile)
+            if state is not None:
+                self._profiles.move_to_end(profile)
+            return state
+
+    def _put(self, profile, state):
+        with self._lock:
+            self._profiles[profile] = state
+            self._profiles.move_to_end(profile)
+            while len(self._profiles) > self.cache_size:
+                self._profiles.popitem(last=False)
+
+    def _full_search(self, image, scale=1.0):
+        """Look for each fiducial in its corner of the page"""
+        height, width = image.shape[:2]
+        span_x, span_y = width * ALIGN_SEARCH_FRACTION, height * ALIGN_SEARCH_FRACTION
+        windows = {
+            'topLeft': ((0, 0, span_x, span_y), (0, 0)),
+            'topRight': ((width - span_x, 0, width, span_y), (width, 0)),
+            'bottomLeft': ((0, height - span_y, span_x, height), (0, height)),
+            'bottomRight': ((width - span_x, height - span_y, width, height), (width, height))
+        }
+
+        found = []
+        for corner in CORNERS:
+            window, target = windows[corner]
+            point = find_fiducial(image, window, target, self.fiducial_size * scale / 2,
+                                  self.fiducial_size * scale * 4)
+            if point is None:
+                return None
+            found.append(point)
+        return np.asarray(found, dtype=np.float32)
+
+    def _refine(self, image, expected, scale):
+        """Look for each fiducial near where the previous transform puts it"""
+        radius = ALIGN_REFINE_RADIUS * self.fiducial_size * scale
+        found = []
+        for x, y in expected:
+            window = (x - radius, y - radius, x + radius, y + radius)
+            point = find_fiducial(image, window, (x, y), self.fiducial_size * scale / 2,
+                                  self.fiducial_size * scale * 2)
+            if point is None:
+                return None
+            found.append(point)
+        return np.asarray(found, dtype=np.float32)
+
+    def _homography(self, found):
+        """Perspective transform from template to image, or None if the points are not a sane quad"""
+        tl, tr, bl, br = found
+        if not (tl[0] < tr[0] and bl[0] < br[0] and tl[1] < bl[1] and tr[1] < br[1]):
+            return None
+        matrix = cv2.getPerspectiveTransform(self.reference, found)
+        if not np.all(np.isfinite(matrix)):
+            return None
+        return matrix
+
+    def _scale(self, found):
+        return float(np.linalg.norm(found[1] - found[0]) / np.linalg.norm(self.reference[1] - self.reference[0]))
+
+    def warp_regions(self, matrix):
+        """Template bubble boxes mapped through a homography, as int (x, y, w, h) rows"""
+        n = len(self._points) // 5
+        points = cv2.perspectiveTransform(self._points, matrix).reshape(5, n, 2)
+        center, left, right, top, bottom = points
+        w = np.linalg.norm(right - left, axis=1)
+        h = np.linalg.norm(bottom - top, axis=1)
+        return np.rint(np.stack([center[:, 0] - w / 2, center[:, 1] - h / 2, w, h], axis=1)).astype(np.int64)
+
+    def _grid(self, boxes, previous):
+        # Reuse the previous grid when the warped boxes land on the same pixels
+        if previous is not None and np.array_equal(previous['boxes'], boxes):
+            return previous['grid']
+        rows = boxes.tolist()
+        regions, start = [], 0
+        for count in self._counts:
+            regions.append(rows[start:start + count])
+            start += count
+        return BubbleGrid(regions)
+
+    def align(self, image, profile=None, scale=1.0):
+        """Return (grid, method) for a sheet; method is 'refined', 'full' or 'none'
+
+        scale is the expected image size relative to the template, e.g. 0.5 for a
+        sheet decoded at half resolution.
+        """
+        previous = self._get(profile)
+
+        found, method = None, 'refined'
+        if previous is not None:
+            expected = cv2.perspectiveTransform(self.reference.reshape(-1, 1, 2), previous['matrix']).reshape(-1, 2)
+            found = self._refine(image, expected, previous['scale'])
+        if found is None:
+            found, method = self._full_search(image, scale), 'full'
+
+        matrix = self._homography(found) if found is not None else None
+        if matrix is None:
+            self.failures += 1
+            logger.warning(f"Could not locate the registration marks for profile {profile}, using raw coordinates")
+            return self.template.grid, 'none'
+
+        if method == 'full':
+            self.full_searches += 1
+        else:
+            self.refinements += 1
+
+        boxes = self.warp_regions(matrix)
+        grid = self._grid(boxes, previous)
+        self._put(profile, {'matrix': matrix, 'scale': self._scale(found), 'boxes': boxes, 'grid': grid})
+        return grid, method
+
+    def stats(self):
+        return {
+            'profiles': len(self._profiles),
+            'fullSearches': self.full_searches,
+            'refinements': self.refinements,
+            'failures': self.failures
+        }
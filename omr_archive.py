@@ -0,0 +1,230 @@
+"""Append-only archive of each sheet's binarized bubble crops, one per batch.
+
+Scans are deleted once processed. What a reviewer needs to check a rating is
+kept instead: the thresholded pixels of every bubble box, bit-packed, a few KB
+per sheet. Each batch has two files under CROP_ARCHIVE_DIR:
+
+    <batch_id>.crops   DATA_MAGIC, then one record per sheet, 8-byte aligned
+    <batch_id>.index   INDEX_MAGIC, then one fixed-size INDEX_ENTRY per record
+
+A record is RECORD_HEADER (questions, bubbles, pixels), the options of each
+question (u1), the height and width of each bubble box (<u2), then the packed
+pixels of every box in bubble order. Records are written before their index
+entry, so readers that map both files never see an entry without its data; a
+sheet stored twice is read from its latest entry.
+"""
+import os
+import mmap
+import zlib
+import fcntl
+import base64
+import struct
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+CROP_ARCHIVE = os.getenv('OMR_CROP_ARCHIVE', 'true').lower() == 'true'  # Keep bubble crops of processed sheets
+CROP_ARCHIVE_DIR = os.getenv('CROP_ARCHIVE_DIR', os.path.join('uploads', 'archive'))
+
+DATA_MAGIC = b'OMRCROP1'
+INDEX_MAGIC = b'OMRIDX01'
+HEADER_SIZE = 8
+RECORD_HEADER = struct.Struct('<HHI')
+# Sheet key digest, record offset, record length, record CRC-32
+INDEX_ENTRY = struct.Struct('<16sQII')
+INDEX_DTYPE = [('key', 'V16'), ('offset', '<u8'), ('length', '<u4'), ('crc', '<u4')]
+ALIGNMENT = 8
+
+
+def pack_crops(options_per_question, heights, widths, bits):
+    """One archive record from BubbleGrid.crops output"""
+    return b''.join([
+        RECORD_HEADER.pack(len(options_per_question), len(heights), int((heights * widths).sum())),
+        bytes(options_per_question),
+        heights.astype('<u2').tobytes(),
+        widths.astype('<u2').tobytes(),
+        bits.tobytes()
+    ])
+
+
+def encode_crops(grid, binary):
+    """Crops of a thresholded sheet as text, so results stay JSON and cross process boundaries"""
+    return base64.b64encode(pack_crops(grid.options_per_question, *grid.crops(binary))).decode('ascii')
+
+
+def without_crops(result):
+    """Copy of a processor result without its crops, for JSON responses and job records"""
+    if 'sheets' in result:
+        result = dict(result, sheets=[without_crops(sheet) for sheet in result['sheets']])
+    return {key: value for key, value in result.items() if key != 'crops'}
+
+
+def sheet_digest(sheet_key):
+    return hashlib.blake2b(sheet_key.encode(), digest_size=16).digest()
+
+
+class SheetCrops:
+    """Bubble crops of one sheet, read in place from a mapped record"""
+
+    def __init__(self, record):
+        import numpy as np
+
+        questions, bubbles, pixels = RECORD_HEADER.unpack_from(record)
+        offset = RECORD_HEADER.size
+        self.options_per_question = np.frombuffer(record, np.uint8, questions, offset).astype(np.int64)
+        offset += questions
+        self.heights = np.frombuffer(record, '<u2', bubbles, offset).astype(np.int64)
+        self.widths = np.frombuffer(record, '<u2', bubbles, offset + 2 * bubbles).astype(np.int64)
+        offset += 4 * bubbles
+        self.bits = np.frombuffer(record, np.uint8, (pixels + 7) // 8, offset)
+        self.pixels = pixels
+
+        self.area = self.heights * self.widths
+        self.ends = np.cumsum(self.area)
+        self.starts = self.ends - self.area
+        self.question_idx = np.repeat(np.arange(questions), self.options_per_question)
+
+    def __len__(self):
+        return len(self.area)
+
+    def fill_ratios(self):
+        """Fill ratio of every bubble, equal to what the sheet was scored with"""
+        import numpy as np
+
+        counts = np.zeros(self.pixels + 1, dtype=np.int64)
+        np.cumsum(np.unpackbits(self.bits, count=self.pixels), out=counts[1:])
+        ratios = np.zeros(len(self.area), dtype=np.float64)
+        np.divide(counts[self.ends] - counts[self.starts], self.area, out=ratios, where=self.area > 0)
+        return ratios
+
+    def scores(self):
+        """(1, questions, options) fill tensor and (questions, options) mask, as BubbleGrid.score_batch"""
+        import numpy as np
+
+        questions, options = len(self.options_per_question), int(self.options_per_question.max(initial=0))
+        option_idx = np.arange(len(self.area)) - np.repeat(np.cumsum(self.options_per_question)
+                                                           - self.options_per_question, self.options_per_question)
+        slots = self.question_idx * options + option_idx
+        scores = np.zeros(questions * options)
+        scores[slots] = self.fill_ratios()
+        valid = np.zeros(questions * options, dtype=bool)
+        valid[slots] = self.area > 0
+        return scores.reshape(1, questions, options), valid.reshape(questions, options)
+
+    def ratings(self, threshold=None):
+        """(ratings, confidences, fallback) per question under the processor's rating rule"""
+        from omr_engine import FILL_THRESHOLD, rate_batch
+
+        scores, valid = self.scores()
+        ratings, confidences, fallback = rate_batch(scores, valid, self.options_per_question,
+                                                    FILL_THRESHOLD if threshold is None else threshold)
+        return ratings[0], confidences[0], fallback[0]
+
+    def bubble(self, index):
+        """Bubble box as a 0/255 uint8 image"""
+        import numpy as np
+
+        start, area = int(self.starts[index]), int(self.area[index])
+        # Only the bytes holding this bubble's bits are unpacked
+        first, last = start // 8, (start + area + 7) // 8
+        pixels = np.unpackbits(self.bits[first:last])[start - first * 8:start - first * 8 + area]
+        return (pixels * 255).reshape(int(self.heights[index]), int(self.widths[index]))
+
+    def mosaic(self, question=None, gap=2):
+        """Bubbles as one image, a row per question, optionally of one question only"""
+        import numpy as np
+
+        questions = range(len(self.options_per_question)) if question is None else [question]
+        rows = [np.flatnonzero(self.question_idx == i) for i in questions]
+        height = sum(int(self.heights[row].max(initial=0)) + gap for row in rows) + gap
+        width = max((int(self.widths[row].sum()) + gap * (len(row) + 1) for row in rows), default=gap)
+        image = np.full((height, width), 128, dtype=np.uint8)
+
+        y = gap
+        for row in rows:
+            x = gap
+            for k in row:
+                h, w = int(self.heights[k]), int(self.widths[k])
+                image[y:y + h, x:x + w] = self.bubble(k)
+                x += w + gap
+            y += int(self.heights[row].max(initial=0)) + gap
+        return image
+
+
+class CropArchive:
+    """Bubble crops of one batch's sheets, appended by writers and read through mmap"""
+
+    def __init__(self, batch_id, root=CROP_ARCHIVE_DIR):
+        self.root = root
+        self.data_path = os.path.join(root, f'{batch_id}.crops')
+        self.index_path = os.path.join(root, f'{batch_id}.index')
+
+    def append(self, sheets):
+        """Store (sheet_key, record) pairs, each replacing any earlier record of its sheet"""
+        os.makedirs(self.root, exist_ok=True)
+        with open(self.index_path, 'ab') as index, open(self.data_path, 'ab') as data:
+            # Serializes writers to this batch across threads and processes
+            fcntl.flock(index, fcntl.LOCK_EX)
+            offset = data.seek(0, os.SEEK_END)
+            if offset == 0:
+                offset = data.write(DATA_MAGIC)
+            if index.seek(0, os.SEEK_END) == 0:
+                index.write(INDEX_MAGIC)
+
+            entries = []
+            for sheet_key, record in sheets:
+                padding = -len(record) % ALIGNMENT
+                data.write(record + b'\0' * padding)
+                entries.append(INDEX_ENTRY.pack(sheet_digest(sheet_key), offset, len(record), zlib.crc32(record)))
+                offset += len(record) + padding
+
+            # Records must be on disk before the entries that point at them
+            data.flush()
+            os.fsync(data.fileno())
+            index.write(b''.join(entries))
+            index.flush()
+
+    @staticmethod
+    def _map(path, magic):
+        try:
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size <= HEADER_SIZE:
+                    return None
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+        if mapped[:HEADER_SIZE] != magic:
+            raise ValueError(f'{path} is not a crop archive')
+        return mapped
+
+    def get(self, sheet_key):
+        """SheetCrops of a sheet's latest record, or None if the sheet has none"""
+        import numpy as np
+
+        index = self._map(self.index_path, INDEX_MAGIC)
+        if index is None:
+            return None
+        # A torn final entry from an interrupted writer is ignored
+        count = (len(index) - HEADER_SIZE) // INDEX_ENTRY.size
+        entries = np.frombuffer(index, np.dtype(INDEX_DTYPE), count, HEADER_SIZE)
+        digest = np.frombuffer(sheet_digest(sheet_key), np.dtype('V16'))
+        matches = np.flatnonzero(entries['key'] == digest)
+        if not len(matches):
+            return None
+        entry = entries[matches[-1]]
+
+        data = self._map(self.data_path, DATA_MAGIC)
+        record = memoryview(data)[int(entry['offset']):int(entry['offset']) + int(entry['length'])]
+        if zlib.crc32(record) != int(entry['crc']):
+            raise ValueError(f'Crop record of {sheet_key} is corrupt')
+        return SheetCrops(record)
+
+    def stats(self):
+        """Sheets stored and bytes on disk"""
+        sizes = [os.path.getsize(path) if os.path.exists(path) else 0 for path in (self.data_path, self.index_path)]
+        return {
+            'records': max(0, sizes[1] - HEADER_SIZE) // INDEX_ENTRY.size,
+            'bytes': sum(sizes)
+        }
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""Process directories of scanned OMR sheets without going through the web API.
+
+Inputs are files, directories (walked recursively) or glob patterns. Results go to
+the database through the bulk SheetWriter, to a JSONL or CSV file, or both. A
+progress manifest records every finished file so an interrupted run picks up
+where it stopped.
+
+With --database, each file's batch comes from its folder under the input
+directory: <root>/<batch_code>/<file>, or <root>/<batch_code>/<subject position>/<file>.
+--batch-code puts every file under one batch instead.
+
+    python omr_batch.py /archive/2025-s1 --database --workers 8
+    python omr_batch.py "/scans/**/*.pdf" --output results.jsonl --manifest run.manifest
+"""
+import os
+import csv
+import sys
+import glob
+import json
+import logging
+import argparse
+from collections import deque
+from datetime import datetime
+from dotenv import load_dotenv
+
+from omr_pool import SheetPool
+from omr_store import SHEET_FLUSH_SIZE, sheet_rows
+from omr_templates import load_json
+from omr_archive import without_crops
+
+logger = logging.getLogger(__name__)
+
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'pdf'}
+
+
+def is_sheet(path):
+    return path.rsplit('.', 1)[-1].lower() in ALLOWED_EXTENSIONS and os.path.isfile(path)
+
+
+def glob_root(pattern):
+    """Directory of a glob pattern above its first wildcard component; a plain file's own directory"""
+    parts = pattern.split(os.sep)
+    for i, part in enumerate(parts):
+        if glob.has_magic(part):
+            return os.sep.join(parts[:i]) or (os.sep if i else '.')
+    return os.path.dirname(pattern) or '.'
+
+
+def find_sheets(inputs):
+    """Yield (root, path) for every sheet under the inputs, in a stable order"""
+    seen = set()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            root = pattern
+            paths = (os.path.join(dirpath, name)
+                     for dirpath, dirnames, filenames in os.walk(pattern)
+                     for name in sorted(filenames))
+        else:
+            root = glob_root(pattern)
+            paths = sorted(glob.glob(pattern, recursive=True))
+        for path in paths:
+            path = os.path.abspath(path)
+            if path not in seen and is_sheet(path):
+                seen.add(path)
+                yield root, path
+
+
+def batch_for(root, path, batch_code=None):
+    """(batch_code, subject_position) for a file from its folders under root
+
+    <root>/<batch>/<file> maps to subject 0; <root>/<batch>/<n>/<file> to subject n.
+    """
+    parts = os.path.relpath(path, root).split(os.sep)[:-1]
+    position = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
+    if batch_code:
+        return batch_code, position
+    if not parts:
+        raise ValueError(f'{path} is not inside a batch folder')
+    return parts[0], position
+
+
+def file_id(path):
+    """Identity recorded in the manifest; a changed file is processed again"""
+    stat = os.stat(path)
+    return f'{path}|{stat.st_size}|{int(stat.st_mtime)}'
+
+
+class Manifest:
+    """Append-only list of finished files, written only after their results are durable"""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        self.done.add(json.loads(line)['file'])
+                    except (ValueError, KeyError):
+                        # A line cut short by a crash; the file is simply redone
+                        continue
+        self._file = open(path, 'a')
+
+    def record(self, entries):
+        for entry in entries:
+            self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+class FileOutput:
+    """JSONL (one line per sheet) or CSV results file, appended to when resuming"""
+
+    def __init__(self, path):
+        self.path = path
+        self.csv = path.lower().endswith('.csv')
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'a', newline='')
+        self._writer = csv.writer(self._file) if self.csv else None
+        self._header = not new
+
+    def write(self, root, path, batch_code, position, result):
+        for page, sheet in sheet_rows(result):
+            ratings = sheet.get('ratings', [])
+            if self.csv:
+                if not self._header:
+                    self._writer.writerow(['File', 'Batch Code', 'Subject Position', 'Page', 'Status',
+                                           'Overall Score', 'Confidence', 'Error'] +
+                                          [r['question'] for r in ratings])
+                    self._header = True
+                self._writer.writerow([path, batch_code, position, page,
+                                       'processed' if sheet.get('success') else 'failed',
+                                       sheet.get('overall_score'), sheet.get('confidence'), sheet.get('error')] +
+                                      [r['rating'] for r in ratings])
+            else:
+                self._file.write(json.dumps({'file': path, 'batchCode': batch_code, 'subjectPosition': position,
+                                             'page': page, 'result': without_crops(sheet)}) + '\n')
+
+    def flush(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+class DatabaseOutput:
+    """Bulk sheet writes into existing batches, committed at each checkpoint"""
+
+    def __init__(self, database, flush_size):
+        import psycopg2
+        import omr_store
+        from db_pool import db_config
+        from result_cache import invalidate_batches
+
+        self.store = omr_store
+        self.invalidate_batches = invalidate_batches
+        self.conn = psycopg2.connect(**db_config(database))
+        self.writer = omr_store.SheetWriter(self.conn, flush_size)
+        self._batch_ids = {}
+        self._written = set()
+
+    def write(self, root, path, batch_code, position, result):
+        if batch_code not in self._batch_ids:
+            self._batch_ids[batch_code] = self.store.batch_id_for(self.conn, batch_code)
+        batch_id = self._batch_ids[batch_code]
+        if batch_id is None:
+            raise ValueError(f'Batch {batch_code} does not exist')
+        # Sheets are named by their path under the input directory, as the watch daemon names them
+        self.writer.add(batch_id, position, os.path.relpath(path, root), result)
+        self._written.add(batch_code)
+
+    def flush(self):
+        self.writer.flush()
+        # The server's cached results of these batches are now stale
+        self.invalidate_batches(self._written)
+        self._written = set()
+
+    def close(self):
+        self.conn.close()
+
+
+def run(args):
+    template = load_json(args.template) if args.template else None
+    # The database goes first: a file it refuses is not written to the results file either
+    outputs = []
+    if args.database:
+        outputs.append(DatabaseOutput(args.database, args.flush_size))
+    if args.output:
+        outputs.append(FileOutput(args.output))
+    if not outputs:
+        raise SystemExit('Nothing to write: give --output and/or --database')
+
+    manifest = Manifest(args.manifest or (args.output or 'omr_batch') + '.manifest')
+    pool = SheetPool(workers=args.workers)
+    pool.start()
+
+    counts = {'processed': 0, 'failed': 0, 'skipped': 0}
+    in_flight = deque()
+    finished = []
+
+    def checkpoint():
+        # Results first, then the manifest, so a crash can only redo work
+        for output in outputs:
+            output.flush()
+        manifest.record(finished)
+        finished.clear()
+
+    def collect():
+        root, path, ident, batch_code, position, pending = in_flight.popleft()
+        result = pending.result()
+        try:
+            for output in outputs:
+                output.write(root, path, batch_code, position, result)
+        except ValueError as e:
+            # Left out of the manifest, so a rerun picks the file up once its batch exists
+            logger.error(f"{path}: {e}")
+            counts['failed'] += 1
+            return
+        status = 'processed' if result.get('success') else 'failed'
+        counts[status] += 1
+        finished.append({'file': ident, 'status': status, 'at': datetime.now().isoformat()})
+        if len(finished) >= args.flush_size:
+            checkpoint()
+            logger.info(f"{counts['processed']} processed, {counts['failed']} failed, {counts['skipped']} skipped")
+
+    try:
+        for root, path in find_sheets(args.inputs):
+            ident = file_id(path)
+            if ident in manifest.done:
+                counts['skipped'] += 1
+                continue
+            try:
+                batch_code, position = batch_for(root, path, args.batch_code)
+            except ValueError as e:
+                logger.error(str(e))
+                counts['failed'] += 1
+                continue
+
+            # Keep a bounded number of files queued on the pool
+            in_flight.append((root, path, ident, batch_code, position,
+                              pool.submit(path, path.lower().endswith('.pdf'), template, args.profile)))
+            if len(in_flight) >= max(1, args.workers) * 2:
+                collect()
+
+        while in_flight:
+            collect()
+        checkpoint()
+    finally:
+        pool.shutdown()
+        manifest.close()
+        for output in outputs:
+            output.close()
+
+    logger.info(f"Done: {counts['processed']} processed, {counts['failed']} failed, "
+                f"{counts['skipped']} already in the manifest")
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('inputs', nargs='+', help='files, directories or glob patterns')
+    parser.add_argument('--output', help='results file, .jsonl or .csv')
+    parser.add_argument('--database', nargs='?', const='omrscan',
+                        help='write sheets to this database (PG* environment variables)')
+    parser.add_argument('--batch-code', help='put every file under this batch')
+    parser.add_argument('--template', help='template JSON file; the built-in form by default')
+    parser.add_argument('--profile', help='scanner profile used for alignment')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--manifest', help='progress manifest (default: <output>.manifest)')
+    parser.add_argument('--flush-size', type=int, default=SHEET_FLUSH_SIZE,
+                        help='files per checkpoint of results and manifest')
+    args = parser.parse_args(argv)
+
+    counts = run(args)
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,291 @@
+import os
+import functools
+import threading
+from collections import OrderedDict
+import cv2
+import numpy as np
+
+# Fill ratio above which a bubble counts as marked
+FILL_THRESHOLD = 0.3
+# Image shapes each grid keeps clipped coordinates for; scans of one form come in a few sizes
+SHAPE_CACHE_SIZE = int(os.getenv('OMR_SHAPE_CACHE_SIZE', '8'))
+
+
+class ShapeCache:
+    """Small thread-safe LRU of values derived from an image shape"""
+
+    def __init__(self, maxsize=SHAPE_CACHE_SIZE):
+        self.maxsize = max(1, maxsize)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+
+class BubbleGrid:
+    """Compiled bubble layout that scores every bubble on a sheet in one pass"""
+
+    def __init__(self, regions):
+        boxes = []
+        question_idx = []
+        option_idx = []
+        for i, question_regions in enumerate(regions):
+            for j, (x, y, w, h) in enumerate(question_regions):
+                boxes.append((x, y, w, h))
+                question_idx.append(i)
+                option_idx.append(j)
+
+        boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+        self.x0 = boxes[:, 0]
+        self.y0 = boxes[:, 1]
+        self.x1 = boxes[:, 0] + boxes[:, 2]
+        self.y1 = boxes[:, 1] + boxes[:, 3]
+        self.question_idx = np.asarray(question_idx, dtype=np.int64)
+        self.option_idx = np.asarray(option_idx, dtype=np.int64)
+        self.question_count = len(regions)
+        self.options_per_question = [len(q) for q in regions]
+        self.options = (self.option_idx + 1).tolist()
+
+        # Slot of each bubble in a (questions, max options) score tensor
+        self.max_options = max(self.options_per_question, default=0)
+        self.slots = self.question_idx * self.max_options + self.option_idx
+
+        # Clipped coordinates per image shape, filled lazily for the most recent shapes
+        self._layouts = ShapeCache()
+        self._bands = ShapeCache()
+        self._insets = ShapeCache()
+        self._crop_pixels = ShapeCache()
+
+    def __len__(self):
+        return len(self.x0)
+
+    def inset(self, fraction):
+        """Grid with every box shrunk by fraction of its size on each side"""
+        grid = self._insets.get(fraction)
+        if grid is None:
+            dx = np.rint((self.x1 - self.x0) * fraction).astype(np.int64)
+            dy = np.rint((self.y1 - self.y0) * fraction).astype(np.int64)
+            boxes = np.stack([self.x0 + dx, self.y0 + dy,
+                              np.maximum(self.x1 - self.x0 - 2 * dx, 1),
+                              np.maximum(self.y1 - self.y0 - 2 * dy, 1)], axis=1).tolist()
+            regions, start = [], 0
+            for count in self.options_per_question:
+                regions.append(boxes[start:start + count])
+                start += count
+            grid = self._insets.put(fraction, BubbleGrid(regions))
+        return grid
+
+    def _layout(self, shape):
+        """Clip bubble boxes to an image shape the same way numpy slicing would"""
+        key = tuple(shape[:2])
+        layout = self._layouts.get(key)
+        if layout is not None:
+            return layout
+
+        height, width = key
+        x0 = np.clip(self.x0, 0, width)
+        y0 = np.clip(self.y0, 0, height)
+        x1 = np.maximum(np.clip(self.x1, 0, width), x0)
+        y1 = np.maximum(np.clip(self.y1, 0, height), y0)
+        area = (x1 - x0) * (y1 - y0)
+
+        if len(area):
+            strip = (int(y0.min()), int(y1.max()), int(x0.min()), int(x1.max()))
+        else:
+            strip = (0, 0, 0, 0)
+
+        # Coordinates relative to the strip's integral image
+        layout = (strip, x0 - strip[2], y0 - strip[0], x1 - strip[2], y1 - strip[0],
+                  area, (area == 0).tolist())
+        return self._layouts.put(key, layout)
+
+    def bands(self, shape, pad):
+        """Padded union boxes of the bubble rows as (y0, y1, x0, x1), merged where they overlap vertically"""
+        key = (tuple(shape[:2]), pad)
+        bands = self._bands.get(key)
+        if bands is not None:
+            return bands
+
+        height, width = key[0]
+        rows = []
+        for i in range(self.question_count):
+            mask = self.question_idx == i
+            if not mask.any():
+                continue
+            rows.append([max(0, int(self.y0[mask].min()) - pad), min(height, int(self.y1[mask].max()) + pad),
+                         max(0, int(self.x0[mask].min()) - pad), min(width, int(self.x1[mask].max()) + pad)])
+
+        # Rows overlapping vertically share one band, so no pixel is thresholded twice
+        bands = []
+        for row in sorted(rows):
+            if row[0] >= row[1] or row[2] >= row[3]:
+                continue
+            if bands and row[0] < bands[-1][1]:
+                last = bands[-1]
+                last[1] = max(last[1], row[1])
+                last[2] = min(last[2], row[2])
+                last[3] = max(last[3], row[3])
+            else:
+                bands.append(row)
+        return self._bands.put(key, [tuple(band) for band in bands])
+
+    def strip(self, shape):
+        """(y0, y1, x0, x1) of the smallest region of an image shape covering every bubble"""
+        return self._layout(shape)[0]
+
+    def crops(self, binary):
+        """(heights, widths, bits) of every bubble's clipped box in a thresholded image
+
+        bits packs the boxes' pixels (nonzero is 1) row by row and bubble after bubble,
+        so bubble k covers heights[k] * widths[k] bits starting where bubble k - 1 ends.
+        """
+        (sy0, _, sx0, _), x0, y0, x1, y1, area, _ = self._layout(binary.shape)
+        key = binary.shape[:2]
+        pixels = self._crop_pixels.get(key)
+        if pixels is None:
+            # Flat image index of every bubble pixel, built once per image shape
+            widths = x1 - x0
+            bubble = np.repeat(np.arange(len(area)), area)
+            local = np.arange(int(area.sum())) - np.repeat(np.cumsum(area) - area, area)
+            rows = sy0 + y0[bubble] + local // np.maximum(widths[bubble], 1)
+            cols = sx0 + x0[bubble] + local % np.maximum(widths[bubble], 1)
+            pixels = self._crop_pixels.put(key, rows * binary.shape[1] + cols)
+
+        bits = np.packbits(np.not_equal(binary.reshape(-1)[pixels], 0))
+        return y1 - y0, x1 - x0, bits
+
+    def fill_ratios(self, binary):
+        """Return (fill_ratio, area) arrays for every bubble of a thresholded image"""
+        (sy0, sy1, sx0, sx1), x0, y0, x1, y1, area, _ = self._layout(binary.shape)
+        if not len(area):
+            return np.zeros(0), area
+
+        # Integral image over the union strip only; counts nonzero pixels like countNonZero
+        strip = binary[sy0:sy1, sx0:sx1]
+        if strip.dtype != np.uint8:
+            strip = np.not_equal(strip, 0).view(np.uint8)
+        _, ones = cv2.threshold(strip, 0, 1, cv2.THRESH_BINARY)
+        integral = cv2.integral(ones)
+
+        filled = (integral[y1, x1] - integral[y0, x1]
+                  - integral[y1, x0] + integral[y0, x0])
+
+        ratios = np.zeros(len(area), dtype=np.float64)
+        np.divide(filled, area, out=ratios, where=area > 0)
+        return ratios, area
+
+    def fill_ratios_batch(self, stack, shape=None):
+        """(N, bubbles) fill ratios for N thresholded pages of the same shape
+
+        stack is (N, H, W) pages, or with shape the strip(shape) crop of each page of that
+        shape, which is all that is read and keeps large batches small.
+        """
+        (sy0, sy1, sx0, sx1), x0, y0, x1, y1, area, _ = self._layout(shape or stack.shape[1:])
+        if shape is None:
+            stack = stack[:, sy0:sy1, sx0:sx1]
+        if not len(area):
+            return np.zeros((len(stack), 0))
+
+        # One integral buffer reused page by page stays in cache; a single integral of the
+        # whole stack does not, and the box gathers from it then run slower than per sheet
+        count, height, width = stack.shape
+        integral = np.empty((height + 1, width + 1), dtype=np.int32)
+        filled = np.empty((count, len(area)), dtype=np.int32)
+        for page, out in zip(stack, filled):
+            if page.dtype != np.uint8:
+                page = np.not_equal(page, 0).view(np.uint8)
+            _, ones = cv2.threshold(page, 0, 1, cv2.THRESH_BINARY)
+            cv2.integral(ones, sum=integral, sdepth=cv2.CV_32S)
+            np.subtract(integral[y1, x1], integral[y0, x1], out=out)
+            out -= integral[y1, x0]
+            out += integral[y0, x0]
+
+        ratios = np.zeros(filled.shape, dtype=np.float64)
+        np.divide(filled, area, out=ratios, where=area > 0)
+        return ratios
+
+    def score_batch(self, stack, shape=None):
+        """Fill ratios of N pages as an (N, questions, options) tensor, plus the (questions, options) mask of real bubbles
+
+        Questions with fewer options than the widest one are padded with zeros.
+        """
+        ratios = self.fill_ratios_batch(stack, shape)
+        scores = np.zeros((len(ratios), self.question_count * self.max_options))
+        scores[:, self.slots] = ratios
+
+        area = self._layout(shape or stack.shape[1:])[5]
+        valid = np.zeros(self.question_count * self.max_options, dtype=bool)
+        valid[self.slots] = area > 0
+        return (scores.reshape(-1, self.question_count, self.max_options),
+                valid.reshape(self.question_count, self.max_options))
+
+    def score(self, binary):
+        """Score a thresholded image into the per-question detection structure"""
+        ratios, _ = self.fill_ratios(binary)
+        empty = self._layout(binary.shape)[-1]
+        marked = (ratios > FILL_THRESHOLD).tolist()
+        confidence = np.minimum(ratios * 2, 1.0).tolist()
+        ratios_list = ratios.tolist()
+        options = self.options
+
+        results = []
+        k = 0
+        for count in self.options_per_question:
+            question_results = []
+            for _ in range(count):
+                if empty[k]:
+                    question_results.append(0)
+                else:
+                    question_results.append({
+                        'option': options[k],
+                        'is_marked': marked[k],
+                        'confidence': confidence[k],
+                        'fill_percentage': ratios_list[k]
+                    })
+                k += 1
+            results.append(question_results)
+
+        return results
+
+
+def rate_batch(scores, valid, options_per_question, threshold=FILL_THRESHOLD):
+    """Vectorized rating rule of OMRProcessor.calculate_ratings for an (N, questions, options) score tensor
+
+    Returns (ratings, confidences, fallback) arrays of shape (N, questions): the most
+    confident marked option (the first on ties), or the middle option with confidence
+    0.1 where nothing is marked.
+    """
+    confidence = np.minimum(scores * 2, 1.0)
+    marked = (scores > threshold) & valid
+    best = np.where(marked, confidence, -1.0).argmax(axis=2)
+    any_marked = marked.any(axis=2)
+
+    counts = np.asarray(options_per_question)
+    ratings = np.where(any_marked, best + 1, (counts + 1) // 2)
+    confidences = np.where(any_marked, np.take_along_axis(confidence, best[..., None], axis=2)[..., 0], 0.1)
+    return ratings, confidences, ~any_marked
+
+
+@functools.lru_cache(maxsize=32)
+def _compile(frozen_regions):
+    return BubbleGrid(frozen_regions)
+
+
+def compile_bubble_grid(regions):
+    """Compile (and cache) a BubbleGrid for a list of question regions"""
+    frozen = tuple(tuple(tuple(int(v) for v in box) for box in question)
+                   for question in regions)
+    return _compile(frozen)
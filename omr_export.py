@@ -0,0 +1,129 @@
+import csv
+import io
+import os
+import tempfile
+from psycopg2.extras import RealDictCursor
+
+from omr_store import FAILED_PERCENTAGE
+
+# Configuration
+EXPORT_FETCH_SIZE = int(os.getenv('EXPORT_FETCH_SIZE', '2000'))  # Rows per server-side cursor round trip
+
+SUMMARY_HEADER = ['Subject', 'Teacher Name', 'Percentage', 'Status']
+SHEET_HEADER = ['Batch Code', 'Subject', 'Teacher Name', 'File', 'Page', 'Status', 'Overall Score', 'Confidence']
+
+
+def _stream(conn, query, params):
+    """Iterate a query through a server-side named cursor so rows never pile up in memory"""
+    cursor = conn.cursor(name='omr_export', cursor_factory=RealDictCursor)
+    cursor.itersize = EXPORT_FETCH_SIZE
+    try:
+        cursor.execute(query, params)
+        for row in cursor:
+            yield row
+    finally:
+        cursor.close()
+
+
+def summary_rows(conn, batch_codes, with_batch_code=False):
+    """(header, rows) with one row per batch subject"""
+    header = (['Batch Code'] if with_batch_code else []) + SUMMARY_HEADER
+    query = """
+        SELECT b.batch_code, bs.subject, bs.teacher_name,
+               CASE
+                   WHEN COUNT(s.id) FILTER (WHERE s.status = 'processed') > 0
+                   THEN ROUND(AVG(COALESCE(s.percentage, s.overall_score / 5 * 100))
+                              FILTER (WHERE s.status = 'processed'), 1)
+                   WHEN COUNT(s.id) > 0 THEN %s
+                   ELSE 0
+               END AS percentage,
+               COUNT(s.id) > 0 AS is_uploaded
+        FROM batches b
+        JOIN batch_subjects bs ON bs.batch_id = b.id
+        LEFT JOIN omr_sheets s ON s.batch_id = bs.batch_id AND s.subject_position = bs.position
+        WHERE b.batch_code = ANY(%s)
+        GROUP BY b.batch_code, bs.position, bs.subject, bs.teacher_name
+        ORDER BY b.batch_code, bs.position
+    """
+
+    def rows():
+        for row in _stream(conn, query, (FAILED_PERCENTAGE, list(batch_codes))):
+            status = "Uploaded" if row['is_uploaded'] else "Not Uploaded"
+            values = [row['subject'], row['teacher_name'], row['percentage'], status]
+            yield ([row['batch_code']] if with_batch_code else []) + values
+
+    return header, rows()
+
+
+def sheet_rows(conn, batch_codes):
+    """(header, rows) with one row per scanned sheet and a column per question"""
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT DISTINCT r.question, r.question_text
+        FROM sheet_responses r
+        JOIN batches b ON b.id = r.batch_id
+        WHERE b.batch_code = ANY(%s)
+        ORDER BY r.question
+    """, (list(batch_codes),))
+    questions = cursor.fetchall()
+    cursor.close()
+
+    header = SHEET_HEADER + [text for _, text in questions]
+    columns = {question: i for i, (question, _) in enumerate(questions)}
+    query = """
+        SELECT b.batch_code, bs.subject, bs.teacher_name, s.file_name, s.page, s.status,
+               s.overall_score, s.confidence,
+               ARRAY_AGG(r.question ORDER BY r.question) FILTER (WHERE r.question IS NOT NULL) AS questions,
+               ARRAY_AGG(r.rating ORDER BY r.question) FILTER (WHERE r.question IS NOT NULL) AS ratings
+        FROM omr_sheets s
+        JOIN batches b ON b.id = s.batch_id
+        LEFT JOIN batch_subjects bs ON bs.batch_id = s.batch_id AND bs.position = s.subject_position
+        LEFT JOIN sheet_responses r ON r.sheet_id = s.id
+        WHERE b.batch_code = ANY(%s)
+        GROUP BY b.batch_code, bs.position, bs.subject, bs.teacher_name, s.id
+        ORDER BY b.batch_code, bs.position, s.file_name, s.page
+    """
+
+    def rows():
+        for row in _stream(conn, query, (list(batch_codes),)):
+            ratings = [None] * len(columns)
+            for question, rating in zip(row['questions'] or [], row['ratings'] or []):
+                ratings[columns[question]] = rating
+            yield [row['batch_code'], row['subject'], row['teacher_name'], row['file_name'], row['page'],
+                   row['status'], row['overall_score'], row['confidence']] + ratings
+
+    return header, rows()
+
+
+def iter_csv(header, rows):
+    """Yield a properly quoted CSV document as encoded chunks of roughly 64KB"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= 64 * 1024:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def write_xlsx(header, rows, sheet_name='Results'):
+    """Write rows to a temporary XLSX file in constant-memory mode and return its path"""
+    import xlsxwriter
+
+    handle, path = tempfile.mkstemp(suffix='.xlsx')
+    os.close(handle)
+    try:
+        workbook = xlsxwriter.Workbook(path, {'constant_memory': True, 'in_memory': False})
+        worksheet = workbook.add_worksheet(sheet_name)
+        worksheet.write_row(0, 0, header)
+        for row_index, row in enumerate(rows, start=1):
+            worksheet.write_row(row_index, 0, [float(v) if hasattr(v, 'as_tuple') else v for v in row])
+        workbook.close()
+    except Exception:
+        os.remove(path)
+        raise
+    return path
@@ -0,0 +1,362 @@
+import os
+import json
+import uuid
+import time
+import shutil
+import sqlite3
+import logging
+import threading
+from datetime import datetime, timedelta
+from sheet_cache import hash_file
+from omr_archive import without_crops
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+JOB_DB_PATH = os.getenv('JOB_DB_PATH', os.path.join('uploads', 'jobs.sqlite3'))
+JOB_SPOOL_DIR = os.getenv('JOB_SPOOL_DIR', os.path.join('uploads', 'jobs'))
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))  # Threads feeding sheets to the sheet pool
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '5'))  # Seconds between idle queue checks
+JOB_STORE_ATTEMPTS = int(os.getenv('JOB_STORE_ATTEMPTS', '5'))  # Tries at storing a sheet's results before it fails
+JOB_STORE_RETRY_DELAY = float(os.getenv('JOB_STORE_RETRY_DELAY', '30'))  # Seconds before the first retry, doubling after
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    batch_code TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS job_sheets (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL REFERENCES jobs(id),
+    batch_code TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    file_name TEXT NOT NULL,
+    file_path TEXT NOT NULL,
+    is_pdf INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'pending',
+    result TEXT,
+    error TEXT,
+    store_attempts INTEGER NOT NULL DEFAULT 0,
+    retry_at TEXT,
+    owner INTEGER,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_job_sheets_status ON job_sheets (status, id);
+CREATE INDEX IF NOT EXISTS idx_job_sheets_job ON job_sheets (job_id);
+CREATE INDEX IF NOT EXISTS idx_job_sheets_batch ON job_sheets (batch_code, status);
+"""
+
+
+def _now():
+    return datetime.now().isoformat()
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _is_complete(counts):
+    return not counts.get('pending') and not counts.get('processing') and not counts.get('uploading')
+
+
+class JobQueue:
+    """Durable SQLite-backed queue of uploaded sheets processed by background threads"""
+
+    def __init__(self, pool, on_sheet_done=None, db_path=JOB_DB_PATH, spool_dir=JOB_SPOOL_DIR,
+                 workers=JOB_WORKERS, poll_interval=JOB_POLL_INTERVAL, sheet_cache=None):
+        self.pool = pool
+        self.on_sheet_done = on_sheet_done
+        self.sheet_cache = sheet_cache
+        self.db_path = db_path
+        self.spool_dir = spool_dir
+        self.workers = max(1, workers)
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Condition()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._local = threading.local()
+        self._next_reclaim = 0
+
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        os.makedirs(spool_dir, exist_ok=True)
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        # Queues created before store retries existed
+        columns = {row['name'] for row in conn.execute("PRAGMA table_info(job_sheets)")}
+        if 'store_attempts' not in columns:
+            conn.execute("ALTER TABLE job_sheets ADD COLUMN store_attempts INTEGER NOT NULL DEFAULT 0")
+            conn.execute("ALTER TABLE job_sheets ADD COLUMN retry_at TEXT")
+        if 'owner' not in columns:
+            conn.execute("ALTER TABLE job_sheets ADD COLUMN owner INTEGER")
+        conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def _conn(self):
+        """One SQLite connection per thread, reopened in forked children"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._local.conn = self._connect()
+            self._local.pid = os.getpid()
+        return conn
+
+    def start(self, requeue=True):
+        """Requeue sheets interrupted by a restart and start the worker threads
+
+        Processes sharing the queue pass requeue=False and let the parent requeue once
+        before they start, so no process requeues sheets another is still working on.
+        """
+        if self._threads:
+            return
+
+        if requeue:
+            self.requeue_interrupted()
+
+        self._stopping.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'omr-job-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def requeue_interrupted(self, owner=None):
+        """Return sheets being processed to pending: every one, or only those claimed by the process owner"""
+        where, params = "status = 'processing'", ()
+        if owner is not None:
+            where, params = where + " AND owner = ?", (owner,)
+        requeued = self._conn().execute(
+            f"UPDATE job_sheets SET status = 'pending', owner = NULL, updated_at = ? WHERE {where}",
+            (_now(),) + params).rowcount
+        if requeued:
+            logger.info(f"Requeued {requeued} interrupted sheets" + (f" of process {owner}" if owner else ''))
+        return requeued
+
+    def requeue_abandoned(self):
+        """Requeue sheets whose claiming process has died, e.g. a worker killed mid-sheet"""
+        owners = [row['owner'] for row in self._conn().execute(
+            "SELECT DISTINCT owner FROM job_sheets WHERE status = 'processing' AND owner IS NOT NULL")]
+        for owner in owners:
+            if not _alive(owner):
+                self.requeue_interrupted(owner)
+
+    def stop(self):
+        self._stopping.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def enqueue(self, batch_code, uploads, job_id=None, first_position=0):
+        """Persist uploads and queue one sheet per file
+
+        uploads is a list of (file_name, is_pdf, save) where save(path) writes the file's bytes;
+        a file's position in the list, after first_position, is the batch subject it belongs to.
+        With job_id the sheets are added to that existing job instead of a new one.
+        """
+        new_job = job_id is None
+        job_id = job_id or uuid.uuid4().hex
+        job_dir = os.path.join(self.spool_dir, job_id)
+
+        rows = []
+        try:
+            for seq, (file_name, is_pdf, save) in enumerate(uploads, start=first_position):
+                os.makedirs(job_dir, exist_ok=True)
+                path = os.path.join(job_dir, f'{seq}{os.path.splitext(file_name)[1]}')
+                save(path)
+                rows.append((job_id, batch_code, seq, file_name, path, int(is_pdf), _now()))
+        except Exception:
+            if new_job:
+                shutil.rmtree(job_dir, ignore_errors=True)
+            else:
+                for row in rows:
+                    os.remove(row[4])
+            raise
+
+        conn = self._conn()
+        conn.execute('BEGIN')
+        if new_job:
+            conn.execute("INSERT INTO jobs (id, batch_code, created_at) VALUES (?, ?, ?)",
+                         (job_id, batch_code, _now()))
+        conn.executemany("""
+            INSERT INTO job_sheets (job_id, batch_code, position, file_name, file_path, is_pdf, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        conn.execute('COMMIT')
+
+        # Never requeue here: other processes may be working on their claimed sheets
+        self.start(requeue=False)
+        with self._wakeup:
+            self._wakeup.notify_all()
+        return job_id
+
+    def _claim(self):
+        """Atomically move the oldest pending sheet to processing"""
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute("""
+                SELECT * FROM job_sheets WHERE status = 'pending' AND (retry_at IS NULL OR retry_at <= ?)
+                ORDER BY id LIMIT 1
+            """, (_now(),)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE job_sheets SET status = 'processing', owner = ?, updated_at = ? WHERE id = ?",
+                             (os.getpid(), _now(), row['id']))
+            conn.execute('COMMIT')
+            return row
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                if time.monotonic() >= self._next_reclaim:
+                    self._next_reclaim = time.monotonic() + self.poll_interval
+                    self.requeue_abandoned()
+                sheet = self._claim()
+            except Exception as e:
+                logger.error(f"Job queue error: {e}")
+                sheet = None
+
+            if sheet is None:
+                with self._wakeup:
+                    self._wakeup.wait(self.poll_interval)
+                continue
+
+            self._process(sheet)
+
+    def _process(self, sheet):
+        # A sheet whose results could not be stored last time is not processed again
+        result = json.loads(sheet['result']) if sheet['store_attempts'] and sheet['result'] else None
+        if result is None:
+            try:
+                # Files already processed byte-for-byte reuse the stored result
+                key = self.sheet_cache.key(hash_file(sheet['file_path'])) if self.sheet_cache else None
+                result = self.sheet_cache.get(key) if key else None
+                if result is None:
+                    result = self.pool.submit(sheet['file_path'], bool(sheet['is_pdf'])).result()
+                    if key:
+                        self.sheet_cache.put(key, result)
+            except Exception as e:
+                logger.error(f"Error processing sheet {sheet['file_name']}: {e}")
+                result = self.pool.processor.failed_result(str(e))
+
+        if self.on_sheet_done:
+            try:
+                self.on_sheet_done(sheet['batch_code'], sheet['position'], sheet['file_name'], result)
+            except Exception as e:
+                self._store_failed(sheet, result, e)
+                return
+
+        # Bubble crops are kept in the batch's crop archive, not in the job record
+        status = 'processed' if result.get('success') else 'failed'
+        self._conn().execute(
+            "UPDATE job_sheets SET status = ?, result = ?, error = ?, updated_at = ? WHERE id = ?",
+            (status, json.dumps(without_crops(result)), result.get('error'), _now(), sheet['id']))
+
+        # The spooled upload is no longer needed once its result is stored
+        self._remove_spooled(sheet)
+
+    @staticmethod
+    def _remove_spooled(sheet):
+        if os.path.exists(sheet['file_path']):
+            os.remove(sheet['file_path'])
+        try:
+            os.rmdir(os.path.dirname(sheet['file_path']))
+        except OSError:
+            pass
+
+    def _store_failed(self, sheet, result, error):
+        """Keep a sheet whose results were not stored pending, with backoff, until its attempts run out
+
+        The spooled file is kept for the retries and deleted once they run out; the failed
+        sheet's full result stays in its job record.
+        """
+        attempts = sheet['store_attempts'] + 1
+        if attempts < JOB_STORE_ATTEMPTS:
+            retry_at = datetime.now() + timedelta(seconds=JOB_STORE_RETRY_DELAY * 2 ** (attempts - 1))
+            logger.error(f"Error storing results for {sheet['file_name']} (attempt {attempts}), "
+                         f"retrying at {retry_at:%H:%M:%S}: {error}")
+            status, retry_at = 'pending', retry_at.isoformat()
+        else:
+            logger.error(f"Giving up storing results for {sheet['file_name']} after {attempts} attempts: {error}")
+            status, retry_at = 'failed', None
+
+        # The full result, crops included, is kept for the retry
+        self._conn().execute("""
+            UPDATE job_sheets SET status = ?, result = ?, error = ?, store_attempts = ?, retry_at = ?, updated_at = ?
+            WHERE id = ?
+        """, (status, json.dumps(result), f'Could not store results: {error}', attempts, retry_at, _now(),
+              sheet['id']))
+        if status == 'failed':
+            self._remove_spooled(sheet)
+
+    def _status_counts(self, where, params):
+        rows = self._conn().execute(
+            f"SELECT status, COUNT(*) AS n FROM job_sheets WHERE {where} GROUP BY status", params)
+        return {row['status']: row['n'] for row in rows}
+
+    def job_status(self, job_id, uploading=0):
+        """Per-sheet state of one job, or None if it does not exist
+
+        uploading is the number of the job's files still being uploaded, which keep it incomplete.
+        """
+        conn = self._conn()
+        job = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if job is None:
+            return None
+
+        sheets = conn.execute("""
+            SELECT file_name, status, result, error, updated_at
+            FROM job_sheets WHERE job_id = ? ORDER BY id
+        """, (job_id,)).fetchall()
+        counts = self._status_counts('job_id = ?', (job_id,))
+        if uploading:
+            counts['uploading'] = uploading
+
+        return {
+            'jobId': job['id'],
+            'batchCode': job['batch_code'],
+            'createdAt': job['created_at'],
+            'totalSheets': len(sheets) + uploading,
+            'statusCounts': counts,
+            'isComplete': _is_complete(counts),
+            'sheets': [{
+                'filename': sheet['file_name'],
+                'status': sheet['status'],
+                'result': without_crops(json.loads(sheet['result'])) if sheet['result'] else None,
+                'error': sheet['error'],
+                'updatedAt': sheet['updated_at']
+            } for sheet in sheets]
+        }
+
+    def batch_status(self, batch_code, uploading=0):
+        """Sheet progress across every job of a batch, or None if nothing was queued or is uploading for it"""
+        counts = self._status_counts('batch_code = ?', (batch_code,))
+        if uploading:
+            counts['uploading'] = uploading
+        if not counts:
+            return None
+
+        return {
+            'batchCode': batch_code,
+            'totalSheets': sum(counts.values()),
+            'statusCounts': counts,
+            'isComplete': _is_complete(counts)
+        }
+
+    def backlog(self):
+        """Number of sheets waiting for or undergoing processing"""
+        counts = self._status_counts("status IN ('pending', 'processing')", ())
+        return sum(counts.values())
@@ -0,0 +1,341 @@
+"""Prometheus metrics for /api/metrics, optionally shared by the processes of one server.
+
+Each process records into its own registry. With OMR_METRICS_DIR set, every
+process writes a snapshot of its metrics there each OMR_METRICS_SYNC_INTERVAL
+seconds and any process renders the merged view: counters and histograms summed,
+per-process gauges labelled with the pid. The counts of processes that exit are
+folded into one archive file by mark_process_dead, so they are neither lost nor
+left behind as one file per recycled worker.
+"""
+import os
+import json
+import time
+import fcntl
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+METRICS_DIR = os.getenv('OMR_METRICS_DIR', '')  # Shared snapshot directory; empty keeps metrics per process
+METRICS_SYNC_INTERVAL = float(os.getenv('OMR_METRICS_SYNC_INTERVAL', '1'))  # Seconds between snapshots
+
+ARCHIVE_FILE = 'archive.json'
+LOCK_FILE = '.lock'
+
+# Latency buckets in seconds, from a single bubble row up to a large PDF
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        self.registry = None
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        if self.registry is not None:
+            self.registry.changed()
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def merge(values, other):
+        for key, value in other.items():
+            values[key] = values.get(key, 0) + value
+
+    def render(self, values=None):
+        values = self.snapshot() if values is None else values
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for key, value in sorted(values.items()):
+            lines.append(f'{self.name}{_labels(self.labelnames, key)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+        self.registry = None
+
+    def observe(self, seconds, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # Cumulative bucket counts, sum, count
+                series = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[0][i] += 1
+            series[1] += seconds
+            series[2] += 1
+        if self.registry is not None:
+            self.registry.changed()
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            return {key: [list(counts), total, count] for key, (counts, total, count) in self._values.items()}
+
+    @staticmethod
+    def merge(values, other):
+        for key, (counts, total, count) in other.items():
+            series = values.setdefault(key, [[0] * len(counts), 0.0, 0])
+            series[0] = [a + b for a, b in zip(series[0], counts)]
+            series[1] += total
+            series[2] += count
+
+    def render(self, values=None):
+        values = self.snapshot() if values is None else values
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for key, (counts, total, count) in sorted(values.items()):
+            for bound, value in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{_labels(self.labelnames, key, [("le", bound)])} {value}')
+            lines.append(f'{self.name}_bucket{_labels(self.labelnames, key, [("le", "+Inf")])} {count}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, key)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, key)} {count}')
+        return lines
+
+
+class Gauge:
+    """Value read from a callback at scrape time
+
+    A per-process gauge is labelled with each process's pid when metrics are shared;
+    one read from shared state (the job queue) is only read by the scraped process.
+    """
+
+    def __init__(self, name, help, read, per_process=True):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.per_process = per_process
+
+    def snapshot(self):
+        return {(str(os.getpid()),): self.read()}
+
+    @staticmethod
+    def merge(values, other):
+        values.update(other)
+
+    def render(self, values=None):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        if values is None:
+            return lines + [f'{self.name} {self.read()}']
+        for key, value in sorted(values.items()):
+            lines.append(f'{self.name}{_labels(("pid",), key)} {value}')
+        return lines
+
+
+class Registry:
+    """Metrics rendered in the Prometheus text exposition format, merged across processes with a directory"""
+
+    def __init__(self, directory=METRICS_DIR, sync_interval=METRICS_SYNC_INTERVAL):
+        self.directory = directory
+        self.sync_interval = sync_interval
+        self._metrics = {}
+        self._sync_pid = None
+        self._sync_lock = threading.Lock()
+
+    def _add(self, metric):
+        metric = self._metrics.setdefault(metric.name, metric)
+        metric.registry = self
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, read, per_process=True):
+        self._metrics[name] = Gauge(name, help, read, per_process)
+        return self._metrics[name]
+
+    def _shared(self, metric):
+        return not isinstance(metric, Gauge) or metric.per_process
+
+    def changed(self):
+        """Start this process's snapshot thread on its first update; threads do not survive a fork"""
+        if not self.directory or self._sync_pid == os.getpid():
+            return
+        with self._sync_lock:
+            if self._sync_pid == os.getpid():
+                return
+            self._sync_pid = os.getpid()
+            os.makedirs(self.directory, exist_ok=True)
+            threading.Thread(target=self._sync_loop, name='omr-metrics-sync', daemon=True).start()
+            atexit.register(self.write_snapshot)
+
+    def _sync_loop(self):
+        while True:
+            try:
+                self.write_snapshot()
+            except Exception as e:
+                logger.error(f"Could not write metrics snapshot: {e}")
+            time.sleep(self.sync_interval)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def snapshot(self):
+        """{name: {label values: value}} of this process's shared metrics"""
+        snapshot = {}
+        for metric in self._metrics.values():
+            if self._shared(metric):
+                try:
+                    snapshot[metric.name] = metric.snapshot()
+                except Exception as e:
+                    logger.error(f"Could not read metric {metric.name}: {e}")
+        return snapshot
+
+    def write_snapshot(self):
+        # Written whole and renamed, so readers never see a partial snapshot
+        path = self._path(f'{os.getpid()}.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self._encode(self.snapshot()), f)
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def _encode(snapshot):
+        return {name: [[list(key), value] for key, value in values.items()] for name, values in snapshot.items()}
+
+    def _read(self, name):
+        try:
+            with open(self._path(name)) as f:
+                return {metric: {tuple(key): value for key, value in values}
+                        for metric, values in json.load(f).items()}
+        except (OSError, ValueError):
+            return {}
+
+    def _merge(self, merged, snapshot, gauges=True):
+        for name, values in snapshot.items():
+            metric = self._metrics.get(name)
+            if metric is None or not self._shared(metric) or (isinstance(metric, Gauge) and not gauges):
+                continue
+            metric.merge(merged.setdefault(name, {}), values)
+
+    def _locked(self, mode):
+        os.makedirs(self.directory, exist_ok=True)
+        lock = open(self._path(LOCK_FILE), 'a')
+        fcntl.flock(lock, mode)
+        return lock
+
+    def merged(self):
+        """This process's live metrics plus the snapshots of every other and every exited process"""
+        merged = {}
+        self._merge(merged, self.snapshot())
+        own = f'{os.getpid()}.json'
+        with self._locked(fcntl.LOCK_SH):
+            self._merge(merged, self._read(ARCHIVE_FILE), gauges=False)
+            for name in os.listdir(self.directory):
+                if not name.endswith('.json') or name in (own, ARCHIVE_FILE):
+                    continue
+                # Gauges of a process that stopped writing snapshots are no longer current
+                try:
+                    fresh = time.time() - os.path.getmtime(self._path(name)) < 5 * self.sync_interval
+                except OSError:
+                    continue
+                self._merge(merged, self._read(name), gauges=fresh)
+        return merged
+
+    def mark_process_dead(self, pid):
+        """Fold an exited process's counters and histograms into the archive and drop its snapshot"""
+        if not self.directory:
+            return
+        name = f'{pid}.json'
+        with self._locked(fcntl.LOCK_EX):
+            if not os.path.exists(self._path(name)):
+                return
+            archive = self._read(ARCHIVE_FILE)
+            self._merge(archive, self._read(name), gauges=False)
+            path = self._path(ARCHIVE_FILE)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(self._encode(archive), f)
+            os.replace(path + '.tmp', path)
+            os.remove(self._path(name))
+
+    def clear(self):
+        """Remove every snapshot; called once when a server starts"""
+        if not self.directory or not os.path.isdir(self.directory):
+            return
+        with self._locked(fcntl.LOCK_EX):
+            for name in os.listdir(self.directory):
+                if name.endswith(('.json', '.tmp')):
+                    os.remove(self._path(name))
+
+    def render(self):
+        merged = self.merged() if self.directory else None
+        lines = []
+        for metric in self._metrics.values():
+            if merged is None or not self._shared(metric):
+                lines.extend(metric.render())
+            else:
+                lines.extend(metric.render(merged.get(metric.name, {})))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram('omr_stage_seconds', 'Time spent in each sheet processing stage', ('stage',))
+SHEETS = registry.counter('omr_sheets_processed_total', 'Sheets processed by outcome', ('status',))
+FALLBACK_RATINGS = registry.counter('omr_fallback_ratings_total', 'Questions given the neutral rating because no mark was detected')
+REQUEST_SECONDS = registry.histogram('omr_http_request_seconds', 'Flask request latency', ('method', 'endpoint', 'status'))
+DB_CONNECT_SECONDS = registry.histogram('omr_db_connect_seconds', 'Time to check out a pooled database connection')
+DB_WRITE_SECONDS = registry.histogram('omr_db_write_seconds', 'Time to flush buffered sheet rows to the database')
+
+
+@contextmanager
+def timed(timings, stage):
+    """Add the time spent in the block to timings[stage]; timings may be None"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+def record_sheet(result):
+    """Count one sheet result and observe its stage timings
+
+    Timings travel inside the result so sheets processed in pool workers are
+    recorded by the parent process.
+    """
+    for stage, seconds in result.get('timings', {}).items():
+        STAGE_SECONDS.observe(seconds, stage=stage)
+    SHEETS.inc(status='processed' if result.get('success') else 'failed')
+    if result.get('fallback_ratings'):
+        FALLBACK_RATINGS.inc(result['fallback_ratings'])
@@ -0,0 +1,192 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from omr_metrics import record_sheet
+from omr_templates import TEMPLATE_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+POOL_WORKERS = int(os.getenv('OMR_POOL_WORKERS', '0'))  # 0 processes sheets in the request thread
+POOL_CHUNK_SIZE = int(os.getenv('OMR_POOL_CHUNK_SIZE', '4'))  # PDF pages per worker task
+POOL_TASK_TIMEOUT = float(os.getenv('OMR_POOL_TASK_TIMEOUT', '120'))  # Seconds per worker task
+
+# Per-process processors keyed by template, the default one built by the worker initializer
+_processors = OrderedDict()
+_processors_lock = threading.Lock()
+
+
+def _processor_from(processors, template=None):
+    """Processor for a template from an LRU of the TEMPLATE_CACHE_SIZE most recent, built on a miss"""
+    key = template.key if template is not None else None
+    with _processors_lock:
+        processor = processors.get(key)
+        if processor is not None:
+            processors.move_to_end(key)
+            return processor
+
+    from omr_processor import OMRProcessor
+    processor = OMRProcessor(template)
+    with _processors_lock:
+        processors[key] = processor
+        processors.move_to_end(key)
+        # Old template versions would otherwise stay compiled in every process
+        while len(processors) > max(1, TEMPLATE_CACHE_SIZE):
+            processors.popitem(last=False)
+    return processor
+
+
+def _get_processor(template=None):
+    return _processor_from(_processors, template)
+
+
+def _init_worker():
+    """Build the default processor and load OpenCV before the first task arrives"""
+    processor = _get_processor()
+    processor.warm_up()
+
+
+def _ping():
+    return os.getpid()
+
+
+def _process_image(source, template=None, profile=None):
+    return _get_processor(template).process_source(source, profile=profile)
+
+
+def _process_pdf_pages(pdf_path, first_page, last_page, template=None, profile=None):
+    processor = _get_processor(template)
+    return list(processor.process_pdf_file(pdf_path, first_page=first_page, last_page=last_page, profile=profile))
+
+
+class PendingSheet:
+    """Handle for one submitted file whose result is gathered later"""
+
+    def __init__(self, pool, processor, futures, pdf):
+        self.pool = pool
+        self.processor = processor
+        self.futures = futures
+        self.pdf = pdf
+
+    def _wait(self, future):
+        try:
+            return future.result(timeout=self.pool.task_timeout)
+        except TimeoutError:
+            future.cancel()
+            logger.error(f"Sheet task timed out after {self.pool.task_timeout}s")
+            return self.processor.failed_result('Processing timed out')
+        except Exception as e:
+            logger.error(f"Sheet task failed: {e}")
+            return self.processor.failed_result(str(e))
+
+    def result(self):
+        if not self.pdf:
+            result = self._wait(self.futures[0])
+        else:
+            # Reassemble page windows in page order
+            sheets = []
+            for future in self.futures:
+                pages = self._wait(future)
+                sheets.extend(pages if isinstance(pages, list) else [pages])
+            result = self.processor.summarize_sheets(sheets)
+        
+        for sheet in result.get('sheets', [result]):
+            record_sheet(sheet)
+        return result
+
+
+class _Completed:
+    """Future-like wrapper for work done inline when the pool is disabled"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def result(self, timeout=None):
+        return self.value
+
+    def cancel(self):
+        return False
+
+
+class SheetPool:
+    """Process pool that fans sheet decoding and detection out across cores"""
+
+    def __init__(self, workers=POOL_WORKERS, chunk_size=POOL_CHUNK_SIZE, task_timeout=POOL_TASK_TIMEOUT):
+        self.workers = workers
+        self.chunk_size = max(1, chunk_size)
+        self.task_timeout = task_timeout
+        self._processors = OrderedDict()
+        self._executor = None
+        self._restart_lock = threading.Lock()
+
+    @property
+    def processor(self):
+        """Processor for the built-in template; OpenCV is imported on first use"""
+        return self.processor_for()
+
+    @property
+    def enabled(self):
+        return self.workers > 0
+
+    def start(self):
+        """Start the worker processes and wait until each one is warmed up"""
+        if not self.enabled or self._executor is not None:
+            return
+        
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+        pids = {f.result() for f in [self._executor.submit(_ping) for _ in range(self.workers)]}
+        logger.info(f"Sheet pool started with {len(pids)} warm workers")
+
+    def _submit(self, fn, *args):
+        """Submit a task, replacing the executor once if a dead worker has broken it"""
+        executor = self._executor
+        try:
+            return executor.submit(fn, *args)
+        except BrokenProcessPool:
+            with self._restart_lock:
+                # Another thread may already have replaced it
+                if self._executor is executor:
+                    logger.error("Sheet pool is broken (a worker died); restarting it")
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    self._executor = None
+                    self.start()
+            return self._executor.submit(fn, *args)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    def processor_for(self, template=None):
+        """Processor for a compiled template, reused across submissions"""
+        return _processor_from(self._processors, template)
+
+    def submit(self, source, pdf=False, template=None, profile=None):
+        """Queue a file path or encoded image buffer and return a PendingSheet"""
+        processor = self.processor_for(template)
+        if not self.enabled:
+            return PendingSheet(self, processor, [_Completed(processor.process_source(source, pdf, profile))], False)
+        
+        self.start()
+        if not pdf:
+            # Buffers must be copied into bytes to cross the process boundary
+            if not isinstance(source, str):
+                source = bytes(source)
+            return PendingSheet(self, processor, [self._submit(_process_image, source, template, profile)], pdf)
+        
+        # Split the PDF into page windows so pages of one file run in parallel
+        try:
+            page_count = processor.pdf_page_count(source)
+        except Exception as e:
+            logger.error(f"Error converting PDF: {e}")
+            failed = [processor.failed_result(f'Could not process PDF: {e}')]
+            return PendingSheet(self, processor, [_Completed(failed)], pdf)
+        
+        futures = []
+        for first_page in range(1, page_count + 1, self.chunk_size):
+            last_page = min(first_page + self.chunk_size - 1, page_count)
+            futures.append(self._submit(_process_pdf_pages, source, first_page, last_page, template, profile))
+        return PendingSheet(self, processor, futures, pdf)
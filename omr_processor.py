@@ -0,0 +1,508 @@
+import os
+import logging
+import subprocess
+import time
+import cv2
+import numpy as np
+import pdf2image
+from omr_engine import FILL_THRESHOLD, compile_bubble_grid, rate_batch
+from omr_templates import default_template
+from omr_align import SheetAligner
+from omr_metrics import timed
+from omr_archive import CROP_ARCHIVE, encode_crops
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+PDF_PAGE_WINDOW = int(os.getenv('PDF_PAGE_WINDOW', '4'))  # PDF pages rasterized at a time
+ROI_PREPROCESS = os.getenv('OMR_ROI_PREPROCESS', 'true').lower() == 'true'  # Threshold only the bubble rows
+DECODE_MODE = os.getenv('OMR_DECODE_MODE', 'color')  # color, gray, reduced2, reduced4 or reduced8
+PDF_DPI = int(os.getenv('PDF_DPI', '200'))  # Resolution template coordinates are laid out at (pdf2image's default)
+PDF_COARSE_DPI = int(os.getenv('PDF_COARSE_DPI', '0'))  # First-pass grayscale DPI; 0 rasterizes once at PDF_DPI
+PDF_REFINE_MARGIN = float(os.getenv('PDF_REFINE_MARGIN', '0.1'))  # Fill ratios this close to the threshold are re-read
+PDF_COARSE_INSET = float(os.getenv('PDF_COARSE_INSET', '0.2'))  # Box fraction trimmed per side in the coarse pass
+PDF_RASTER_TIMEOUT = float(os.getenv('PDF_RASTER_TIMEOUT', '60'))  # Seconds per pdftoppm crop
+DETECT_BATCH_SIZE = int(os.getenv('OMR_DETECT_BATCH_SIZE', '16'))  # Pages scored together by process_batch
+
+# Kernel radii of the blur (2) and adaptive threshold (5), plus a pixel of slack
+ROI_PADDING = 8
+
+# imread flags and downscale factor per decode mode
+DECODE_FLAGS = {
+    'color': (cv2.IMREAD_COLOR, 1),
+    'gray': (cv2.IMREAD_GRAYSCALE, 1),
+    'reduced2': (cv2.IMREAD_REDUCED_GRAYSCALE_2, 2),
+    'reduced4': (cv2.IMREAD_REDUCED_GRAYSCALE_4, 4),
+    'reduced8': (cv2.IMREAD_REDUCED_GRAYSCALE_8, 8)
+}
+
+class OMRProcessor:
+    def __init__(self, template=None, decode_mode=DECODE_MODE, roi=ROI_PREPROCESS):
+        # Compiled bubble layout; defaults to the built-in 5 x 5 feedback form
+        self.template = template or default_template()
+        self.decode_flags, self.reduction = DECODE_FLAGS[decode_mode]
+        self.roi = roi
+        self.question_regions = self.template.question_regions
+        self.questions = self.template.questions
+        
+        # Registration-mark alignment, only for templates that define calibration points
+        self.aligner = SheetAligner(self.template) if self.template.calibration_points else None
+
+    def warm_up(self):
+        """Load OpenCV so the first sheet pays no setup cost"""
+        self.preprocess_image(np.zeros((16, 16, 3), dtype=np.uint8))
+
+    def preprocess_image(self, image, grid=None):
+        """Preprocess image for better OMR detection
+        
+        With a grid and ROI preprocessing on, only the padded bubble rows are
+        converted and thresholded; every bubble pixel comes out as on the full page.
+        """
+        if grid is None or not self.roi:
+            return self._threshold(self._gray(image))
+        
+        thresh = np.zeros(image.shape[:2], dtype=np.uint8)
+        for y0, y1, x0, x1 in grid.bands(image.shape, ROI_PADDING):
+            thresh[y0:y1, x0:x1] = self._threshold(self._gray(image[y0:y1, x0:x1]))
+        return thresh
+
+    def _gray(self, image):
+        # Convert to grayscale unless the image was decoded as grayscale
+        if image.ndim == 2:
+            return image
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    def _threshold(self, gray):
+        # Apply Gaussian blur to reduce noise
+        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+        
+        # Apply adaptive threshold for better contrast
+        thresh = cv2.adaptiveThreshold(blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
+                                     cv2.THRESH_BINARY_INV, 11, 2)
+        
+        return thresh
+
+    def detect_filled_circles(self, image, regions, grid=None, timings=None):
+        """Detect filled circles/marks in specified regions"""
+        # Score every bubble at once from the compiled (or aligned) template grid
+        if grid is None:
+            if regions is self.question_regions:
+                grid = self.template.grid
+            else:
+                grid = compile_bubble_grid(regions)
+        
+        with timed(timings, 'preprocess'):
+            processed_image = self.preprocess_image(image, grid)
+        with timed(timings, 'detect'):
+            return grid.score(processed_image)
+
+    def reduced_grid(self, reduction):
+        """Template grid scaled down for an image decoded at 1/reduction size"""
+        return compile_bubble_grid([[(round(x / reduction), round(y / reduction),
+                                      max(1, round(w / reduction)), max(1, round(h / reduction)))
+                                     for x, y, w, h in question] for question in self.question_regions])
+
+    def calculate_ratings(self, detection_results):
+        """Calculate ratings based on detection results"""
+        ratings = []
+        
+        for i, question_results in enumerate(detection_results):
+            # Find the highest confidence marked option
+            marked_options = [r for r in question_results if r['is_marked']]
+            
+            if marked_options:
+                # Select the option with highest confidence
+                best_option = max(marked_options, key=lambda x: x['confidence'])
+                rating = best_option['option']
+                confidence = best_option['confidence']
+            else:
+                # No clear marking detected, assign neutral rating
+                rating = (len(question_results) + 1) // 2
+                confidence = 0.1
+            
+            ratings.append({
+                'question': self.questions[i],
+                'rating': rating,
+                'confidence': confidence,
+                'percentage': (rating / len(question_results)) * 100
+            })
+        
+        return ratings
+
+    def calculate_ratings_batch(self, scores, valid):
+        """Ratings of N sheets from an (N, questions, options) score tensor, as calculate_ratings gives them"""
+        counts = self.template.grid.options_per_question
+        ratings, confidences, fallback = rate_batch(scores, valid, counts)
+        sheets = []
+        for sheet_ratings, sheet_confidences in zip(ratings.tolist(), confidences.tolist()):
+            sheets.append([{
+                'question': question,
+                'rating': rating,
+                'confidence': confidence,
+                'percentage': (rating / count) * 100
+            } for question, rating, confidence, count in zip(self.questions, sheet_ratings, sheet_confidences, counts)])
+        return sheets, fallback.sum(axis=1).tolist()
+
+    def process_batch(self, images, profile=None, reduction=1, batch_size=DETECT_BATCH_SIZE, timings=None):
+        """Process decoded sheets together, returning one result per image
+        
+        Each sheet is aligned and thresholded on its own; sheets that share a bubble grid
+        and page size are then scored batch_size at a time in one vectorized reduction
+        over their stacked bubble strips. timings, if given, is one dict per image.
+        """
+        timings = timings or [{} for _ in images]
+        results = [None] * len(images)
+        batch_size = max(1, batch_size)
+        
+        for start in range(0, len(images), batch_size):
+            prepared = {}
+            for i in range(start, min(start + batch_size, len(images))):
+                try:
+                    prepared[i] = self._prepare_sheet(images[i], profile, reduction, timings[i])
+                except Exception as e:
+                    logger.error(f"Error processing image: {e}")
+                    results[i] = self.failed_result(str(e))
+            self._score_prepared(prepared, results, timings)
+        
+        return results
+
+    def _prepare_sheet(self, image, profile, reduction, timings):
+        """Align and threshold one sheet for batch scoring: (grid, page shape, bubble strip, alignment, crops)"""
+        if image is None or image.size == 0:
+            raise ValueError("Could not load image")
+        with timed(timings, 'align'):
+            grid, alignment = self.grid_for(image, profile, reduction)
+        with timed(timings, 'preprocess'):
+            binary = self.preprocess_image(image, grid)
+            y0, y1, x0, x1 = grid.strip(binary.shape)
+            # Copied, so the page itself can be freed while the batch fills
+            strip = binary[y0:y1, x0:x1].copy()
+        crops = self._crops(grid, binary, timings)
+        return grid, binary.shape, strip, alignment, crops
+
+    def _score_prepared(self, prepared, results, timings):
+        """Score prepared sheets ({index: _prepare_sheet output}) into results, a vectorized pass per grid and shape"""
+        groups = {}
+        for i, (grid, shape, strip, alignment, crops) in prepared.items():
+            groups.setdefault((id(grid), shape), (grid, shape, []))[2].append((i, strip, alignment, crops))
+        
+        for grid, shape, members in groups.values():
+            detect_start = time.perf_counter()
+            scores, valid = grid.score_batch(np.stack([member[1] for member in members]), shape)
+            detect_seconds = (time.perf_counter() - detect_start) / len(members)
+            
+            rate_start = time.perf_counter()
+            sheet_ratings, fallbacks = self.calculate_ratings_batch(scores, valid)
+            rate_seconds = (time.perf_counter() - rate_start) / len(members)
+            
+            for (i, _, alignment, crops), ratings, fallback in zip(members, sheet_ratings, fallbacks):
+                # The batch's time is shared evenly between its sheets
+                timings[i]['detect'] = timings[i].get('detect', 0.0) + detect_seconds
+                timings[i]['rate'] = timings[i].get('rate', 0.0) + rate_seconds
+                results[i] = self._rated_result(ratings, fallback, alignment, timings[i])
+                if crops:
+                    results[i]['crops'] = crops
+
+    def process_image_array(self, image, profile=None, reduction=1, timings=None):
+        """Process an in-memory BGR or grayscale image and extract OMR data
+        
+        profile names the scanner or feeder the sheet came from, so its alignment
+        can start from the previous sheet's transform. reduction is the factor the
+        image was downscaled by when it was decoded. timings collects seconds per
+        stage and is returned in the result.
+        """
+        timings = {} if timings is None else timings
+        try:
+            if image is None or image.size == 0:
+                raise ValueError("Could not load image")
+            
+            # Warp the bubble coordinates onto the scan
+            with timed(timings, 'align'):
+                grid, alignment = self.grid_for(image, profile, reduction)
+            
+            # Detect filled circles
+            with timed(timings, 'preprocess'):
+                binary = self.preprocess_image(image, grid)
+            with timed(timings, 'detect'):
+                detection_results = grid.score(binary)
+            crops = self._crops(grid, binary, timings)
+            result = self._sheet_result(detection_results, alignment, timings)
+            if crops:
+                result['crops'] = crops
+            return result
+            
+        except Exception as e:
+            logger.error(f"Error processing image: {e}")
+            return self.failed_result(str(e))
+
+    def grid_for(self, image, profile=None, reduction=1):
+        """Bubble grid for one sheet, aligned when the template has registration marks"""
+        grid, alignment = None, None
+        if self.aligner:
+            grid, alignment = self.aligner.align(image, profile, 1 / reduction)
+        if reduction != 1 and alignment in (None, 'none'):
+            grid = self.reduced_grid(reduction)
+        if grid is None:
+            grid = self.template.grid
+        return grid, alignment
+
+    def _crops(self, grid, binary, timings=None):
+        """Archived bubble crops of a thresholded sheet, or None when archiving is off"""
+        if not CROP_ARCHIVE:
+            return None
+        with timed(timings, 'crops'):
+            return encode_crops(grid, binary)
+
+    def _sheet_result(self, detection_results, alignment=None, timings=None):
+        # Calculate ratings
+        with timed(timings, 'rate'):
+            ratings = self.calculate_ratings(detection_results)
+        
+        fallback = sum(1 for question in detection_results if not any(r and r['is_marked'] for r in question))
+        return self._rated_result(ratings, fallback, alignment, timings)
+
+    def _rated_result(self, ratings, fallback, alignment=None, timings=None):
+        result = {
+            'success': True,
+            'ratings': ratings,
+            'overall_score': sum(r['rating'] for r in ratings) / len(ratings),
+            'confidence': sum(r['confidence'] for r in ratings) / len(ratings),
+            'fallback_ratings': fallback
+        }
+        if alignment:
+            result['alignment'] = alignment
+        if timings is not None:
+            result['timings'] = timings
+            result['processing_time'] = round(sum(timings.values()) * 1000)
+        return result
+
+    def ambiguous_questions(self, detection_results, margin=PDF_REFINE_MARGIN):
+        """Questions with several marks or a best fill ratio within margin of the threshold"""
+        ambiguous = []
+        for i, question_results in enumerate(detection_results):
+            options = [r for r in question_results if r]
+            if not options:
+                continue
+            marked = sum(1 for r in options if r['is_marked'])
+            best = max(r['fill_percentage'] for r in options)
+            if marked > 1 or abs(best - FILL_THRESHOLD) < margin:
+                ambiguous.append(i)
+        return ambiguous
+
+    def rasterize_region(self, pdf_path, page_number, dpi, box):
+        """Rasterize one grayscale (x, y, w, h) pixel crop of a PDF page with pdftoppm"""
+        x, y, w, h = box
+        output = subprocess.run([
+            'pdftoppm', '-f', str(page_number), '-l', str(page_number), '-r', str(dpi),
+            '-x', str(x), '-y', str(y), '-W', str(w), '-H', str(h), '-gray', pdf_path
+        ], capture_output=True, check=True, timeout=PDF_RASTER_TIMEOUT).stdout
+        return cv2.imdecode(np.frombuffer(output, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+
+    def process_pdf_page(self, pdf_path, page_number, image, profile=None, timings=None):
+        """Score a page rasterized at PDF_COARSE_DPI, re-reading ambiguous questions at PDF_DPI
+        
+        The coarse pass scores bubble interiors, since printed outlines cover more of
+        each box as the resolution drops. Only the bounding box of the ambiguous
+        questions' bubbles is rasterized again.
+        """
+        timings = {} if timings is None else timings
+        try:
+            if image is None or image.size == 0:
+                raise ValueError("Could not load image")
+            
+            reduction = PDF_DPI / PDF_COARSE_DPI
+            with timed(timings, 'align'):
+                grid, alignment = self.grid_for(image, profile, reduction)
+            coarse_grid = grid.inset(PDF_COARSE_INSET)
+            with timed(timings, 'preprocess'):
+                binary = self.preprocess_image(image, coarse_grid)
+            with timed(timings, 'detect'):
+                detection_results = coarse_grid.score(binary)
+            ambiguous = self.ambiguous_questions(detection_results)
+            
+            if ambiguous:
+                # Full-resolution boxes: the template's own unless the page was aligned
+                if alignment in (None, 'none'):
+                    regions = [self.question_regions[i] for i in ambiguous]
+                else:
+                    regions = []
+                    for i in ambiguous:
+                        mask = grid.question_idx == i
+                        regions.append([
+                            (round(x0 * reduction), round(y0 * reduction),
+                             round((x1 - x0) * reduction), round((y1 - y0) * reduction))
+                            for x0, y0, x1, y1 in zip(grid.x0[mask], grid.y0[mask], grid.x1[mask], grid.y1[mask])])
+                
+                # Crop to the affected bubbles, padded for the filter kernels
+                pad = ROI_PADDING + int(np.ceil(reduction))
+                boxes = [box for question in regions for box in question]
+                x = max(0, min(b[0] for b in boxes) - pad)
+                y = max(0, min(b[1] for b in boxes) - pad)
+                w = max(b[0] + b[2] for b in boxes) + pad - x
+                h = max(b[1] + b[3] for b in boxes) + pad - y
+                with timed(timings, 'rasterize'):
+                    crop = self.rasterize_region(pdf_path, page_number, PDF_DPI, (x, y, w, h))
+                
+                shifted = [[(bx - x, by - y, bw, bh) for bx, by, bw, bh in question] for question in regions]
+                fine_results = self.detect_filled_circles(crop, shifted, compile_bubble_grid(shifted), timings)
+                for i, question_results in zip(ambiguous, fine_results):
+                    detection_results[i] = question_results
+            
+            # Whole boxes at the coarse resolution; the padded bands cover them past the inset
+            crops = self._crops(grid, binary, timings)
+            result = self._sheet_result(detection_results, alignment, timings)
+            result['refined_questions'] = len(ambiguous)
+            if crops:
+                result['crops'] = crops
+            return result
+            
+        except Exception as e:
+            logger.error(f"Error processing PDF page {page_number}: {e}")
+            return self.failed_result(str(e))
+
+    def process_image_file(self, image_path, profile=None):
+        """Process an image file and extract OMR data"""
+        timings = {}
+        with timed(timings, 'decode'):
+            image = cv2.imread(image_path, self.decode_flags)
+        return self.process_image_array(image, profile, self.reduction, timings)
+
+    def process_image_buffer(self, buffer, profile=None):
+        """Decode an encoded image from bytes or a memoryview and extract OMR data"""
+        timings = {}
+        with timed(timings, 'decode'):
+            encoded = np.frombuffer(buffer, dtype=np.uint8)
+            image = cv2.imdecode(encoded, self.decode_flags) if encoded.size else None
+        return self.process_image_array(image, profile, self.reduction, timings)
+
+    def convert_pdf_to_images(self, pdf_path):
+        """Convert PDF to images for processing"""
+        try:
+            images = pdf2image.convert_from_path(pdf_path)
+            return [np.array(img) for img in images]
+        except Exception as e:
+            logger.error(f"Error converting PDF: {e}")
+            return []
+
+    def pdf_page_count(self, pdf_path):
+        return pdf2image.pdfinfo_from_path(pdf_path)['Pages']
+
+    def iter_pdf_pages(self, pdf_path, window=PDF_PAGE_WINDOW, first_page=1, last_page=None, dpi=None):
+        """Rasterize a PDF a few pages at a time, yielding (page_number, image)
+        
+        Pages are BGR, or grayscale when a dpi is given for a coarse pass.
+        """
+        if last_page is None:
+            last_page = self.pdf_page_count(pdf_path)
+        window = max(1, window)
+        options = {'dpi': dpi, 'grayscale': True} if dpi else {}
+        
+        for window_start in range(first_page, last_page + 1, window):
+            window_end = min(window_start + window - 1, last_page)
+            pages = pdf2image.convert_from_path(pdf_path, first_page=window_start, last_page=window_end, **options)
+            
+            for offset, page in enumerate(pages):
+                if dpi:
+                    image = np.asarray(page.convert('L'))
+                else:
+                    image = cv2.cvtColor(np.asarray(page), cv2.COLOR_RGB2BGR)
+                page.close()
+                yield window_start + offset, image
+            
+            # Release the window before rasterizing the next one
+            del pages
+
+    def process_pdf_file(self, pdf_path, window=PDF_PAGE_WINDOW, first_page=1, last_page=None, profile=None):
+        """Process every page of a PDF as its own sheet, streaming the rasterization"""
+        # Pages of one PDF come off the same feeder
+        profile = profile or pdf_path
+        try:
+            if PDF_COARSE_DPI:
+                pages = self.iter_pdf_pages(pdf_path, window, first_page, last_page, PDF_COARSE_DPI)
+            else:
+                pages = self.iter_pdf_pages(pdf_path, window, first_page, last_page)
+            
+            # Full-resolution pages are thresholded as they arrive and scored DETECT_BATCH_SIZE at a time;
+            # only their bubble strips wait, so memory stays bounded by the rasterization window
+            batch = []
+            while True:
+                # A window's rasterization is charged to its first page
+                timings = {}
+                with timed(timings, 'rasterize'):
+                    page = next(pages, None)
+                done = page is None
+                
+                if not done and PDF_COARSE_DPI:
+                    page_number, image = page
+                    result = self.process_pdf_page(pdf_path, page_number, image, profile, timings)
+                    result['page'] = page_number
+                    yield result
+                    continue
+                
+                if not done:
+                    page_number, image = page
+                    try:
+                        batch.append((page_number, timings, self._prepare_sheet(image, profile, 1, timings), None))
+                    except Exception as e:
+                        logger.error(f"Error processing image: {e}")
+                        batch.append((page_number, timings, None, self.failed_result(str(e))))
+                    page = image = None
+                if batch and (done or len(batch) >= DETECT_BATCH_SIZE):
+                    results = [failed for _, _, _, failed in batch]
+                    self._score_prepared({i: prepared for i, (_, _, prepared, _) in enumerate(batch)
+                                          if prepared is not None},
+                                         results, [t for _, t, _, _ in batch])
+                    for (page_number, _, _, _), result in zip(batch, results):
+                        result['page'] = page_number
+                        yield result
+                    batch = []
+                if done:
+                    break
+        except Exception as e:
+            logger.error(f"Error converting PDF: {e}")
+            yield self.failed_result(f'Could not process PDF: {e}')
+
+    def process_source(self, source, pdf=False, profile=None):
+        """Process a file path or in-memory encoded image as one subject result"""
+        if pdf:
+            return self.summarize_sheets(self.process_pdf_file(source, profile=profile))
+        if isinstance(source, str):
+            return self.process_image_file(source, profile)
+        return self.process_image_buffer(source, profile)
+
+    def failed_result(self, error):
+        return {
+            'success': False,
+            'error': error,
+            'ratings': [],
+            'overall_score': 0,
+            'confidence': 0
+        }
+
+    def summarize_sheets(self, sheet_results):
+        """Combine per-page sheet results into one subject result"""
+        sheet_results = list(sheet_results)
+        processed = [r for r in sheet_results if r['success']]
+        
+        if not processed:
+            error = sheet_results[0].get('error') if sheet_results else 'PDF has no pages'
+            return {'success': False, 'error': error or 'Could not process PDF', 'sheets': sheet_results}
+        
+        # Average each question's rating and confidence across the processed sheets
+        ratings = []
+        for i, question in enumerate(self.questions):
+            rating = sum(r['ratings'][i]['rating'] for r in processed) / len(processed)
+            ratings.append({
+                'question': question,
+                'rating': rating,
+                'confidence': sum(r['ratings'][i]['confidence'] for r in processed) / len(processed),
+                'percentage': (rating / len(self.question_regions[i])) * 100
+            })
+        
+        return {
+            'success': True,
+            'ratings': ratings,
+            'overall_score': sum(r['overall_score'] for r in processed) / len(processed),
+            'confidence': sum(r['confidence'] for r in processed) / len(processed),
+            'sheets': sheet_results
+        }
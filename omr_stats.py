@@ -0,0 +1,292 @@
+"""Dashboard counters kept up to date by triggers on batches and omr_sheets.
+
+Every statement that writes sheets (SheetWriter flushes, clear_sheets, the Node
+service's manual review updates) adjusts stats_summary and stats_hourly in the
+same transaction, so reading the dashboard sums a few counter rows instead of
+scanning omr_sheets. The counters are sharded by database session so writers do
+not serialize on one row, and hourly throughput only ever grows. Rebuild the
+counters from the raw rows with:
+
+    python omr_stats.py rebuild
+"""
+import sys
+import logging
+import argparse
+from psycopg2.extras import RealDictCursor
+
+logger = logging.getLogger(__name__)
+
+# Hourly throughput buckets returned by fetch_stats
+STATS_HOURS = 24
+# Counter rows per table; each database session updates the one picked by its backend pid,
+# so concurrent writers do not queue on a single row lock until they commit
+STATS_SHARDS = 16
+
+_SHARD = f"pg_backend_pid() % {STATS_SHARDS}"
+
+# Sheet rows as signed changes: +1 for each new row version, -1 for each old one
+_CHANGES = {
+    'INSERT': "SELECT 1 AS sign, status, overall_score FROM new_rows",
+    'DELETE': "SELECT -1 AS sign, status, overall_score FROM old_rows",
+    'UPDATE': """SELECT 1 AS sign, status, overall_score FROM new_rows
+                 UNION ALL
+                 SELECT -1, status, overall_score FROM old_rows"""
+}
+
+# Sheets reaching processed or failed; throughput is append-only, so deletes and
+# re-uploads never take away hours already counted
+_FINISHED = {
+    'INSERT': "SELECT status, processed_at FROM new_rows",
+    'UPDATE': """SELECT n.status, n.processed_at FROM new_rows n LEFT JOIN old_rows o ON o.id = n.id
+                 WHERE o.status IS DISTINCT FROM n.status"""
+}
+
+# Counter columns computed from a set of signed sheet rows
+_SUMMARY_DELTAS = """
+    COALESCE(SUM(sign), 0) AS total_sheets,
+    COALESCE(SUM(sign) FILTER (WHERE status = 'pending'), 0) AS pending_sheets,
+    COALESCE(SUM(sign) FILTER (WHERE status = 'processed'), 0) AS processed_sheets,
+    COALESCE(SUM(sign) FILTER (WHERE status = 'failed'), 0) AS failed_sheets,
+    COALESCE(SUM(sign) FILTER (WHERE status = 'review_needed'), 0) AS review_sheets,
+    COALESCE(SUM(sign * overall_score), 0) AS score_sum,
+    COALESCE(SUM(sign) FILTER (WHERE overall_score IS NOT NULL), 0) AS score_count
+"""
+
+_HOURLY_COUNTS = """
+    date_trunc('hour', processed_at) AS hour,
+    count(*) FILTER (WHERE status = 'processed') AS processed,
+    count(*) FILTER (WHERE status = 'failed') AS failed
+"""
+
+SCHEMA = f"""
+-- Tables from before sharding are replaced; install is followed by a rebuild
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM information_schema.columns
+               WHERE table_name = 'stats_summary' AND column_name = 'id') THEN
+        DROP TABLE stats_summary;
+        DROP TABLE IF EXISTS stats_hourly;
+    END IF;
+END;
+$$;
+
+CREATE TABLE IF NOT EXISTS stats_summary (
+    shard SMALLINT PRIMARY KEY CHECK (shard >= 0 AND shard < {STATS_SHARDS}),
+    total_batches BIGINT NOT NULL DEFAULT 0,
+    total_sheets BIGINT NOT NULL DEFAULT 0,
+    pending_sheets BIGINT NOT NULL DEFAULT 0,
+    processed_sheets BIGINT NOT NULL DEFAULT 0,
+    failed_sheets BIGINT NOT NULL DEFAULT 0,
+    review_sheets BIGINT NOT NULL DEFAULT 0,
+    score_sum NUMERIC NOT NULL DEFAULT 0,
+    score_count BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+INSERT INTO stats_summary (shard) SELECT generate_series(0, {STATS_SHARDS - 1}) ON CONFLICT (shard) DO NOTHING;
+
+CREATE TABLE IF NOT EXISTS stats_hourly (
+    hour TIMESTAMP NOT NULL,
+    shard SMALLINT NOT NULL,
+    processed BIGINT NOT NULL DEFAULT 0,
+    failed BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (hour, shard)
+);
+
+CREATE OR REPLACE FUNCTION omr_stats_sheets() RETURNS trigger AS $$
+DECLARE
+    changes TEXT := CASE TG_OP
+        WHEN 'INSERT' THEN $q${_CHANGES['INSERT']}$q$
+        WHEN 'DELETE' THEN $q${_CHANGES['DELETE']}$q$
+        ELSE $q${_CHANGES['UPDATE']}$q$
+    END;
+BEGIN
+    EXECUTE format($q$
+        UPDATE stats_summary s SET
+            total_sheets = s.total_sheets + d.total_sheets,
+            pending_sheets = s.pending_sheets + d.pending_sheets,
+            processed_sheets = s.processed_sheets + d.processed_sheets,
+            failed_sheets = s.failed_sheets + d.failed_sheets,
+            review_sheets = s.review_sheets + d.review_sheets,
+            score_sum = s.score_sum + d.score_sum,
+            score_count = s.score_count + d.score_count,
+            updated_at = CURRENT_TIMESTAMP
+        FROM (SELECT {_SUMMARY_DELTAS} FROM (%s) changes) d
+        WHERE s.shard = {_SHARD}
+    $q$, changes);
+
+    IF TG_OP <> 'DELETE' THEN
+        EXECUTE format($q$
+            INSERT INTO stats_hourly (hour, shard, processed, failed)
+            SELECT {_HOURLY_COUNTS}, {_SHARD} FROM (%s) changes
+            WHERE processed_at IS NOT NULL AND status IN ('processed', 'failed')
+            GROUP BY 1 ORDER BY 1
+            ON CONFLICT (hour, shard) DO UPDATE SET
+                processed = stats_hourly.processed + EXCLUDED.processed,
+                failed = stats_hourly.failed + EXCLUDED.failed
+        $q$, CASE TG_OP WHEN 'INSERT' THEN $q${_FINISHED['INSERT']}$q$ ELSE $q${_FINISHED['UPDATE']}$q$ END);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION omr_stats_batches() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE stats_summary SET total_batches = total_batches + (SELECT count(*) FROM new_rows),
+                                 updated_at = CURRENT_TIMESTAMP
+        WHERE shard = {_SHARD};
+    ELSE
+        UPDATE stats_summary SET total_batches = total_batches - (SELECT count(*) FROM old_rows),
+                                 updated_at = CURRENT_TIMESTAMP
+        WHERE shard = {_SHARD};
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS omr_stats_sheets_insert ON omr_sheets;
+DROP TRIGGER IF EXISTS omr_stats_sheets_update ON omr_sheets;
+DROP TRIGGER IF EXISTS omr_stats_sheets_delete ON omr_sheets;
+DROP TRIGGER IF EXISTS omr_stats_batches_insert ON batches;
+DROP TRIGGER IF EXISTS omr_stats_batches_delete ON batches;
+
+-- Statement-level, so a flush of hundreds of sheets updates the counters once
+CREATE TRIGGER omr_stats_sheets_insert AFTER INSERT ON omr_sheets
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE omr_stats_sheets();
+CREATE TRIGGER omr_stats_sheets_update AFTER UPDATE ON omr_sheets
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE omr_stats_sheets();
+CREATE TRIGGER omr_stats_sheets_delete AFTER DELETE ON omr_sheets
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE PROCEDURE omr_stats_sheets();
+CREATE TRIGGER omr_stats_batches_insert AFTER INSERT ON batches
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE omr_stats_batches();
+CREATE TRIGGER omr_stats_batches_delete AFTER DELETE ON batches
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE PROCEDURE omr_stats_batches();
+"""
+
+
+def install(conn):
+    """Create the counter tables and triggers; run rebuild afterwards to seed them"""
+    cursor = conn.cursor()
+    cursor.execute(SCHEMA)
+    conn.commit()
+    cursor.close()
+
+
+def rebuild(conn):
+    """Recompute every counter from batches and omr_sheets in one transaction
+
+    Writers are blocked while the tables are scanned, so no change is counted twice or missed.
+    Totals go to shard 0 and the other shards are zeroed. Throughput can only be rebuilt from
+    the sheets still stored, so hours of since-deleted or re-uploaded sheets are lost.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("LOCK TABLE batches, omr_sheets IN SHARE MODE")
+        cursor.execute(f"""
+            UPDATE stats_summary s SET
+                total_batches = (SELECT count(*) FROM batches),
+                total_sheets = d.total_sheets,
+                pending_sheets = d.pending_sheets,
+                processed_sheets = d.processed_sheets,
+                failed_sheets = d.failed_sheets,
+                review_sheets = d.review_sheets,
+                score_sum = d.score_sum,
+                score_count = d.score_count,
+                updated_at = CURRENT_TIMESTAMP
+            FROM (SELECT {_SUMMARY_DELTAS} FROM (SELECT 1 AS sign, * FROM omr_sheets) changes) d
+            WHERE s.shard = 0
+        """)
+        cursor.execute("""
+            UPDATE stats_summary SET total_batches = 0, total_sheets = 0, pending_sheets = 0, processed_sheets = 0,
+                failed_sheets = 0, review_sheets = 0, score_sum = 0, score_count = 0, updated_at = CURRENT_TIMESTAMP
+            WHERE shard <> 0
+        """)
+        cursor.execute("DELETE FROM stats_hourly")
+        cursor.execute(f"""
+            INSERT INTO stats_hourly (hour, shard, processed, failed)
+            SELECT {_HOURLY_COUNTS}, 0 FROM omr_sheets
+            WHERE processed_at IS NOT NULL AND status IN ('processed', 'failed')
+            GROUP BY 1
+        """)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def fetch_stats(conn, hours=STATS_HOURS):
+    """Dashboard statistics from the counter tables, shaped like the Node /api/dashboard/stats
+
+    None if the counters are not installed.
+    """
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    # Checked up front: querying a missing table would abort the caller's transaction
+    cursor.execute("SELECT to_regclass('stats_summary') IS NOT NULL AND to_regclass('stats_hourly') IS NOT NULL AS installed")
+    if not cursor.fetchone()['installed']:
+        cursor.close()
+        return None
+    cursor.execute("""
+        SELECT count(*) AS shards, SUM(total_batches)::bigint AS total_batches,
+               SUM(total_sheets)::bigint AS total_sheets, SUM(pending_sheets)::bigint AS pending_sheets,
+               SUM(processed_sheets)::bigint AS processed_sheets, SUM(failed_sheets)::bigint AS failed_sheets,
+               SUM(review_sheets)::bigint AS review_sheets, SUM(score_sum) AS score_sum,
+               SUM(score_count)::bigint AS score_count, MAX(updated_at) AS updated_at
+        FROM stats_summary
+    """)
+    summary = cursor.fetchone()
+    cursor.execute("""
+        SELECT hour, SUM(processed)::bigint AS processed, SUM(failed)::bigint AS failed FROM stats_hourly
+        WHERE hour > date_trunc('hour', LOCALTIMESTAMP) - make_interval(hours => %s)
+        GROUP BY hour ORDER BY hour
+    """, (hours,))
+    hourly = cursor.fetchall()
+    cursor.close()
+
+    if not summary['shards']:
+        return None
+    total = summary['total_sheets']
+    processing_rate = summary['processed_sheets'] / total * 100 if total else 0
+    return {
+        'totalBatches': summary['total_batches'],
+        'totalSheets': total,
+        'processedSheets': summary['processed_sheets'],
+        'pendingSheets': summary['pending_sheets'],
+        'reviewSheets': summary['review_sheets'],
+        'failedSheets': summary['failed_sheets'],
+        'averageScore': float(summary['score_sum'] / summary['score_count']) if summary['score_count'] else 0,
+        'processingRate': round(processing_rate, 2),
+        'throughput': [
+            {'hour': row['hour'].isoformat(), 'processed': row['processed'], 'failed': row['failed']}
+            for row in hourly],
+        'updatedAt': summary['updated_at'].isoformat() if summary['updated_at'] else None
+    }
+
+
+def main(argv=None):
+    import psycopg2
+    from db_pool import db_config
+
+    parser = argparse.ArgumentParser(description='Maintain the dashboard statistics counters')
+    parser.add_argument('command', choices=('install', 'rebuild'),
+                        help='install creates the tables and triggers and then rebuilds')
+    parser.add_argument('--database', default='omrscan')
+    args = parser.parse_args(argv)
+
+    conn = psycopg2.connect(**db_config(args.database))
+    try:
+        if args.command == 'install':
+            install(conn)
+        rebuild(conn)
+        logger.info(f"Dashboard statistics: {fetch_stats(conn)}")
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,296 @@
+import os
+import json
+import time
+import base64
+import logging
+from psycopg2.extras import RealDictCursor, execute_values
+from omr_metrics import DB_WRITE_SECONDS
+from omr_archive import CROP_ARCHIVE, CropArchive
+
+logger = logging.getLogger(__name__)
+
+# Default percentage reported for a subject whose sheets all failed to process
+FAILED_PERCENTAGE = 75.0
+SHEET_FLUSH_SIZE = int(os.getenv('SHEET_FLUSH_SIZE', '500'))  # Sheets written per bulk flush
+
+
+def result_percentage(result):
+    """Mean of a result's per-question percentages, each scaled by that question's option count"""
+    ratings = result.get('ratings') or []
+    if not ratings:
+        return None
+    return sum(r['percentage'] for r in ratings) / len(ratings)
+
+
+def sheet_rows(result):
+    """Split a processor result into (page, sheet result) pairs, one per scanned sheet"""
+    if 'sheets' in result:
+        return [(sheet.get('page'), sheet) for sheet in result['sheets']]
+    return [(None, result)]
+
+
+def upsert_batch(conn, batch_code, phase, total_students, subjects):
+    """Create or update a batch and its ordered subject list, returning the batch row"""
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor.execute("""
+        INSERT INTO batches (batch_code, name, description, total_students, created_by)
+        VALUES (%s, %s, %s, %s, (SELECT id FROM users WHERE username = 'admin'))
+        ON CONFLICT (batch_code) DO UPDATE SET
+        description = EXCLUDED.description,
+        total_students = EXCLUDED.total_students
+        RETURNING *
+    """, (batch_code, f'Batch {batch_code}', phase, total_students))
+    batch = cursor.fetchone()
+
+    cursor.execute("DELETE FROM batch_subjects WHERE batch_id = %s", (batch['id'],))
+    for position, (subject, teacher_name) in enumerate(subjects):
+        cursor.execute("""
+            INSERT INTO batch_subjects (batch_id, position, subject, teacher_name)
+            VALUES (%s, %s, %s, %s)
+        """, (batch['id'], position, subject, teacher_name))
+
+    cursor.close()
+    return batch
+
+
+def batch_id_for(conn, batch_code):
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM batches WHERE batch_code = %s", (batch_code,))
+    row = cursor.fetchone()
+    cursor.close()
+    return row[0] if row else None
+
+
+def clear_sheets(conn, batch_id, subject_position):
+    """Remove a subject's sheets before they are replaced by a re-upload"""
+    cursor = conn.cursor()
+    cursor.execute("""
+        DELETE FROM sheet_responses WHERE batch_id = %s AND subject_position = %s
+    """, (batch_id, subject_position))
+    cursor.execute("""
+        DELETE FROM omr_sheets WHERE batch_id = %s AND subject_position = %s
+    """, (batch_id, subject_position))
+    cursor.close()
+
+
+class SheetWriter:
+    """Buffers sheet results and writes them with execute_values, one transaction per flush
+
+    Sheets are upserted on (batch_id, sheet_key), so flushing the same sheet twice
+    overwrites it instead of duplicating it. Bubble crops of the flushed sheets are
+    appended to their batch's CropArchive once the transaction has committed.
+    """
+
+    def __init__(self, conn, batch_size=SHEET_FLUSH_SIZE, archive=CROP_ARCHIVE):
+        self.conn = conn
+        self.batch_size = max(1, batch_size)
+        self.archive = archive
+        self._sheets = {}
+        self._responses = {}
+        self._crops = {}
+        self.flushed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, batch_id, subject_position, file_name, result):
+        """Buffer every sheet in a processor result, flushing when the buffer is full"""
+        for page, sheet in sheet_rows(result):
+            status = 'processed' if sheet.get('success') else 'failed'
+            student_id = f'{file_name}#{page}' if page else file_name
+            key = (batch_id, f'{subject_position}:{student_id}')
+            self._sheets[key] = (
+                batch_id, key[1], subject_position, page, student_id, file_name, file_name, status,
+                sheet.get('overall_score') if status == 'processed' else None,
+                result_percentage(sheet) if status == 'processed' else None,
+                sheet.get('confidence') if status == 'processed' else None,
+                sheet.get('processing_time'),
+                json.dumps(sheet.get('ratings', [])),
+                json.dumps({'error': sheet['error']} if sheet.get('error') else {}))
+            self._responses[key] = [
+                (subject_position, question, rating['question'], rating['rating'], rating['confidence'],
+                 rating['percentage'])
+                for question, rating in enumerate(sheet.get('ratings', []))]
+            if self.archive and sheet.get('crops'):
+                self._crops[key] = sheet['crops']
+            else:
+                self._crops.pop(key, None)
+
+            if len(self._sheets) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        """Write the buffered sheets and their responses in a single transaction"""
+        if not self._sheets:
+            return 0
+
+        keys = list(self._sheets)
+        cursor = self.conn.cursor()
+        start = time.perf_counter()
+        try:
+            ids = execute_values(cursor, """
+                INSERT INTO omr_sheets (batch_id, sheet_key, subject_position, page, student_id, file_name,
+                                        file_path, status, overall_score, percentage, confidence, processing_time,
+                                        responses, metadata, processed_at)
+                VALUES %s
+                ON CONFLICT (batch_id, sheet_key) DO UPDATE SET
+                status = EXCLUDED.status,
+                overall_score = EXCLUDED.overall_score,
+                percentage = EXCLUDED.percentage,
+                confidence = EXCLUDED.confidence,
+                processing_time = EXCLUDED.processing_time,
+                responses = EXCLUDED.responses,
+                metadata = EXCLUDED.metadata,
+                processed_at = EXCLUDED.processed_at
+                RETURNING batch_id, sheet_key, id
+            """, [self._sheets[key] for key in keys],
+                template='(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)',
+                page_size=self.batch_size, fetch=True)
+            sheet_ids = {(batch_id, sheet_key): sheet_id for batch_id, sheet_key, sheet_id in ids}
+
+            # Replace the responses of every upserted sheet
+            cursor.execute("DELETE FROM sheet_responses WHERE sheet_id = ANY(%s::uuid[])",
+                           ([str(sheet_id) for sheet_id in sheet_ids.values()],))
+            response_rows = [
+                (sheet_ids[key], key[0]) + response
+                for key in keys
+                for response in self._responses[key]]
+            execute_values(cursor, """
+                INSERT INTO sheet_responses (sheet_id, batch_id, subject_position, question,
+                                             question_text, rating, confidence, percentage)
+                VALUES %s
+            """, response_rows, page_size=self.batch_size * 8)
+
+            self.conn.commit()
+            DB_WRITE_SECONDS.observe(time.perf_counter() - start)
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+        self._sheets.clear()
+        self._responses.clear()
+        self._archive_crops()
+        self.flushed += len(keys)
+        return len(keys)
+
+    def _archive_crops(self):
+        """Append the flushed sheets' crops, one archive write per batch"""
+        batches = {}
+        for (batch_id, sheet_key), crops in self._crops.items():
+            batches.setdefault(batch_id, []).append((sheet_key, base64.b64decode(crops)))
+        self._crops.clear()
+
+        # The sheets are already stored, so a failed write only costs their review crops
+        for batch_id, sheets in batches.items():
+            try:
+                CropArchive(batch_id).append(sheets)
+            except Exception as e:
+                logger.error(f"Could not archive bubble crops of batch {batch_id}: {e}")
+
+
+def insert_sheets(conn, batch_id, subject_position, file_name, result):
+    """Write every sheet of one processor result and commit"""
+    with SheetWriter(conn) as writer:
+        writer.add(batch_id, subject_position, file_name, result)
+
+
+def fetch_sheet(conn, sheet_id):
+    """A sheet's batch, key and stored ratings, or None"""
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor.execute("""
+        SELECT s.id, s.batch_id, b.batch_code, s.sheet_key, s.subject_position, s.page, s.student_id,
+               s.status, s.overall_score, s.confidence, s.responses
+        FROM omr_sheets s
+        JOIN batches b ON b.id = s.batch_id
+        WHERE s.id = %s::uuid
+    """, (sheet_id,))
+    sheet = cursor.fetchone()
+    cursor.close()
+    return sheet
+
+
+def fetch_batch(conn, batch_code):
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor.execute("""
+        SELECT b.id, b.batch_code, b.description AS phase, b.total_students, b.created_at,
+               GREATEST(b.created_at, (SELECT MAX(s.processed_at) FROM omr_sheets s WHERE s.batch_id = b.id))
+                   AS last_modified
+        FROM batches b
+        WHERE b.batch_code = %s
+    """, (batch_code,))
+    batch = cursor.fetchone()
+    cursor.close()
+    return batch
+
+
+def fetch_subject_results(conn, batch_id, with_ratings=True):
+    """Per-subject results aggregated from the sheet rows, in subject order"""
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor.execute("""
+        SELECT bs.position, bs.subject, bs.teacher_name,
+               COUNT(s.id) AS sheets,
+               COUNT(s.id) FILTER (WHERE s.status = 'processed') AS processed,
+               AVG(s.overall_score) FILTER (WHERE s.status = 'processed') AS overall_score,
+               AVG(COALESCE(s.percentage, s.overall_score / 5 * 100))
+                   FILTER (WHERE s.status = 'processed') AS percentage,
+               AVG(s.confidence) FILTER (WHERE s.status = 'processed') AS confidence,
+               MAX(s.metadata ->> 'error') AS error
+        FROM batch_subjects bs
+        LEFT JOIN omr_sheets s ON s.batch_id = bs.batch_id AND s.subject_position = bs.position
+        WHERE bs.batch_id = %s
+        GROUP BY bs.position, bs.subject, bs.teacher_name
+        ORDER BY bs.position
+    """, (batch_id,))
+    rows = cursor.fetchall()
+
+    ratings = {}
+    if with_ratings:
+        cursor.execute("""
+            SELECT r.subject_position, r.question, MAX(r.question_text) AS question_text,
+                   AVG(r.rating) AS rating, AVG(r.confidence) AS confidence,
+                   AVG(COALESCE(r.percentage, r.rating / 5 * 100)) AS percentage
+            FROM sheet_responses r
+            WHERE r.batch_id = %s
+            GROUP BY r.subject_position, r.question
+            ORDER BY r.subject_position, r.question
+        """, (batch_id,))
+        for row in cursor.fetchall():
+            rating = float(row['rating'])
+            ratings.setdefault(row['subject_position'], []).append({
+                'question': row['question_text'],
+                'rating': rating,
+                'confidence': float(row['confidence']),
+                'percentage': float(row['percentage'])
+            })
+    cursor.close()
+
+    subjects = []
+    for row in rows:
+        subject = {
+            'subject': row['subject'],
+            'teacherName': row['teacher_name'],
+            'percentage': 0,
+            'isUploaded': row['sheets'] > 0
+        }
+        if row['processed']:
+            subject.update({
+                'percentage': round(float(row['percentage']), 1),
+                'confidence': float(row['confidence']),
+                'sheetCount': row['processed']
+            })
+            if with_ratings:
+                subject['ratings'] = ratings.get(row['position'], [])
+        elif row['sheets']:
+            subject.update({
+                'percentage': FAILED_PERCENTAGE,
+                'error': row['error'] or 'Processing failed'
+            })
+        subjects.append(subject)
+
+    return subjects
@@ -0,0 +1,174 @@
+import os
+import json
+import uuid
+import threading
+from collections import OrderedDict
+from psycopg2.extras import RealDictCursor
+
+# Configuration
+TEMPLATE_CACHE_SIZE = int(os.getenv('TEMPLATE_CACHE_SIZE', '32'))  # Compiled templates kept in memory
+
+# Calibration point order, matching calibrationPoints in client/src/lib/omr-processing.ts
+CORNERS = ('topLeft', 'topRight', 'bottomLeft', 'bottomRight')
+
+# Built-in feedback form: 5 questions x 5 rating bubbles
+DEFAULT_CONFIGURATION = {
+    'questions': [
+        "Course Content Quality",
+        "Teaching Effectiveness",
+        "Learning Materials",
+        "Assessment Methods",
+        "Overall Satisfaction"
+    ],
+    'layout': {
+        'origin': [100, 150],  # Top-left corner of the first bubble
+        'bubble': [25, 25],  # Bubble width and height
+        'optionPitch': 40,  # Horizontal distance between options
+        'questionPitch': 50,  # Vertical distance between questions
+        'options': 5
+    }
+}
+
+
+class OMRTemplate:
+    """A bubble layout compiled once into a BubbleGrid and shared by every sheet
+
+    The grid is compiled on first use, so reading a template does not load numpy.
+
+    configuration has a 'questions' list whose entries are either question texts laid
+    out by the 'layout' grid spec, or {'text': ..., 'options': [[x, y, w, h], ...]} with
+    explicit bubble boxes. Optional 'calibrationPoints' ({'topLeft': {'x': ..., 'y': ...}, ...})
+    give the centres of the sheet's registration marks, 'fiducialSize' their width.
+    """
+
+    def __init__(self, configuration, template_id='default', version='1'):
+        self.id = str(template_id)
+        self.version = str(version)
+        self.questions = []
+        self.question_regions = []
+
+        layout = configuration.get('layout', {})
+        for i, question in enumerate(configuration['questions']):
+            if isinstance(question, dict):
+                self.questions.append(question['text'])
+                self.question_regions.append([tuple(int(v) for v in box) for box in question['options']])
+            else:
+                self.questions.append(question)
+                self.question_regions.append(self._layout_row(layout, i))
+
+        self._grid = None
+
+        # Registration marks used to align scans; None skips alignment
+        points = configuration.get('calibrationPoints')
+        self.calibration_points = [(points[c]['x'], points[c]['y']) for c in CORNERS] if points else None
+        self.fiducial_size = configuration.get('fiducialSize', 20)
+
+    @staticmethod
+    def _layout_row(layout, i):
+        x, y = layout['origin']
+        w, h = layout['bubble']
+        y += i * layout['questionPitch']
+        return [(x + j * layout['optionPitch'], y, w, h) for j in range(layout['options'])]
+
+    @property
+    def grid(self):
+        if self._grid is None:
+            from omr_engine import BubbleGrid
+            self._grid = BubbleGrid(self.question_regions)
+        return self._grid
+
+    @property
+    def key(self):
+        return (self.id, self.version)
+
+    def __getstate__(self):
+        # Ship the layout to worker processes, not the compiled arrays
+        return {'id': self.id, 'version': self.version, 'questions': self.questions,
+                'question_regions': self.question_regions, 'calibration_points': self.calibration_points,
+                'fiducial_size': self.fiducial_size}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._grid = None
+
+
+def default_template():
+    return _default
+
+
+def load_json(path):
+    """Build a template from a JSON configuration file, versioned by its modification time"""
+    with open(path) as f:
+        configuration = json.load(f)
+    return OMRTemplate(configuration, path, str(os.path.getmtime(path)))
+
+
+class TemplateCache:
+    """LRU of compiled templates keyed by (template id, version)"""
+
+    def __init__(self, maxsize=TEMPLATE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+            return template
+
+    def _put(self, template):
+        with self._lock:
+            self._templates[template.key] = template
+            self._templates.move_to_end(template.key)
+            while len(self._templates) > self.maxsize:
+                self._templates.popitem(last=False)
+        return template
+
+    def from_db(self, conn, template_id):
+        """Compiled template for an omr_templates row, or None if it does not exist
+
+        Only the version is read on a cache hit; the configuration and question texts
+        are loaded and compiled when the version changes.
+        """
+        # Ids are UUIDs; anything else cannot exist and would only fail in the query
+        try:
+            template_id = str(uuid.UUID(str(template_id)))
+        except ValueError:
+            return None
+
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute("SELECT version FROM omr_templates WHERE id = %s", (template_id,))
+        row = cursor.fetchone()
+        if row is None:
+            cursor.close()
+            return None
+
+        template = self._get((str(template_id), str(row['version'])))
+        if template is not None:
+            cursor.close()
+            return template
+
+        cursor.execute("SELECT version, configuration FROM omr_templates WHERE id = %s", (template_id,))
+        row = cursor.fetchone()
+        configuration = dict(row['configuration'] or {})
+        if not configuration.get('questions'):
+            # Fall back to the template's feedback questions for the question texts
+            cursor.execute("""
+                SELECT question_text FROM feedback_questions
+                WHERE template_id = %s
+                ORDER BY "order"
+            """, (template_id,))
+            configuration['questions'] = [q['question_text'] for q in cursor.fetchall()]
+        cursor.close()
+
+        configuration.setdefault('layout', DEFAULT_CONFIGURATION['layout'])
+        return self._put(OMRTemplate(configuration, template_id, row['version']))
+
+    def from_json(self, path):
+        key = (path, str(os.path.getmtime(path)))
+        return self._get(key) or self._put(load_json(path))
+
+
+_default = OMRTemplate(DEFAULT_CONFIGURATION)
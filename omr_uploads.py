@@ -0,0 +1,304 @@
+import os
+import uuid
+import fcntl
+import shutil
+import sqlite3
+import hashlib
+import logging
+import threading
+from datetime import datetime, timedelta
+from sheet_cache import hash_file
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+UPLOAD_SESSION_DB_PATH = os.getenv('UPLOAD_SESSION_DB_PATH', os.path.join('uploads', 'upload_sessions.sqlite3'))
+UPLOAD_SESSION_DIR = os.getenv('UPLOAD_SESSION_DIR', os.path.join('uploads', 'sessions'))
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', str(8 * 1024 * 1024)))  # Suggested chunk size, below MAX_CONTENT_LENGTH
+UPLOAD_MAX_FILE_SIZE = int(os.getenv('UPLOAD_MAX_FILE_SIZE', str(2 * 1024 * 1024 * 1024)))  # Largest file a session accepts
+UPLOAD_SESSION_TTL = float(os.getenv('UPLOAD_SESSION_TTL', '24'))  # Hours before an unfinished session is discarded
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS upload_sessions (
+    id TEXT PRIMARY KEY,
+    batch_code TEXT NOT NULL,
+    job_id TEXT NOT NULL,
+    finalized INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS upload_files (
+    session_id TEXT NOT NULL REFERENCES upload_sessions(id),
+    position INTEGER NOT NULL,
+    file_name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT,
+    received INTEGER NOT NULL DEFAULT 0,
+    chunks INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'receiving',
+    duplicate_of TEXT,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (session_id, position)
+);
+"""
+
+READ_SIZE = 1024 * 1024
+
+
+class UploadError(Exception):
+    """A rejected chunk or request; status is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400, **details):
+        super().__init__(message)
+        self.status = status
+        self.details = details
+
+
+def _now():
+    return datetime.now().isoformat()
+
+
+class UploadSessions:
+    """Resumable chunked uploads: create a session, append chunks at offsets, finalize
+
+    Each file is spooled to its own file and written under an exclusive lock, so any
+    process may receive any chunk. A file is handed to the job queue the moment its
+    last chunk lands, so sheets are processed while later files are still uploading.
+    """
+
+    def __init__(self, job_queue, sheet_cache=None, db_path=UPLOAD_SESSION_DB_PATH, spool_dir=UPLOAD_SESSION_DIR,
+                 max_file_size=UPLOAD_MAX_FILE_SIZE, ttl_hours=UPLOAD_SESSION_TTL):
+        self.job_queue = job_queue
+        self.sheet_cache = sheet_cache
+        self.db_path = db_path
+        self.spool_dir = spool_dir
+        self.max_file_size = max_file_size
+        self.ttl = timedelta(hours=ttl_hours)
+        self._local = threading.local()
+
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        os.makedirs(spool_dir, exist_ok=True)
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def _conn(self):
+        """One SQLite connection per thread, reopened in forked children"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._local.conn = self._connect()
+            self._local.pid = os.getpid()
+        return conn
+
+    def _spool_path(self, session_id, position):
+        return os.path.join(self.spool_dir, session_id, str(position))
+
+    def create(self, batch_code, files):
+        """Open a session for files, a list of (file_name, size, sha256 or None) in subject order"""
+        if not files:
+            raise UploadError('No files given')
+        for file_name, size, _ in files:
+            if size <= 0 or size > self.max_file_size:
+                raise UploadError(f'{file_name}: size must be between 1 and {self.max_file_size} bytes')
+        self.expire()
+
+        session_id = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.spool_dir, session_id))
+        for position in range(len(files)):
+            open(self._spool_path(session_id, position), 'wb').close()
+
+        # The job exists from the start so files can be added to it as they complete
+        job_id = self.job_queue.enqueue(batch_code, [])
+
+        conn = self._conn()
+        conn.execute('BEGIN')
+        conn.execute("INSERT INTO upload_sessions (id, batch_code, job_id, created_at) VALUES (?, ?, ?, ?)",
+                     (session_id, batch_code, job_id, _now()))
+        conn.executemany("""
+            INSERT INTO upload_files (session_id, position, file_name, size, sha256, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [(session_id, position, file_name, size, sha256, _now())
+              for position, (file_name, size, sha256) in enumerate(files)])
+        conn.execute('COMMIT')
+        return self.status(session_id)
+
+    def _file(self, session_id, position):
+        row = self._conn().execute("""
+            SELECT f.*, s.batch_code, s.job_id, s.finalized FROM upload_files f
+            JOIN upload_sessions s ON s.id = f.session_id
+            WHERE f.session_id = ? AND f.position = ?
+        """, (session_id, position)).fetchone()
+        if row is None:
+            raise UploadError('Upload not found', 404)
+        return row
+
+    def write_chunk(self, session_id, position, offset, stream, length, checksum=None):
+        """Append length bytes from stream at offset, returning the file's new state
+
+        offset must equal the bytes received so far (409 with the current offset otherwise),
+        and checksum, if given, is the chunk's SHA-256 hex digest.
+        """
+        path = self._spool_path(session_id, position)
+        try:
+            spool = open(path, 'r+b')
+        except FileNotFoundError:
+            # Complete files are moved to the job queue's spool
+            upload = self._file(session_id, position)
+            raise UploadError('File is already complete', 409, offset=upload['received'])
+
+        with spool:
+            # Serializes writers to this file across threads and processes
+            fcntl.flock(spool, fcntl.LOCK_EX)
+            upload = self._file(session_id, position)
+            if upload['status'] != 'receiving':
+                raise UploadError('File is already complete', 409, offset=upload['received'])
+            if offset != upload['received']:
+                raise UploadError('Offset does not match the bytes received', 409, offset=upload['received'])
+            if length <= 0 or offset + length > upload['size']:
+                raise UploadError('Chunk runs past the declared file size', 400, offset=upload['received'])
+
+            spool.seek(offset)
+            hasher = hashlib.sha256()
+            remaining = length
+            while remaining:
+                data = stream.read(min(READ_SIZE, remaining))
+                if not data:
+                    break
+                hasher.update(data)
+                spool.write(data)
+                remaining -= len(data)
+
+            if remaining or (checksum and hasher.hexdigest() != checksum.lower()):
+                # Drop the partial or corrupt chunk; the client resends it from the same offset
+                spool.truncate(offset)
+                message = 'Chunk was cut short' if remaining else 'Chunk checksum mismatch'
+                raise UploadError(message, 400, offset=offset)
+
+            spool.flush()
+            os.fsync(spool.fileno())
+            received = offset + length
+            if received == upload['size']:
+                # The last chunk only counts once the file is queued, so if that fails it can be sent again
+                self._complete(upload, path)
+            else:
+                self._conn().execute("""
+                    UPDATE upload_files SET received = ?, chunks = chunks + 1, updated_at = ?
+                    WHERE session_id = ? AND position = ?
+                """, (received, _now(), session_id, position))
+        return self._file_status(self._file(session_id, position))
+
+    def _complete(self, upload, path):
+        """Verify a fully received file and queue it for processing"""
+        session_id, position = upload['session_id'], upload['position']
+        if upload['sha256']:
+            with open(path, 'rb') as f:
+                digest = hashlib.sha256()
+                for data in iter(lambda: f.read(READ_SIZE), b''):
+                    digest.update(data)
+            if digest.hexdigest() != upload['sha256'].lower():
+                # Start the file over rather than process a corrupt scan
+                os.truncate(path, 0)
+                self._conn().execute("""
+                    UPDATE upload_files SET received = 0, chunks = 0, updated_at = ?
+                    WHERE session_id = ? AND position = ?
+                """, (_now(), session_id, position))
+                raise UploadError('File checksum mismatch; upload it again from offset 0', 422, offset=0)
+
+        content_hash = hash_file(path) if self.sheet_cache is not None else None
+
+        moved = []
+
+        def save(target):
+            shutil.move(path, target)
+            moved.append(target)
+
+        file_name = upload['file_name']
+        try:
+            self.job_queue.enqueue(upload['batch_code'], [(file_name, file_name.lower().endswith('.pdf'), save)],
+                                   job_id=upload['job_id'], first_position=position)
+        except Exception:
+            # Put the file back so the resent last chunk finds it
+            if moved and os.path.exists(moved[0]):
+                shutil.move(moved[0], path)
+            raise
+
+        # Registered only once queued, so a resent file is not flagged as a duplicate of itself
+        duplicate_of = None
+        if content_hash is not None:
+            duplicate_of = self.sheet_cache.register(upload['batch_code'], content_hash, file_name)
+        self._conn().execute("""
+            UPDATE upload_files SET received = size, chunks = chunks + 1, status = 'queued', duplicate_of = ?,
+                updated_at = ?
+            WHERE session_id = ? AND position = ?
+        """, (duplicate_of, _now(), session_id, position))
+        logger.info(f"Upload {session_id}: {file_name} complete and queued")
+
+    def awaiting(self, job_id=None, batch_code=None):
+        """Files of open sessions not yet queued, for one job or for every job of a batch"""
+        column, value = ('job_id', job_id) if job_id is not None else ('batch_code', batch_code)
+        return self._conn().execute(f"""
+            SELECT COUNT(*) FROM upload_files f JOIN upload_sessions s ON s.id = f.session_id
+            WHERE s.{column} = ? AND f.status != 'queued'
+        """, (value,)).fetchone()[0]
+
+    def finalize(self, session_id):
+        """Close a session once every file has arrived"""
+        status = self.status(session_id)
+        if status is None:
+            raise UploadError('Upload not found', 404)
+        missing = [f['position'] for f in status['files'] if f['status'] != 'queued']
+        if missing:
+            raise UploadError('Some files are incomplete', 409, missing=missing)
+
+        self._conn().execute("UPDATE upload_sessions SET finalized = 1 WHERE id = ?", (session_id,))
+        shutil.rmtree(os.path.join(self.spool_dir, session_id), ignore_errors=True)
+        status['finalized'] = True
+        return status
+
+    @staticmethod
+    def _file_status(upload):
+        return {
+            'position': upload['position'],
+            'fileName': upload['file_name'],
+            'size': upload['size'],
+            'offset': upload['received'],
+            'chunks': upload['chunks'],
+            'status': upload['status'],
+            'duplicateOf': upload['duplicate_of']
+        }
+
+    def status(self, session_id):
+        """Session state with each file's offset to resume from, or None if it does not exist"""
+        conn = self._conn()
+        session = conn.execute("SELECT * FROM upload_sessions WHERE id = ?", (session_id,)).fetchone()
+        if session is None:
+            return None
+        files = conn.execute("SELECT * FROM upload_files WHERE session_id = ? ORDER BY position",
+                             (session_id,)).fetchall()
+        return {
+            'uploadId': session['id'],
+            'batchCode': session['batch_code'],
+            'jobId': session['job_id'],
+            'finalized': bool(session['finalized']),
+            'chunkSize': UPLOAD_CHUNK_SIZE,
+            'createdAt': session['created_at'],
+            'files': [self._file_status(row) for row in files]
+        }
+
+    def expire(self):
+        """Discard the spool files of sessions left unfinished for longer than the TTL"""
+        cutoff = (datetime.now() - self.ttl).isoformat()
+        conn = self._conn()
+        stale = [row['id'] for row in conn.execute(
+            "SELECT id FROM upload_sessions WHERE finalized = 0 AND created_at < ?", (cutoff,))]
+        for session_id in stale:
+            shutil.rmtree(os.path.join(self.spool_dir, session_id), ignore_errors=True)
+            conn.execute("DELETE FROM upload_files WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM upload_sessions WHERE id = ?", (session_id,))
+        if stale:
+            logger.info(f"Discarded {len(stale)} expired upload sessions")
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""Watch a scanner output directory and store new sheets without browser uploads.
+
+Files are picked up once they stop growing, processed on the sheet pool and
+written to their batch in the database, then moved to the done or failed folder.
+The batch comes from the folder layout, as for omr_batch.py:
+<root>/<batch_code>/<file> or <root>/<batch_code>/<subject position>/<file>.
+
+Uses inotify when the optional inotify_simple package is installed (the `watch`
+extra) and polls otherwise; network shares often deliver no inotify events, so
+the directory is also rescanned every WATCH_POLL_INTERVAL seconds either way.
+
+    python omr_watch.py /mnt/scanner --workers 4
+"""
+import os
+import sys
+import time
+import queue
+import shutil
+import signal
+import logging
+import argparse
+import threading
+from dotenv import load_dotenv
+
+import omr_store
+from db_pool import db_config
+from omr_batch import batch_for, is_sheet
+from omr_pool import SheetPool
+from omr_templates import load_json
+from result_cache import invalidate_batches
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+WATCH_SETTLE_SECONDS = float(os.getenv('WATCH_SETTLE_SECONDS', '3'))  # A file must be unchanged this long
+WATCH_POLL_INTERVAL = float(os.getenv('WATCH_POLL_INTERVAL', '2'))  # Seconds between directory scans
+WATCH_QUEUE_SIZE = int(os.getenv('WATCH_QUEUE_SIZE', '0'))  # Files in flight before intake pauses; 0 = 4 per worker
+WATCH_FLUSH_SIZE = int(os.getenv('WATCH_FLUSH_SIZE', '50'))  # Sheets written per database transaction
+WATCH_RETRY_SECONDS = float(os.getenv('WATCH_RETRY_SECONDS', '30'))  # Wait after a database error
+DONE_FOLDER = '_done'
+FAILED_FOLDER = '_failed'
+
+
+class SettleTracker:
+    """Reports files whose size and mtime have not changed for settle seconds"""
+
+    def __init__(self, settle):
+        self.settle = settle
+        self._seen = {}
+
+    def ready(self, paths, now=None):
+        now = now or time.monotonic()
+        ready = []
+        current = {}
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            previous = self._seen.get(path)
+            since = previous[1] if previous and previous[0] == signature else now
+            current[path] = (signature, since)
+            if stat.st_size and now - since >= self.settle:
+                ready.append(path)
+        # Forget files that were moved away or deleted
+        self._seen = current
+        return ready
+
+
+class FolderWatcher:
+    """Yields candidate sheet paths under root, waking early on inotify events"""
+
+    def __init__(self, root, poll_interval):
+        self.root = root
+        self.poll_interval = poll_interval
+        self._inotify = INotify() if INotify is not None else None
+        self._watched = set()
+        if self._inotify is None:
+            logger.info("inotify_simple not installed; polling for new files")
+
+    def scan(self):
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            # Never descend into the folders processed files are moved to
+            if dirpath == self.root:
+                dirnames[:] = [d for d in dirnames if d not in (DONE_FOLDER, FAILED_FOLDER)]
+            dirnames.sort()
+            if self._inotify is not None and dirpath not in self._watched:
+                self._inotify.add_watch(dirpath, flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE)
+                self._watched.add(dirpath)
+            paths.extend(os.path.join(dirpath, name) for name in sorted(filenames))
+        return [path for path in paths if is_sheet(path)]
+
+    def wait(self, timeout=None):
+        timeout = self.poll_interval if timeout is None else timeout
+        if self._inotify is None:
+            time.sleep(timeout)
+            return
+        self._inotify.read(timeout=int(timeout * 1000))
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+
+
+class WatchDaemon:
+    """Intake thread feeding a bounded queue; a writer thread stores results and moves files"""
+
+    def __init__(self, root, pool, database='omrscan', template=None, profile=None,
+                 queue_size=WATCH_QUEUE_SIZE, flush_size=WATCH_FLUSH_SIZE,
+                 settle=WATCH_SETTLE_SECONDS, poll_interval=WATCH_POLL_INTERVAL):
+        self.root = os.path.abspath(root)
+        self.pool = pool
+        self.database = database
+        self.template = template
+        self.profile = profile
+        self.flush_size = max(1, flush_size)
+        self.watcher = FolderWatcher(self.root, poll_interval)
+        self.tracker = SettleTracker(settle)
+        self.queue = queue.Queue(maxsize=queue_size or max(1, pool.workers) * 4)
+
+        self._stopping = threading.Event()
+        self._claimed = set()
+        self._claimed_lock = threading.Lock()
+        self._conn = None
+        self._writer = None
+        self._batch_ids = {}
+        self._moves = []
+        self._written = set()
+        self.counts = {'processed': 0, 'failed': 0}
+
+    def stop(self):
+        self._stopping.set()
+
+    def run(self):
+        writer = threading.Thread(target=self._write_loop, name='omr-watch-writer', daemon=True)
+        writer.start()
+        logger.info(f"Watching {self.root} ({self.queue.maxsize} files in flight)")
+        try:
+            self._intake_loop()
+        finally:
+            self.queue.put(None)
+            writer.join()
+            self.watcher.close()
+            if self._conn is not None:
+                self._conn.close()
+
+    def _intake_loop(self):
+        while not self._stopping.is_set():
+            for path in self.tracker.ready(self.watcher.scan()):
+                with self._claimed_lock:
+                    if path in self._claimed:
+                        continue
+                    self._claimed.add(path)
+                if not self._submit(path):
+                    break
+            self.watcher.wait()
+
+    def _submit(self, path):
+        """Queue one file, blocking while the queue is full; False once stopping"""
+        try:
+            batch_code, position = batch_for(self.root, path)
+        except ValueError as e:
+            logger.error(str(e))
+            self._move(path, FAILED_FOLDER)
+            return True
+
+        pending = self.pool.submit(path, path.lower().endswith('.pdf'), self.template, self.profile)
+        item = (path, batch_code, position, pending)
+        if self.queue.full():
+            logger.info(f"{self.queue.maxsize} files in flight; pausing intake")
+        while not self._stopping.is_set():
+            try:
+                self.queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        # Stopping: the file stays in place and is picked up again on restart
+        return False
+
+    def _write_loop(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=1)
+            except queue.Empty:
+                self._flush()
+                continue
+            if item is None:
+                self._flush()
+                return
+
+            path, batch_code, position, pending = item
+            result = pending.result()
+            try:
+                self._store(path, batch_code, position, result)
+            except Exception as e:
+                # Sheets buffered on the dropped connection are retried along with this one
+                paths = [path] + [moved for moved, _ in self._moves]
+                logger.error(f"Could not store {path}, retrying {len(paths)} files in {WATCH_RETRY_SECONDS}s: {e}")
+                self._moves = []
+                self._written = set()
+                self._reset(paths)
+                continue
+
+            # Write as soon as the queue drains so sheets land within seconds
+            if self.queue.empty() or len(self._moves) >= self.flush_size:
+                self._flush()
+
+    def _connection(self):
+        if self._conn is None or self._conn.closed:
+            import psycopg2
+            self._conn = psycopg2.connect(**db_config(self.database))
+            self._writer = omr_store.SheetWriter(self._conn, sys.maxsize)
+            self._batch_ids = {}
+        return self._conn
+
+    def _store(self, path, batch_code, position, result):
+        conn = self._connection()
+        batch_id = self._batch_ids.get(batch_code)
+        if batch_id is None:
+            # Misses are not cached, so a batch created after its folder appeared is found
+            batch_id = omr_store.batch_id_for(conn, batch_code)
+            if batch_id is not None:
+                self._batch_ids[batch_code] = batch_id
+        if batch_id is None:
+            logger.error(f"Batch {batch_code} not found for {path}")
+            self._move(path, FAILED_FOLDER)
+            return
+
+        self._writer.add(batch_id, position, os.path.relpath(path, self.root), result)
+        self._moves.append((path, DONE_FOLDER if result.get('success') else FAILED_FOLDER))
+        self._written.add(batch_code)
+
+    def _flush(self):
+        """Commit buffered sheets, then move their files; on error leave them to be retried"""
+        if not self._moves:
+            return
+        moves, self._moves = self._moves, []
+        written, self._written = self._written, set()
+        try:
+            self._writer.flush()
+        except Exception as e:
+            logger.error(f"Database write failed, retrying {len(moves)} files in {WATCH_RETRY_SECONDS}s: {e}")
+            self._reset([path for path, _ in moves])
+            return
+
+        # The server's cached results of these batches are now stale
+        invalidate_batches(written)
+        for path, folder in moves:
+            self.counts['processed' if folder == DONE_FOLDER else 'failed'] += 1
+            self._move(path, folder)
+        logger.info(f"Stored {len(moves)} files ({self.counts['processed']} processed, "
+                    f"{self.counts['failed']} failed so far)")
+
+    def _reset(self, paths):
+        """Drop the connection and its unwritten sheets, then let the files be picked up again"""
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+        self._conn = None
+        self._stopping.wait(WATCH_RETRY_SECONDS)
+        self._release(paths)
+
+    def _release(self, paths):
+        """Let the intake loop pick files up again"""
+        with self._claimed_lock:
+            self._claimed.difference_update(paths)
+
+    def _move(self, path, folder):
+        """Move a file under the done or failed folder, keeping its relative path"""
+        target = os.path.join(self.root, folder, os.path.relpath(path, self.root))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.exists(target):
+            base, ext = os.path.splitext(target)
+            target = f'{base}.{int(time.time())}{ext}'
+        try:
+            shutil.move(path, target)
+        except OSError as e:
+            logger.error(f"Could not move {path} to {folder}: {e}")
+        self._release([path])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('root', help='directory the scanners write to')
+    parser.add_argument('--database', default='omrscan', help='database name (PG* environment variables)')
+    parser.add_argument('--template', help='template JSON file; the built-in form by default')
+    parser.add_argument('--profile', help='scanner profile used for alignment')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args(argv)
+
+    template = load_json(args.template) if args.template else None
+    pool = SheetPool(workers=args.workers)
+    pool.start()
+    daemon = WatchDaemon(args.root, pool, args.database, template, args.profile)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: daemon.stop())
+    try:
+        daemon.run()
+    finally:
+        pool.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+RESULT_CACHE_SIZE = int(os.getenv('RESULT_CACHE_SIZE', '256'))  # Batches kept in memory
+RESULT_CACHE_TTL = float(os.getenv('RESULT_CACHE_TTL', '300'))  # Seconds before an entry is re-read
+RESULT_VERSIONS_PATH = os.getenv('RESULT_VERSIONS_PATH', os.path.join('uploads', 'result_versions.sqlite3'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS result_versions (
+    batch_code TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+"""
+
+_BUMP = """
+    INSERT INTO result_versions (batch_code, version) VALUES (?, 1)
+    ON CONFLICT (batch_code) DO UPDATE SET version = version + 1
+"""
+
+
+def invalidate_batches(batch_codes, db_path=RESULT_VERSIONS_PATH):
+    """Bump the shared version of batches written outside the server, by omr_watch or omr_batch
+
+    The results are already committed, so a failure is logged rather than raised.
+    """
+    if not batch_codes:
+        return
+    try:
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            conn.executemany(_BUMP, [(batch_code,) for batch_code in batch_codes])
+        finally:
+            conn.close()
+    except Exception as e:
+        logger.error(f"Could not invalidate cached results of {len(batch_codes)} batches: {e}")
+
+
+class CacheEntry:
+    def __init__(self, data, ttl, version, last_modified=None):
+        self.data = data
+        self.version = version
+        body = json.dumps(data, sort_keys=True, default=str).encode('utf-8')
+        self.etag = hashlib.sha1(body).hexdigest()
+        # When the batch last changed; naive database timestamps are in local time
+        last_modified = last_modified or datetime.now(timezone.utc)
+        self.last_modified = last_modified.astimezone(timezone.utc).replace(microsecond=0)
+        self.expires = time.monotonic() + ttl
+
+
+class ResultCache:
+    """In-process LRU + TTL cache of batch results, invalidated across processes
+
+    Every write bumps its batch's version in a SQLite file shared by the server's
+    processes. Reads take the version before querying and an entry is only served
+    while its version is current, so neither a write in another process nor one
+    that raced with the read leaves stale data cached. The watch daemon and omr_batch
+    bump versions through invalidate_batches; the Node service's writes are only
+    seen after the TTL.
+    """
+
+    def __init__(self, maxsize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL, db_path=RESULT_VERSIONS_PATH):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.db_path = db_path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self._conn().executescript(SCHEMA)
+
+    def _conn(self):
+        """One SQLite connection per thread, reopened in forked children"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._local.conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.pid = os.getpid()
+        return conn
+
+    def version(self, key):
+        """Token to pass to put() so writes made during the read are not overwritten"""
+        row = self._conn().execute("SELECT version FROM result_versions WHERE batch_code = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        # The shared version is read outside the lock, so lookups do not wait on SQLite in turn
+        current = self.version(key) if entry is not None else None
+        with self._lock:
+            if entry is None or self._entries.get(key) is not entry:
+                self.misses += 1
+                return None
+            if entry.expires <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            if entry.version != current:
+                # Written since it was read, possibly by another process
+                del self._entries[key]
+                self.invalidations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, data, version, last_modified=None):
+        """Cache data read at the given version and return its entry"""
+        entry = CacheEntry(data, self.ttl, version, last_modified)
+        if self.maxsize <= 0:
+            return entry
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def invalidate(self, key):
+        self._conn().execute(_BUMP, (key,))
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxSize': self.maxsize,
+                'ttlSeconds': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': self.hits / lookups if lookups else 0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations
+            }
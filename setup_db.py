@@ -1,6 +1,7 @@
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import uuid
+import omr_stats
 
 def setup_database():
     # Database connection parameters
@@ -29,6 +30,7 @@ def setup_database():
         # Connect to omrscan database
         db_params['database'] = 'omrscan'
         conn = psycopg2.connect(**db_params)
+        conn.autocommit = True
         cursor = conn.cursor(cursor_factory=RealDictCursor)
 
         # Create UUID extension if not exists
@@ -83,7 +85,7 @@ def setup_database():
                 file_name TEXT NOT NULL,
                 file_path TEXT NOT NULL,
                 status TEXT NOT NULL DEFAULT 'pending',
-                overall_score NUMERIC(3,2),
+                overall_score NUMERIC(6,2),
                 confidence NUMERIC(5,4),
                 processing_time INTEGER,
                 responses JSONB,
@@ -93,6 +95,53 @@ def setup_database():
             )
         ''')
 
+        # Columns the Flask service needs on the shared tables
+        cursor.execute('ALTER TABLE batches ADD COLUMN IF NOT EXISTS total_students INTEGER')
+        cursor.execute('''
+            ALTER TABLE omr_sheets
+                ADD COLUMN IF NOT EXISTS subject_position INTEGER,
+                ADD COLUMN IF NOT EXISTS page INTEGER,
+                ADD COLUMN IF NOT EXISTS sheet_key TEXT,
+                ADD COLUMN IF NOT EXISTS percentage NUMERIC(5,2)
+        ''')
+        # Scores are on each template's own option scale, which may exceed 9.99
+        cursor.execute('ALTER TABLE omr_sheets ALTER COLUMN overall_score TYPE NUMERIC(6,2)')
+
+        # Create batch_subjects table (ordered subject/teacher list per batch)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS batch_subjects (
+                batch_id UUID NOT NULL REFERENCES batches(id) ON DELETE CASCADE,
+                position INTEGER NOT NULL,
+                subject TEXT NOT NULL,
+                teacher_name TEXT NOT NULL,
+                PRIMARY KEY (batch_id, position)
+            )
+        ''')
+
+        # Create sheet_responses table (one row per question per sheet)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sheet_responses (
+                id BIGSERIAL PRIMARY KEY,
+                sheet_id UUID NOT NULL REFERENCES omr_sheets(id) ON DELETE CASCADE,
+                batch_id UUID NOT NULL REFERENCES batches(id),
+                subject_position INTEGER,
+                question INTEGER NOT NULL,
+                question_text TEXT NOT NULL,
+                rating NUMERIC(4,2) NOT NULL,
+                confidence NUMERIC(5,4) NOT NULL
+            )
+        ''')
+
+        # Per-question percentage, scaled by the question's own option count
+        cursor.execute('ALTER TABLE sheet_responses ADD COLUMN IF NOT EXISTS percentage NUMERIC(5,2)')
+
+        # Indexes for the per-batch aggregates
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_omr_sheets_batch_status ON omr_sheets (batch_id, status)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_omr_sheets_batch_subject ON omr_sheets (batch_id, subject_position)')
+        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_omr_sheets_batch_sheet_key ON omr_sheets (batch_id, sheet_key)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sheet_responses_batch_question ON sheet_responses (batch_id, question)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sheet_responses_sheet ON sheet_responses (sheet_id)')
+
         # Create feedback_questions table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS feedback_questions (
@@ -103,6 +152,24 @@ def setup_database():
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
+        cursor.execute('ALTER TABLE feedback_questions ADD COLUMN IF NOT EXISTS "order" INTEGER NOT NULL DEFAULT 0')
+
+        # Create omr_templates table; configuration holds the bubble layout
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS omr_templates (
+                id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+                name TEXT NOT NULL,
+                version TEXT NOT NULL,
+                is_active BOOLEAN DEFAULT TRUE,
+                configuration JSONB,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Dashboard counters, maintained by triggers and seeded from the existing rows
+        conn.autocommit = False
+        omr_stats.install(conn)
+        omr_stats.rebuild(conn)
 
         print("Database and tables created successfully!")
 
@@ -34,7 +34,7 @@ export const omrSheets = pgTable("omr_sheets", {
   fileName: text("file_name").notNull(),
   filePath: text("file_path").notNull(),
   status: text("status").notNull().default("pending"), // pending, processed, failed, review_needed
-  overallScore: numeric("overall_score", { precision: 3, scale: 2 }),
+  overallScore: numeric("overall_score", { precision: 6, scale: 2 }),
   confidence: numeric("confidence", { precision: 5, scale: 4 }),
   processingTime: integer("processing_time"), // in milliseconds
   responses: json("responses"), // Array of question responses
@@ -0,0 +1,130 @@
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+from datetime import datetime
+
+from omr_templates import default_template
+
+# Configuration
+SHEET_CACHE_PATH = os.getenv('SHEET_CACHE_PATH', os.path.join('uploads', 'sheet_cache.sqlite3'))
+SHEET_CACHE_ENABLED = os.getenv('SHEET_CACHE_ENABLED', 'true').lower() == 'true'  # Reuse results for identical uploads
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sheet_results (
+    content_key TEXT PRIMARY KEY,
+    result TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS batch_uploads (
+    batch_code TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    uploaded_at TEXT NOT NULL,
+    PRIMARY KEY (batch_code, content_hash)
+);
+"""
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def hash_stream(stream):
+    """SHA-256 of a file-like object's contents, leaving it rewound"""
+    if hasattr(stream, 'getbuffer'):
+        digest = hashlib.sha256(stream.getbuffer()).hexdigest()
+    else:
+        stream.seek(0)
+        hasher = hashlib.sha256()
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+        digest = hasher.hexdigest()
+    stream.seek(0)
+    return digest
+
+
+def hash_file(path):
+    with open(path, 'rb') as f:
+        return hash_stream(f)
+
+
+class SheetCache:
+    """Content-addressed store of processor results in a local SQLite file
+
+    Results are keyed by the upload's SHA-256, the template id and version and the
+    decode settings, so a byte-identical re-upload skips OpenCV entirely. It also
+    remembers which hashes each batch has seen, to flag duplicate uploads.
+    """
+
+    def __init__(self, db_path=SHEET_CACHE_PATH, enabled=SHEET_CACHE_ENABLED):
+        self.db_path = db_path
+        self.enabled = enabled
+        self._local = threading.local()
+
+        self.hits = 0
+        self.misses = 0
+
+        if enabled:
+            os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+            conn = self._conn()
+            conn.executescript(SCHEMA)
+
+    def _conn(self):
+        """One SQLite connection per thread, reopened in forked children"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._local.conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.pid = os.getpid()
+        return conn
+
+    def key(self, content_hash, template=None):
+        # Imported here so the results endpoints start without OpenCV
+        from omr_processor import DECODE_MODE, PDF_COARSE_DPI
+        template = template or default_template()
+        return f'{content_hash}:{template.id}:{template.version}:{DECODE_MODE}:{PDF_COARSE_DPI}'
+
+    def get(self, key):
+        """Stored result for a content key, or None"""
+        if not self.enabled:
+            return None
+        row = self._conn().execute("SELECT result FROM sheet_results WHERE content_key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        result = json.loads(row[0])
+        result['cached'] = True
+        return result
+
+    def put(self, key, result):
+        """Store a successful result; failures are retried on the next upload"""
+        if not self.enabled or not result.get('success'):
+            return
+        self._conn().execute(
+            "INSERT OR REPLACE INTO sheet_results (content_key, result, created_at) VALUES (?, ?, ?)",
+            (key, json.dumps(result), datetime.now().isoformat()))
+
+    def register(self, batch_code, content_hash, file_name):
+        """Record an upload for a batch, returning the earlier file name if it is a duplicate"""
+        if not self.enabled:
+            return None
+        conn = self._conn()
+        row = conn.execute("SELECT file_name FROM batch_uploads WHERE batch_code = ? AND content_hash = ?",
+                           (batch_code, content_hash)).fetchone()
+        if row is not None:
+            return row[0]
+        conn.execute("""
+            INSERT OR IGNORE INTO batch_uploads (batch_code, content_hash, file_name, uploaded_at)
+            VALUES (?, ?, ?, ?)
+        """, (batch_code, content_hash, file_name, datetime.now().isoformat()))
+        return None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'enabled': self.enabled,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRate': self.hits / lookups if lookups else 0
+        }
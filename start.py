@@ -10,12 +10,21 @@ def run_flask():
     print("Starting Flask backend...")
     subprocess.run([sys.executable, "app.py"], cwd=".")
 
+def run_production():
+    """Run the backend under gunicorn with pre-forked, preloaded workers"""
+    print("Starting production backend...")
+    return subprocess.run([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "wsgi:app"], cwd=".").returncode
+
 def run_vite():
     """Run the Vite frontend"""
     print("Starting Vite frontend...")
     subprocess.run(["npm", "run", "dev:client"], shell=True)
 
 if __name__ == "__main__":
+    # The built frontend is served separately in production, so only the backend runs here
+    if "--production" in sys.argv:
+        sys.exit(run_production())
+    
     # Start Flask backend in a separate thread
     flask_thread = threading.Thread(target=run_flask)
     flask_thread.daemon = True
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from omr_archive import CropArchive, encode_crops, pack_crops, without_crops
+from omr_engine import BubbleGrid
+
+REGIONS = [
+    [(10, 10, 6, 5), (20, 10, 6, 5), (30, 10, 6, 5)],
+    [(10, 30, 7, 7), (20, 30, 7, 7)],
+    # Clipped at the image edge
+    [(58, 50, 10, 5)]
+]
+
+
+def sheet(seed):
+    rng = np.random.default_rng(seed)
+    return np.where(rng.random((60, 64)) < 0.4, 255, 0).astype(np.uint8)
+
+
+def record(grid, binary):
+    return pack_crops(grid.options_per_question, *grid.crops(binary))
+
+
+def test_round_trip_matches_the_scored_sheet(tmp_path):
+    grid, binary = BubbleGrid(REGIONS), sheet(1)
+    archive = CropArchive('batch', root=str(tmp_path))
+    archive.append([('a.png', record(grid, binary))])
+
+    crops = archive.get('a.png')
+    assert len(crops) == len(grid)
+    np.testing.assert_allclose(crops.fill_ratios(), grid.fill_ratios(binary)[0])
+    for k, (x, y, w, h) in enumerate(box for question in REGIONS for box in question):
+        np.testing.assert_array_equal(crops.bubble(k), (binary[y:y + h, x:x + w] != 0) * 255)
+
+    scores, valid = crops.scores()
+    assert scores.shape == (1, 3, 3) and valid.sum() == len(grid)
+    assert archive.stats()['records'] == 1
+
+
+def test_latest_record_of_a_sheet_wins(tmp_path):
+    grid = BubbleGrid(REGIONS)
+    archive = CropArchive('batch', root=str(tmp_path))
+    archive.append([('a.png', record(grid, sheet(1))), ('b.png', record(grid, sheet(2)))])
+    archive.append([('a.png', record(grid, sheet(3)))])
+
+    np.testing.assert_allclose(archive.get('a.png').fill_ratios(), grid.fill_ratios(sheet(3))[0])
+    np.testing.assert_allclose(archive.get('b.png').fill_ratios(), grid.fill_ratios(sheet(2))[0])
+    assert archive.get('c.png') is None
+    assert CropArchive('other', root=str(tmp_path)).get('a.png') is None
+
+
+def test_corrupt_record_is_refused(tmp_path):
+    grid = BubbleGrid(REGIONS)
+    archive = CropArchive('batch', root=str(tmp_path))
+    archive.append([('a.png', record(grid, sheet(1)))])
+    with open(archive.data_path, 'r+b') as f:
+        # Inside the first record, just past the file magic and record header
+        f.seek(16)
+        f.write(b'\xff' * 4)
+
+    with pytest.raises(ValueError):
+        archive.get('a.png')
+
+
+def test_crops_travel_as_text_and_are_stripped_from_responses():
+    grid, binary = BubbleGrid(REGIONS), sheet(1)
+    result = {'success': True, 'sheets': [{'success': True, 'crops': encode_crops(grid, binary)}]}
+
+    assert isinstance(result['sheets'][0]['crops'], str)
+    assert without_crops(result) == {'success': True, 'sheets': [{'success': True}]}
+    assert 'crops' in result['sheets'][0]
@@ -0,0 +1,147 @@
+import os
+import json
+import subprocess
+import sys
+
+import pytest
+
+import omr_jobs
+from omr_jobs import JobQueue
+
+
+class Done:
+    def __init__(self, value):
+        self.value = value
+
+    def result(self, timeout=None):
+        return self.value
+
+
+class StubProcessor:
+    @staticmethod
+    def failed_result(error):
+        return {'success': False, 'error': error, 'ratings': []}
+
+
+class StubPool:
+    processor = StubProcessor()
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, path, pdf=False):
+        self.submitted.append(path)
+        return Done({'success': True, 'ratings': [], 'crops': 'packed'})
+
+
+@pytest.fixture
+def make_queue(tmp_path, monkeypatch):
+    # Sheets are claimed and processed by hand instead of by worker threads
+    monkeypatch.setattr(JobQueue, 'start', lambda self, requeue=True: None)
+
+    def make(on_sheet_done=None):
+        return JobQueue(StubPool(), on_sheet_done=on_sheet_done, db_path=str(tmp_path / 'jobs.sqlite3'),
+                        spool_dir=str(tmp_path / 'jobs'))
+    return make
+
+
+def upload(name, data=b'scan'):
+    return (name, name.endswith('.pdf'), lambda path: open(path, 'wb').write(data))
+
+
+def rows(queue):
+    return [dict(row) for row in queue._conn().execute("SELECT * FROM job_sheets ORDER BY id")]
+
+
+def test_claim_takes_oldest_pending_sheet(make_queue):
+    queue = make_queue()
+    queue.enqueue('B1', [upload('a.png'), upload('b.pdf')])
+
+    sheet = queue._claim()
+    assert sheet['file_name'] == 'a.png' and sheet['position'] == 0
+    first, second = rows(queue)
+    assert first['status'] == 'processing' and first['owner'] == os.getpid()
+    assert second['status'] == 'pending' and second['is_pdf'] == 1
+    assert queue.backlog() == 2
+
+
+def test_processed_sheet_is_stored_without_crops_and_spool_removed(make_queue):
+    stored = []
+    queue = make_queue(lambda *args: stored.append(args))
+    job_id = queue.enqueue('B1', [upload('a.png')])
+
+    sheet = queue._claim()
+    queue._process(sheet)
+
+    assert stored[0][:3] == ('B1', 0, 'a.png')
+    assert stored[0][3]['crops'] == 'packed'
+    row = rows(queue)[0]
+    assert row['status'] == 'processed' and 'crops' not in json.loads(row['result'])
+    assert not os.path.exists(sheet['file_path'])
+    status = queue.job_status(job_id)
+    assert status['isComplete'] and status['statusCounts'] == {'processed': 1}
+
+
+def test_store_failure_retries_with_backoff_then_fails(make_queue, monkeypatch):
+    monkeypatch.setattr(omr_jobs, 'JOB_STORE_ATTEMPTS', 2)
+
+    def refuse(*args):
+        raise RuntimeError('Database connection failed')
+
+    queue = make_queue(refuse)
+    queue.enqueue('B1', [upload('a.png')])
+
+    sheet = queue._claim()
+    queue._process(sheet)
+    row = rows(queue)[0]
+    assert row['status'] == 'pending' and row['store_attempts'] == 1 and row['retry_at']
+    assert os.path.exists(sheet['file_path'])
+    # Not claimable until its backoff has passed
+    assert queue._claim() is None
+
+    queue._conn().execute("UPDATE job_sheets SET retry_at = '2000-01-01T00:00:00'")
+    queue._process(queue._claim())
+    row = rows(queue)[0]
+    assert row['status'] == 'failed' and row['error'].startswith('Could not store results')
+    # The stored result is reused rather than the sheet processed again
+    assert len(queue.pool.submitted) == 1
+    assert json.loads(row['result'])['crops'] == 'packed'
+    assert not os.path.exists(sheet['file_path'])
+
+
+def test_requeue_interrupted_by_owner(make_queue):
+    queue = make_queue()
+    queue.enqueue('B1', [upload('a.png'), upload('b.png')])
+    queue._claim()
+    queue._claim()
+    queue._conn().execute("UPDATE job_sheets SET owner = 1 WHERE position = 1")
+
+    assert queue.requeue_interrupted(owner=1) == 1
+    assert [row['status'] for row in rows(queue)] == ['processing', 'pending']
+    assert queue.requeue_interrupted() == 1
+    assert [row['status'] for row in rows(queue)] == ['pending', 'pending']
+
+
+def test_requeue_abandoned_sheets_of_dead_processes(make_queue):
+    queue = make_queue()
+    queue.enqueue('B1', [upload('a.png'), upload('b.png')])
+    queue._claim()
+    queue._claim()
+    dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+    dead.wait()
+    queue._conn().execute("UPDATE job_sheets SET owner = ? WHERE position = 1", (dead.pid,))
+
+    queue.requeue_abandoned()
+    assert [(row['status'], row['owner']) for row in rows(queue)] == [('processing', os.getpid()), ('pending', None)]
+
+
+def test_job_with_files_still_uploading_is_incomplete(make_queue):
+    queue = make_queue()
+    job_id = queue.enqueue('B1', [])
+
+    status = queue.job_status(job_id, uploading=2)
+    assert not status['isComplete']
+    assert status['totalSheets'] == 2 and status['statusCounts'] == {'uploading': 2}
+    assert queue.job_status(job_id)['isComplete']
+    assert queue.batch_status('B1') is None
+    assert not queue.batch_status('B1', uploading=1)['isComplete']
@@ -0,0 +1,51 @@
+import pytest
+
+from result_cache import ResultCache, invalidate_batches
+
+
+@pytest.fixture
+def versions(tmp_path):
+    return str(tmp_path / 'versions.sqlite3')
+
+
+def test_write_in_another_process_invalidates_entry(versions):
+    worker, other = ResultCache(db_path=versions), ResultCache(db_path=versions)
+    worker.put('B1', {'subjects': []}, worker.version('B1'))
+    assert worker.get('B1').data == {'subjects': []}
+
+    other.invalidate('B1')
+    assert worker.get('B1') is None
+    assert worker.stats()['invalidations'] == 1
+
+
+def test_read_that_raced_a_write_is_not_served(versions):
+    cache = ResultCache(db_path=versions)
+    version = cache.version('B1')
+    cache.invalidate('B1')
+    cache.put('B1', {'stale': True}, version)
+    assert cache.get('B1') is None
+
+    cache.put('B1', {'stale': False}, cache.version('B1'))
+    assert cache.get('B1').data == {'stale': False}
+
+
+def test_writers_outside_the_server_invalidate(versions):
+    cache = ResultCache(db_path=versions)
+    cache.put('B1', {}, cache.version('B1'))
+    cache.put('B2', {}, cache.version('B2'))
+
+    invalidate_batches({'B1'}, versions)
+    assert cache.get('B1') is None
+    assert cache.get('B2') is not None
+
+
+def test_expired_and_evicted_entries_are_misses(versions):
+    cache = ResultCache(maxsize=1, ttl=0, db_path=versions)
+    cache.put('B1', {}, cache.version('B1'))
+    assert cache.get('B1') is None and cache.stats()['expirations'] == 1
+
+    cache = ResultCache(maxsize=1, db_path=versions)
+    cache.put('B1', {}, cache.version('B1'))
+    cache.put('B2', {}, cache.version('B2'))
+    assert cache.get('B1') is None and cache.get('B2') is not None
+    assert cache.stats()['evictions'] == 1
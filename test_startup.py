@@ -0,0 +1,14 @@
+import os
+import sys
+import json
+import subprocess
+
+# The imaging stack is loaded on first upload or by preload_imaging, never by `import app`
+HEAVY_MODULES = ('cv2', 'numpy', 'pdf2image')
+
+
+def test_app_import_skips_imaging_stack():
+    code = f"import sys, json, app; print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+    completed = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    assert json.loads(completed.stdout.splitlines()[-1]) == []
@@ -0,0 +1,114 @@
+import io
+import os
+import hashlib
+
+import pytest
+
+from omr_jobs import JobQueue
+from omr_uploads import UploadSessions, UploadError
+from sheet_cache import SheetCache
+
+DATA = bytes(range(256)) * 40
+
+
+@pytest.fixture
+def sessions(tmp_path, monkeypatch):
+    # Queued files are checked in the job queue, not processed
+    monkeypatch.setattr(JobQueue, 'start', lambda self, requeue=True: None)
+    queue = JobQueue(None, db_path=str(tmp_path / 'jobs.sqlite3'), spool_dir=str(tmp_path / 'jobs'))
+    return UploadSessions(queue, sheet_cache=SheetCache(str(tmp_path / 'cache.sqlite3')),
+                          db_path=str(tmp_path / 'sessions.sqlite3'), spool_dir=str(tmp_path / 'sessions'))
+
+
+def put(sessions, upload_id, offset, data, position=0, checksum=None):
+    return sessions.write_chunk(upload_id, position, offset, io.BytesIO(data), len(data), checksum)
+
+
+def test_chunks_resume_from_the_received_offset(sessions):
+    session = sessions.create('B1', [('a.png', len(DATA), None)])
+    upload_id = session['uploadId']
+
+    state = put(sessions, upload_id, 0, DATA[:4000])
+    assert state['offset'] == 4000 and state['status'] == 'receiving'
+    assert sessions.status(upload_id)['files'][0]['offset'] == 4000
+
+    with pytest.raises(UploadError) as error:
+        put(sessions, upload_id, 0, DATA[:4000])
+    assert error.value.status == 409 and error.value.details['offset'] == 4000
+
+    state = put(sessions, upload_id, 4000, DATA[4000:])
+    assert state['offset'] == len(DATA) and state['status'] == 'queued'
+
+
+def test_chunk_checksum_mismatch_is_dropped(sessions):
+    upload_id = sessions.create('B1', [('a.png', len(DATA), None)])['uploadId']
+    put(sessions, upload_id, 0, DATA[:1000])
+
+    with pytest.raises(UploadError) as error:
+        put(sessions, upload_id, 1000, DATA[1000:2000], checksum='0' * 64)
+    assert error.value.status == 400 and error.value.details['offset'] == 1000
+    assert os.path.getsize(sessions._spool_path(upload_id, 0)) == 1000
+
+    good = hashlib.sha256(DATA[1000:2000]).hexdigest()
+    assert put(sessions, upload_id, 1000, DATA[1000:2000], checksum=good)['offset'] == 2000
+
+
+def test_chunk_past_declared_size_is_refused(sessions):
+    upload_id = sessions.create('B1', [('a.png', 10, None)])['uploadId']
+    with pytest.raises(UploadError) as error:
+        put(sessions, upload_id, 0, DATA[:11])
+    assert error.value.status == 400
+
+
+def test_file_checksum_mismatch_starts_the_file_over(sessions):
+    upload_id = sessions.create('B1', [('a.png', len(DATA), 'f' * 64)])['uploadId']
+
+    with pytest.raises(UploadError) as error:
+        put(sessions, upload_id, 0, DATA)
+    assert error.value.status == 422 and error.value.details['offset'] == 0
+    assert sessions.status(upload_id)['files'][0]['offset'] == 0
+    assert os.path.getsize(sessions._spool_path(upload_id, 0)) == 0
+
+
+def test_complete_files_are_queued_on_the_session_job(sessions):
+    session = sessions.create('B1', [('a.png', len(DATA), hashlib.sha256(DATA).hexdigest()),
+                                     ('b.png', 10, None)])
+    upload_id, job_id = session['uploadId'], session['jobId']
+    queue = sessions.job_queue
+    assert not queue.job_status(job_id, uploading=sessions.awaiting(job_id=job_id))['isComplete']
+
+    put(sessions, upload_id, 0, DATA)
+    status = queue.job_status(job_id, uploading=sessions.awaiting(job_id=job_id))
+    assert status['statusCounts'] == {'pending': 1, 'uploading': 1}
+    with pytest.raises(UploadError) as error:
+        put(sessions, upload_id, 0, DATA)
+    assert error.value.status == 409
+
+    with pytest.raises(UploadError) as error:
+        sessions.finalize(upload_id)
+    assert error.value.status == 409 and error.value.details['missing'] == [1]
+
+    put(sessions, upload_id, 0, DATA[:10], position=1)
+    assert sessions.awaiting(batch_code='B1') == 0
+    assert sessions.finalize(upload_id)['finalized']
+    sheets = queue._conn().execute("SELECT position, file_name, file_path FROM job_sheets ORDER BY position").fetchall()
+    assert [(row['position'], row['file_name']) for row in sheets] == [(0, 'a.png'), (1, 'b.png')]
+    with open(sheets[0]['file_path'], 'rb') as f:
+        assert f.read() == DATA
+
+
+def test_failed_enqueue_leaves_the_last_chunk_to_resend(sessions, monkeypatch):
+    upload_id = sessions.create('B1', [('a.png', len(DATA), None)])['uploadId']
+    enqueue = sessions.job_queue.enqueue
+
+    def fail_once(batch_code, uploads, **kwargs):
+        monkeypatch.setattr(sessions.job_queue, 'enqueue', enqueue)
+        uploads[0][2](os.path.join(os.path.dirname(sessions.db_path), 'moved'))
+        raise RuntimeError('queue unavailable')
+
+    monkeypatch.setattr(sessions.job_queue, 'enqueue', fail_once)
+    with pytest.raises(RuntimeError):
+        put(sessions, upload_id, 0, DATA)
+    assert sessions.status(upload_id)['files'][0]['offset'] == 0
+
+    assert put(sessions, upload_id, 0, DATA)['status'] == 'queued'
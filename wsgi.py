@@ -0,0 +1,12 @@
+"""Production entry point: gunicorn -c gunicorn.conf.py wsgi:app
+
+Imported once in the gunicorn master (preload_app), so OpenCV, numpy and the
+compiled templates are loaded before the workers fork and shared copy-on-write.
+"""
+from app import app, job_queue, preload_imaging, preload_templates
+
+preload_imaging()
+preload_templates()
+
+# Requeue sheets interrupted by the last shutdown once, before any worker starts
+job_queue.requeue_interrupted()